@@ -9,6 +9,7 @@ import argparse
 
 from PyQt4 import QtGui, QtCore
 
+from barbecue import sweep
 from barbecue import gain_offset_controller
 
 logging.basicConfig(filename="GainOffset_log.txt", filemode="w",
@@ -48,8 +49,22 @@ class GainOffsetApplication(object):
         """
         log.debug("Process args: %s", argv)
         self.args = self.parser.parse_args(argv)
+        self.check_stop_policy()
         return self.args
 
+    def check_stop_policy(self):
+        """ Reject a saturation stop that can never end a row of the
+        sweep strategy, and warn if it only ends some rows.
+        """
+        if not self.args.stop_saturated:
+            return
+        try:
+            warning = sweep.check_stop_policy(self.args.strategy)
+        except ValueError as exc:
+            self.parser.error(str(exc))
+        if warning is not None:
+            log.warning(warning)
+
     def create_parser(self):
         """ Create the parser with arguments specific to this
         application.
@@ -60,6 +75,32 @@ class GainOffsetApplication(object):
         help_str = "Automatically terminate the program for testing"
         parser.add_argument("-t", "--testing", action="store_true",
                             help=help_str)
+
+        help_str = "Memory map each acquisition to a file in this directory"
+        parser.add_argument("--sweep-dir", default=None, help=help_str)
+
+        help_str = "Order and subset of gain/offset combinations to scan"
+        parser.add_argument("--strategy", default="raster",
+                            choices=sorted(sweep.STRATEGIES), help=help_str)
+
+        help_str = "Number of lines averaged for each combination"
+        parser.add_argument("--frames", type=int, default=1, help=help_str)
+
+        help_str = "Seconds to wait after a large gain or offset change"
+        parser.add_argument("--settle", type=float, default=0.0,
+                            help=help_str)
+
+        help_str = "Grab frames while the previous ones are stored"
+        parser.add_argument("--pipeline", action="store_true",
+                            help=help_str)
+
+        help_str = "Live image updates per second during a sweep, 0 for none"
+        parser.add_argument("--live-fps", type=float, default=10.0,
+                            help=help_str)
+
+        help_str = "End a gain row after this many saturated lines"
+        parser.add_argument("--stop-saturated", type=int, default=0,
+                            help=help_str)
         return parser
 
     def run(self):
@@ -76,6 +117,13 @@ class GainOffsetApplication(object):
 
         self.form = gain_offset_controller.GainOffset()
         #self.form.set_parameters(self.args)
+        self.form.sweep_directory = self.args.sweep_dir
+        self.form.sweep_strategy = self.args.strategy
+        self.form.frames = self.args.frames
+        self.form.settle_delay = self.args.settle
+        self.form.pipelined = self.args.pipeline
+        self.form.saturation_stop = self.args.stop_saturated
+        self.form.live_fps = self.args.live_fps
 
         if not self.args.testing:
             sys.exit(app.exec_())
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+""" SweepRunner - run a gain/offset sweep from the command line, with no
+display required.
+"""
+
+import sys
+import json
+import logging
+import argparse
+
+from barbecue import model
+from barbecue import devices
+from barbecue import sweep
+from barbecue import storage
+from barbecue import pipeline
+from barbecue import progress
+
+log = logging.getLogger(__name__)
+
+class DeviceHelpParser(argparse.ArgumentParser):
+    """ Argument parser that lists the registered device types in the
+    help of the device action. The list is only built when the help is
+    shown, as finding the installed drivers imports pkg_resources.
+    """
+    device_action = None
+
+    def format_help(self):
+        if self.device_action is not None:
+            self.device_action.help = "Device type to acquire from: %s" % \
+                                      ", ".join(devices.available())
+        return super(DeviceHelpParser, self).format_help()
+
+class SweepRunnerApplication(object):
+    """ Acquire a gain/offset sweep from the specified device and stream
+    the results to a bbq, npz or csv file, printing the throughput and
+    estimated time remaining as it runs.
+    """
+    def __init__(self, stream=None):
+        super(SweepRunnerApplication, self).__init__()
+        log.debug("startup")
+        self.parser = self.create_parser()
+        self.args = None
+        self.stream = stream
+        if self.stream is None:
+            self.stream = sys.stdout
+
+        self.progress = progress.ProgressReporter(self.report)
+
+    def parse_args(self, argv):
+        """ Handle any bad arguments, then set defaults. Values in a
+        config file replace the defaults, and are in turn replaced by any
+        arguments on the command line.
+        """
+        log.debug("Process args: %s", argv)
+        self.args = self.parser.parse_args(argv)
+        if self.args.config is not None:
+            config = json.load(open(self.args.config))
+            for key in config:
+                if key.replace("-", "_") not in vars(self.args):
+                    self.parser.error("Unknown config setting: %s" % key)
+            self.parser.set_defaults(**dict((key.replace("-", "_"), value)
+                                            for key, value in config.items()))
+            self.args = self.parser.parse_args(argv)
+
+        if self.args.output is None:
+            self.parser.error("An output file is required")
+        self.check_stop_policy()
+        return self.args
+
+    def check_stop_policy(self):
+        """ Reject a saturation stop that can never end a row of the
+        sweep strategy, and warn if it only ends some rows.
+        """
+        if not self.args.stop_saturated:
+            return
+        try:
+            warning = sweep.check_stop_policy(self.args.strategy)
+        except ValueError as exc:
+            self.parser.error(str(exc))
+        if warning is not None:
+            log.warning(warning)
+
+    def create_parser(self):
+        """ Create the parser with arguments specific to this
+        application.
+        """
+        desc = "acquire a gain/offset sweep from the specified device"
+        parser = DeviceHelpParser(description=desc)
+
+        help_str = "Results file, format chosen by extension: bbq, npz, csv"
+        parser.add_argument("-o", "--output", default=None, help=help_str)
+
+        help_str = "JSON file of settings, keyed by long argument name"
+        parser.add_argument("-c", "--config", default=None, help=help_str)
+
+        help_str = "Device type to acquire from"
+        parser.device_action = parser.add_argument("-d", "--device",
+                                                   default="single",
+                                                   help=help_str)
+
+        help_str = "Sweep file played back by the replay device"
+        parser.add_argument("--replay", default=None, help=help_str)
+
+        help_str = "Replay at the recorded scan times"
+        parser.add_argument("--paced", action="store_true", help=help_str)
+
+        help_str = "First and last gain of the sweep"
+        parser.add_argument("--gains", type=int, nargs=2, default=[0, 255],
+                            metavar=("START", "END"), help=help_str)
+
+        help_str = "First and last offset of the sweep"
+        parser.add_argument("--offsets", type=int, nargs=2, default=[0, 255],
+                            metavar=("START", "END"), help=help_str)
+
+        help_str = "Line time setting stored with each scan"
+        parser.add_argument("--linetime", type=int, default=100,
+                            help=help_str)
+
+        help_str = "Integration time setting stored with each scan"
+        parser.add_argument("--integration", type=int, default=98,
+                            help=help_str)
+
+        help_str = "Order and subset of gain/offset combinations to scan"
+        parser.add_argument("--strategy", default="raster",
+                            choices=sorted(sweep.STRATEGIES), help=help_str)
+
+        help_str = "Number of lines averaged for each combination"
+        parser.add_argument("--frames", type=int, default=1, help=help_str)
+
+        help_str = "Seconds to wait after a large gain or offset change"
+        parser.add_argument("--settle", type=float, default=0.0,
+                            help=help_str)
+
+        help_str = "Grab frames while the previous ones are stored"
+        parser.add_argument("--pipeline", action="store_true",
+                            help=help_str)
+
+        help_str = "End a gain row after this many saturated lines"
+        parser.add_argument("--stop-saturated", type=int, default=0,
+                            help=help_str)
+
+        help_str = "Seconds between progress reports"
+        parser.add_argument("--interval", type=float, default=5.0,
+                            help=help_str)
+        return parser
+
+    def run(self):
+        """ Scan every block of the sweep strategy. Binary files are
+        written as the sweep runs, csv offset groups are appended as soon
+        as they are complete. An interrupted sweep keeps the results
+        measured so far.
+        """
+        args = self.args
+        output = args.output
+        file_format = storage.file_format(output)
+
+        offsets = range(args.offsets[0], args.offsets[1] + 1)
+        gains = range(args.gains[0], args.gains[1] + 1)
+
+        acquire_model = model.Model()
+        acquire_model.frames = args.frames
+        acquire_model.settle_delay = args.settle
+        if args.replay is not None:
+            acquire_model.device_options = {"filename": args.replay,
+                                            "paced": args.paced}
+
+        # Open the device before any output file is created
+        acquire_model.assign(args.device)
+
+        # A bbq sweep is memory mapped straight to the output file
+        filename = None
+        if file_format == "bbq":
+            filename = output
+        cube = acquire_model.allocate(offsets, gains, filename=filename)
+        strategy = sweep.create(args.strategy, offsets, gains)
+
+        scanner = acquire_model
+        if args.pipeline:
+            scanner = pipeline.PipelinedScanner(acquire_model)
+
+        policy = None
+        if args.stop_saturated:
+            policy = sweep.SaturationStop(args.stop_saturated)
+
+        csv_file = None
+        written = set()
+        if file_format == "csv":
+            csv_file = storage.create_csv(output)
+            storage.write_header(csv_file)
+
+        # Strategies that skip combinations finish before the total, so
+        # the estimate is an upper bound
+        self.progress.max_rate = 0.0
+        if args.interval > 0:
+            self.progress.max_rate = 1.0 / args.interval
+        self.progress.start(len(offsets) * len(gains), unit="scans")
+
+        def block_complete(block_offsets, block_gains):
+            if csv_file is not None and strategy.offset_major:
+                self.write_groups(csv_file, cube, block_offsets, written)
+
+        try:
+            scanner.scan_sweep(strategy, args.linetime, args.integration,
+                               callback=self.scan_complete, policy=policy,
+                               block_complete=block_complete)
+        except KeyboardInterrupt:
+            log.warning("Sweep interrupted after %s scans",
+                        self.progress.count)
+        finally:
+            acquire_model.close_model()
+
+            if csv_file is not None:
+                self.write_groups(csv_file, cube, cube.offsets, written)
+                csv_file.close()
+            elif file_format == "npz":
+                storage.save_binary(output, cube.groups())
+            else:
+                cube.flush()
+
+        self.progress.finish()
+        return self.progress.count
+
+    def write_groups(self, csv_file, cube, offsets, written):
+        """ Append the offset groups with measured cells that have not
+        yet been written to the csv file.
+        """
+        measured = cube.measured().any(axis=1)
+        for offset in offsets:
+            offset = int(offset)
+            if offset in written:
+                continue
+            if measured[cube.offset_position(offset)]:
+                written.add(offset)
+                storage.write_group(csv_file, cube.group(offset))
+        csv_file.flush()
+
+    def scan_complete(self, offset, gain):
+        """ Count the scan, the reporter limits the report rate.
+        """
+        self.progress.add()
+
+    def report(self, reporter):
+        """ Print the scans completed, throughput and time remaining.
+        """
+        self.stream.write(reporter.describe() + "\n")
+        self.stream.flush()
+
+def main(argv=None):
+    """ main calls the wrapper code around the application objects with
+    as little framework as possible.
+    """
+    if argv is None:
+        from sys import argv as sys_argv
+        argv = sys_argv
+
+    argv = argv[1:]
+    logging.basicConfig(level=logging.INFO)
+    log.debug("Arguments: %s", argv)
+
+    exit_code = 0
+    try:
+        runner = SweepRunnerApplication()
+        runner.parse_args(argv)
+        runner.run()
+
+    except SystemExit as exc:
+        exit_code = exc.code
+
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
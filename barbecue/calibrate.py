@@ -0,0 +1,135 @@
+""" Search for the gain and offset settings that put the dark level and
+peak signal of a spectrometer at target counts, without sweeping every
+combination.
+"""
+
+import logging
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+class Calibrator(object):
+    """ Alternately bisect the offset to reach the target dark level and
+    the gain to reach the target peak level, until both are within the
+    tolerance. The dark and peak levels of a line are low and high
+    percentiles of its pixel values. Requires an assigned model with no
+    sweep cube allocated.
+    """
+    def __init__(self, acquire_model, linetime, integration,
+                 gain_range=(0, 255), offset_range=(0, 255),
+                 dark_percentile=5.0, peak_percentile=99.0):
+        super(Calibrator, self).__init__()
+        if acquire_model.cube is not None:
+            raise ValueError("Calibration scans are not stored in a cube")
+
+        self.model = acquire_model
+        self.linetime = linetime
+        self.integration = integration
+        self.gain_range = gain_range
+        self.offset_range = offset_range
+        self.dark_percentile = dark_percentile
+        self.peak_percentile = peak_percentile
+        self.trail = []
+
+    def measure(self, gain, offset):
+        """ Scan one line at the settings, record and return the
+        measurement.
+        """
+        self.model.scan(gain, offset, self.linetime, self.integration)
+        data = numpy.asarray(self.model.results.pop().data, dtype=float)
+
+        dark, peak = numpy.percentile(data, [self.dark_percentile,
+                                             self.peak_percentile])
+        measurement = Measurement(gain, offset, dark, peak)
+        self.trail.append(measurement)
+        log.debug("Gain %s, offset %s: dark %s, peak %s", gain, offset,
+                  dark, peak)
+        return measurement
+
+    def calibrate(self, dark_target, peak_target, tolerance=16.0,
+                  max_rounds=4, gain=None):
+        """ Return the Calibration with the closest gain and offset
+        found. The offset search starts at the middle of the gain range
+        unless a gain is specified.
+        """
+        if max_rounds < 1:
+            raise ValueError("Calibration needs at least one round")
+
+        self.trail = []
+        if gain is None:
+            gain = (self.gain_range[0] + self.gain_range[1]) // 2
+
+        offset = self.offset_range[0]
+        for _ in range(max_rounds):
+            offset = self.search(lambda value: self.measure(gain,
+                                                            value).dark,
+                                 self.offset_range, dark_target, tolerance)
+            gain = self.search(lambda value: self.measure(value,
+                                                          offset).peak,
+                               self.gain_range, peak_target, tolerance)
+
+            # Changing the gain moves the dark level too, so check both
+            final = self.measure(gain, offset)
+            if abs(final.dark - dark_target) <= tolerance and \
+               abs(final.peak - peak_target) <= tolerance:
+                return Calibration(final, True, self.trail)
+
+        log.warning("Calibration did not converge in %s rounds", max_rounds)
+        return Calibration(final, False, self.trail)
+
+    def search(self, level_at, value_range, target, tolerance):
+        """ Bisect the integer setting range for the value whose level is
+        closest to the target. The level must be monotonic in the
+        setting, in either direction.
+        """
+        low, high = value_range
+        low_level = level_at(low)
+        high_level = level_at(high)
+        rising = high_level >= low_level
+
+        best = min([(abs(low_level - target), low),
+                    (abs(high_level - target), high)])
+
+        while high - low > 1 and best[0] > tolerance:
+            middle = (low + high) // 2
+            level = level_at(middle)
+            best = min(best, (abs(level - target), middle))
+
+            if (level < target) == rising:
+                low = middle
+            else:
+                high = middle
+
+        return best[1]
+
+
+class Measurement(object):
+    """ Dark and peak levels of a line scanned at a gain and offset.
+    """
+    def __init__(self, gain, offset, dark, peak):
+        super(Measurement, self).__init__()
+        self.gain = gain
+        self.offset = offset
+        self.dark = dark
+        self.peak = peak
+
+
+class Calibration(object):
+    """ The chosen gain and offset, their measured levels, and every
+    measurement made to find them.
+    """
+    def __init__(self, measurement, converged, trail):
+        super(Calibration, self).__init__()
+        self.gain = measurement.gain
+        self.offset = measurement.offset
+        self.dark = measurement.dark
+        self.peak = measurement.peak
+        self.converged = converged
+        self.trail = trail
+
+    @property
+    def scans(self):
+        """ Number of scans used by the calibration.
+        """
+        return len(self.trail)
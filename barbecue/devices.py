@@ -0,0 +1,471 @@
+""" Device layers used by the barbecue models.
+"""
+
+import os
+import time
+import tempfile
+import logging
+import importlib
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+# Drivers by device type, as "module:class" to import when the device is
+# created, or as a callable that returns the device. Drivers installed by
+# other packages are found by name in the entry point group.
+DEVICES = {"single": "wasatchcameralink.simulation:SimulatedCobraSLED",
+           "simulation": "wasatchcameralink.simulation:SimulatedCobraSLED",
+           "cobra": "wasatchcameralink.DALSA:Cobra",
+           "fast": "barbecue.devices:FastSimulatedCobra",
+           "replay": "barbecue.devices:ReplayCobra",
+          }
+
+ENTRY_POINT_GROUP = "barbecue.devices"
+
+def register(device_type, driver):
+    """ Add a driver to the registry, as a "module:class" string or a
+    callable that returns the device.
+    """
+    DEVICES[device_type] = driver
+
+def available():
+    """ Return the sorted names of every registered device type.
+    """
+    names = set(DEVICES)
+    for entry_point in entry_points():
+        names.add(entry_point.name)
+    return sorted(names)
+
+def entry_points(device_type=None):
+    """ Return the device entry points installed by other packages, or
+    none if setuptools is not available.
+    """
+    try:
+        import pkg_resources
+    except ImportError:
+        return []
+    return list(pkg_resources.iter_entry_points(ENTRY_POINT_GROUP,
+                                                device_type))
+
+def load_driver(device_type):
+    """ Return the callable that creates the device type, importing its
+    module if required.
+    """
+    if device_type not in DEVICES:
+        for entry_point in entry_points(device_type):
+            register(device_type, entry_point.load())
+            break
+        else:
+            raise ValueError("Unknown device type: %s" % device_type)
+
+    driver = DEVICES[device_type]
+    if callable(driver):
+        return driver
+
+    module_name, class_name = driver.split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+def create(device_type, **options):
+    """ Return a new device of the registered type.
+    """
+    return load_driver(device_type)(**options)
+
+class RegisterShadow(object):
+    """ Wrap a device and keep a shadow copy of the last gain and offset
+    written to it. Writes of the value already in the register are
+    skipped, which removes most of the serial round trips from a sweep.
+    With a verify interval, every n'th redundant write is issued anyway
+    to refresh the device. A write that moves a register by more than
+    the settle threshold is followed by the settle delay, in seconds, to
+    let the analog front end recover. All other device calls pass
+    straight through.
+    """
+    def __init__(self, device, verify_interval=0, settle_delay=0.0,
+                 settle_threshold=16):
+        super(RegisterShadow, self).__init__()
+        self._device = device
+        self.verify_interval = verify_interval
+        self.settle_delay = settle_delay
+        self.settle_threshold = settle_threshold
+        self.values = {}
+        self.issued = 0
+        self.skipped = 0
+        self.settles = 0
+        self.settle_time = 0.0
+        self._redundant = {}
+
+    def set_gain(self, gain):
+        """ Write the gain register if it differs from the shadow value.
+        """
+        return self._write("gain", gain, self._device.set_gain)
+
+    def set_offset(self, offset):
+        """ Write the offset register if it differs from the shadow
+        value.
+        """
+        return self._write("offset", offset, self._device.set_offset)
+
+    def _write(self, name, value, setter):
+        """ Issue or skip the register write, and keep the counts.
+        """
+        if name in self.values and self.values[name] == value:
+            count = self._redundant.get(name, 0) + 1
+            if not self.verify_interval or count < self.verify_interval:
+                self._redundant[name] = count
+                self.skipped += 1
+                return True
+
+        # The register state is unknown until the write succeeds
+        previous = self.values.pop(name, None)
+        result = setter(value)
+        self.values[name] = value
+        self._redundant[name] = 0
+        self.issued += 1
+
+        if self.settle_delay and previous is not None and \
+           abs(int(value) - int(previous)) > self.settle_threshold:
+            time.sleep(self.settle_delay)
+            self.settles += 1
+            self.settle_time += self.settle_delay
+        return result
+
+    def invalidate(self):
+        """ Forget the shadow values, so the next writes are issued.
+        """
+        self.values = {}
+        self._redundant = {}
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+
+class DeviceSession(object):
+    """ Long lived connection to a device of the registered type, shared
+    by every sweep instead of being set up again for each one. The
+    device is wrapped in a register shadow, which stays valid for as long
+    as the device is open. A failed health check closes and reopens the
+    device.
+    """
+    def __init__(self, device_type, **options):
+        super(DeviceSession, self).__init__()
+        self.device_type = device_type
+        self.options = options
+        self.device = None
+        self.opens = 0
+
+    @property
+    def is_open(self):
+        """ True if the device has been set up and not closed.
+        """
+        return self.device is not None
+
+    def open(self):
+        """ Create and set up the device, return its register shadow.
+        """
+        raw_dev = create(self.device_type, **self.options)
+        shadow = RegisterShadow(raw_dev)
+
+        # Yes, this order is correct. You have to setup, then grab from
+        # the pipe, then open the port and then start the scan. You
+        # might think this would cause a timeout in the sap net grab.
+        # Apparently it does not. However, if you setup the pipe and/or
+        # open the serial port first, everything will look fine. Until
+        # you go to write to the serial port after a grab operation.
+        # Then the write command will succeed, but reading back the
+        # response will always result in '', and no changes appear to be
+        # written to the device.
+        result = shadow.setup_pipe()
+        result, data = shadow.grab_pipe()
+        forc_res = shadow.open_port()
+        forc_res = shadow.start_scan()
+
+        self.device = shadow
+        self.opens += 1
+        log.info("Opened %s device", self.device_type)
+        return shadow
+
+    def check(self):
+        """ Return True if the open device grabs a line.
+        """
+        if not self.is_open:
+            return False
+
+        try:
+            result, data = self.device.grab_pipe()
+        except Exception:
+            log.exception("Health check of %s device failed",
+                          self.device_type)
+            return False
+        return bool(result) and data is not None and len(data) > 0
+
+    def acquire(self):
+        """ Return the register shadow of a healthy device, opening or
+        reopening the device as needed.
+        """
+        if self.is_open and self.check():
+            return self.device
+
+        self.close()
+        return self.open()
+
+    def close(self):
+        """ Close the device if it is open. Errors on close are logged,
+        as the device is discarded either way.
+        """
+        if not self.is_open:
+            return
+
+        device = self.device
+        self.device = None
+        try:
+            device.close_pipe()
+        except Exception:
+            log.exception("Close of %s device failed", self.device_type)
+        log.info("Closed %s device", self.device_type)
+
+
+
+class FastSimulatedCobra(object):
+    """ Simulated Cobra spectrometer with the gain/offset response, read
+    noise, saturation and dead pixels of the hardware, computed with
+    numpy. The offset sets the dark level and the gain scales the signal
+    above it, and the result is clipped to the 12 bit range. The first
+    masked pixels are optically covered and read the dark level. A whole
+    row of gains is generated in one call, and the per-line device
+    interface can add an artificial delay to every register write and
+    grab. A grab can be split into a trigger, which takes the register
+    settings, and the read out of the frame.
+    """
+    def __init__(self, pixels=2048, full_scale=4095, noise=4.0,
+                 dead_pixels=8, masked_pixels=16, write_latency=0.0,
+                 grab_latency=0.0, seed=0):
+        super(FastSimulatedCobra, self).__init__()
+        self.pixels = pixels
+        self.full_scale = full_scale
+        self.noise = noise
+        self.write_latency = write_latency
+        self.grab_latency = grab_latency
+        self.gain = 0
+        self.offset = 0
+        self._triggered = (0, 0, 0.0)
+
+        self._random = numpy.random.RandomState(seed)
+
+        # Short simulated sensors keep most of their pixels live
+        masked_pixels = min(masked_pixels, pixels // 4)
+        dead_pixels = min(dead_pixels, (pixels - masked_pixels) // 4)
+
+        # Broad lamp spectrum over a stray light floor, with a few
+        # emission lines on top
+        position = numpy.linspace(-1.0, 1.0, pixels)
+        signal = 200.0 + 600.0 * numpy.exp(-position ** 2 / 0.18)
+        for center in self._random.uniform(-0.8, 0.8, 5):
+            signal += 400.0 * numpy.exp(-(position - center) ** 2 / 2e-4)
+        signal[:masked_pixels] = 0
+        self.signal = signal
+
+        self.dead = masked_pixels + self._random.choice(
+            pixels - masked_pixels, dead_pixels, replace=False)
+
+    def levels(self, gains, offset):
+        """ Return the (gains, pixels) array of noiseless floating point
+        levels at the offset, before clipping.
+        """
+        gains = numpy.asarray(gains, dtype=float)
+        dark = 16.0 * (offset - 64)
+        factor = 1.0 + gains / 32.0
+        return dark + factor[:, None] * self.signal[None, :]
+
+    def grab_gain_row(self, gains, offset):
+        """ Return a line for every gain at the offset, as a uint16 array
+        of shape (gains, pixels).
+        """
+        levels = self.levels(gains, offset)
+        if self.noise:
+            levels += self._random.normal(0.0, self.noise, levels.shape)
+        numpy.clip(levels, 0, self.full_scale, out=levels)
+        levels[:, self.dead] = 0
+        return levels.astype(numpy.uint16)
+
+    def fill(self, cube, linetime=-1, integration=-1):
+        """ Store a simulated line in every cell of the sweep cube, one
+        gain row at a time.
+        """
+        for position, offset in enumerate(cube.offsets):
+            cube.data[position] = self.grab_gain_row(cube.gains, offset)
+            meta = cube.meta[position]
+            meta["gain"] = cube.gains
+            meta["offset"] = offset
+            meta["linetime"] = linetime
+            meta["integration"] = integration
+            meta["frames"] = 1
+            meta["duration"] = 0
+        return cube
+
+    def set_gain(self, gain):
+        """ Set the gain register.
+        """
+        if self.write_latency:
+            time.sleep(self.write_latency)
+        self.gain = gain
+        return True
+
+    def set_offset(self, offset):
+        """ Set the offset register.
+        """
+        if self.write_latency:
+            time.sleep(self.write_latency)
+        self.offset = offset
+        return True
+
+    def trigger(self):
+        """ Start a frame at the current gain and offset. The registers
+        can be written again while the frame is read out.
+        """
+        self._triggered = (self.gain, self.offset, time.time())
+        return True
+
+    def read_pipe(self):
+        """ Return the line of the last triggered frame, once the grab
+        latency has passed since the trigger.
+        """
+        gain, offset, triggered = self._triggered
+        if self.grab_latency:
+            remaining = triggered + self.grab_latency - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+        return True, self.grab_gain_row([gain], offset)[0]
+
+    def grab_pipe(self):
+        """ Return a line at the current gain and offset.
+        """
+        self.trigger()
+        return self.read_pipe()
+
+    def setup_pipe(self):
+        return True
+
+    def open_port(self):
+        return True
+
+    def start_scan(self):
+        return True
+
+    def close_pipe(self):
+        return True
+
+
+class ReplayCobra(object):
+    """ Play back a recorded sweep file as a spectrometer. Each grab
+    returns the line recorded at the current gain and offset, so a sweep
+    over the recorded settings reproduces the original data exactly. A
+    bbq file is memory mapped, and only the lines grabbed are read. A
+    csv file is converted to a temporary memory mapped bbq file, which is
+    removed when the pipe is closed. When paced, every grab takes as long
+    as the recorded scan did, divided by the speed.
+    """
+    def __init__(self, filename=None, paced=False, speed=1.0):
+        super(ReplayCobra, self).__init__()
+        if filename is None:
+            raise ValueError("specify a sweep file to replay")
+
+        # Imported here, as the storage formats depend on the model
+        from barbecue import storage
+
+        self.filename = filename
+        self.temp_name = None
+        if storage.is_binary(filename):
+            self.cube = storage.load_binary(filename)
+        else:
+            handle, self.temp_name = tempfile.mkstemp(prefix="replay_",
+                                                      suffix=".bbq")
+            os.close(handle)
+            self.cube = storage.csv_to_cube(filename, self.temp_name)
+
+        self.paced = paced
+        self.speed = speed
+        self.gain = None
+        self.offset = None
+        self.grabs = 0
+
+        measured = numpy.argwhere(self.cube.measured())
+        if not len(measured):
+            raise ValueError("No recorded lines in %s" % filename)
+        self._first = tuple(measured[0])
+        self._last_grab = None
+
+    def position(self):
+        """ Return the cube position of the current gain and offset, or
+        the first recorded line before both are set.
+        """
+        if self.gain is None or self.offset is None:
+            return self._first
+
+        try:
+            position = (self.cube.offset_position(self.offset),
+                        self.cube.gain_position(self.gain))
+        except KeyError:
+            position = None
+
+        if position is None or self.cube.meta["gain"][position] < 0:
+            raise ValueError("No recorded line at gain %s, offset %s" %
+                             (self.gain, self.offset))
+        return position
+
+    def set_gain(self, gain):
+        """ Select the recorded gain.
+        """
+        self.gain = int(gain)
+        return True
+
+    def set_offset(self, offset):
+        """ Select the recorded offset.
+        """
+        self.offset = int(offset)
+        return True
+
+    def grab_pipe(self):
+        """ Return the line recorded at the current gain and offset.
+        """
+        position = self.position()
+        if self.paced:
+            self.pace(self.cube.meta[position])
+        self.grabs += 1
+        return True, numpy.array(self.cube.data[position])
+
+    def pace(self, cell):
+        """ Wait until the recorded time per frame of the cell has passed
+        since the previous grab.
+        """
+        duration = float(cell["duration"])
+        frames = max(int(cell["frames"]), 1)
+        if duration <= 0:
+            return
+
+        interval = duration / frames / self.speed
+        now = time.time()
+        if self._last_grab is not None:
+            remaining = self._last_grab + interval - now
+            if remaining > 0:
+                time.sleep(remaining)
+        self._last_grab = time.time()
+
+    def setup_pipe(self):
+        return True
+
+    def open_port(self):
+        return True
+
+    def start_scan(self):
+        return True
+
+    def close_pipe(self):
+        """ Release the recorded sweep, and remove the temporary file of a
+        converted csv sweep.
+        """
+        if self.temp_name is not None:
+            self.cube = None
+            os.remove(self.temp_name)
+            self.temp_name = None
+        return True
@@ -1,9 +1,12 @@
 """ Gain/Offset walkthrough with live visualization.
 """
 
-import csv
+import os
 import numpy
+import bisect
 import logging
+import threading
+import collections
 
 from PyQt4 import QtGui, QtCore
 
@@ -11,9 +14,17 @@ from guiqwt import plot
 from guiqwt import builder
 
 from barbecue import model
+from barbecue import sweep
+from barbecue import storage
+from barbecue import devices
+from barbecue import pipeline
+from barbecue import progress
 
 log = logging.getLogger(__name__)
 
+# The save and load formats are selected by the file extension
+SWEEP_FILTER = "Sweep files (*.csv *.bbq *.npz);;All files (*)"
+
 class GainOffset(QtGui.QMainWindow):
     """ The main interface for the GainOffset application. Can be created
     from unittest or a main() for full test coverage.
@@ -29,7 +40,6 @@ class GainOffset(QtGui.QMainWindow):
 
         self.replace_widgets()
 
-        self.last_model = None
         self.set_app_defaults()
         self.setup_signals()
 
@@ -65,6 +75,10 @@ class GainOffset(QtGui.QMainWindow):
         # Hide the progress bar for better startup looks
         self.ui.progressBar.setVisible(False)
 
+        # Acquisition, save and load count every operation, the interface
+        # is updated at most ten times a second
+        self.progress = progress.ProgressReporter(self.show_progress)
+
         self.ui.spinBoxGainStart.setMinimum(0)
         self.ui.spinBoxGainStart.setMaximum(254)
         self.ui.spinBoxGainStart.setValue(0)
@@ -89,23 +103,20 @@ class GainOffset(QtGui.QMainWindow):
         self.ui.spinBoxIntegrationTime.setMaximum(98)
         self.ui.spinBoxIntegrationTime.setValue(98)
 
-        # Create a datamodel, add it to the widget
-        self.datamod = QtGui.QStandardItemModel()
-
-        self.model_header = QtCore.QStringList()
-        self.model_header.append('Offset')
-        self.model_header.append('Gain')
-        self.datamod.setHorizontalHeaderLabels(self.model_header)
+        # Create a datamodel over the sweep storage, add it to the widget
+        self.datamod = SweepTreeModel()
         self.ui.treeView.setModel(self.datamod)
 
         # Trigger an update of the text
         self.update_summary()
 
-        # Create the timer so the test controller can have access to the
-        # various parts of the gain/offset loop control
-        self.process_timer = QtCore.QTimer()
-        self.process_timer.setSingleShot(True)
-        self.process_timer.timeout.connect(self.loop_process)
+        # The acquisition runs in a worker thread so the interface stays
+        # responsive
+        self.worker = None
+
+        # The device is opened by the first sweep and kept open until
+        # the window closes
+        self.device_session = devices.DeviceSession("single")
 
         # Progress indicators for data saving
         self.save_timer = QtCore.QTimer()
@@ -116,6 +127,16 @@ class GainOffset(QtGui.QMainWindow):
         self.load_timer.setSingleShot(True)
         self.load_timer.timeout.connect(self.loop_load)
 
+        # While a sweep runs, new gain rows of the current offset are
+        # copied into a preallocated image at most live_fps times a
+        # second. Zero disables the live image.
+        self.live_fps = 10
+        self.live_timer = QtCore.QTimer()
+        self.live_timer.timeout.connect(self.update_live_image)
+        self.live_buffer = None
+        self.live_offset = None
+        self.live_pending = []
+
         # When the save file action is activated, it needs to wait for
         # the filename selection dialog to close first. Signal is
         # connected with lambda function to filename below
@@ -126,12 +147,32 @@ class GainOffset(QtGui.QMainWindow):
         self.load_wait_timer.setSingleShot(True)
 
         # Load / save / process parameters
-        self.load_position = 0
         self.orig_gain_start = 0
 
         self.linetime = self.ui.spinBoxLineTime.value()
         self.integration = self.ui.spinBoxIntegrationTime.value()
 
+        # When set, each acquisition is memory mapped to a new sweep file
+        # in this directory instead of being held in memory
+        self.sweep_directory = None
+
+        # Name of the sweep strategy that chooses the combinations to
+        # scan, see barbecue.sweep
+        self.sweep_strategy = "raster"
+
+        # Number of lines averaged for every gain/offset combination
+        self.frames = 1
+
+        # Seconds to wait after a large register change
+        self.settle_delay = 0.0
+
+        # Overlap device access with storage, see barbecue.pipeline
+        self.pipelined = False
+
+        # Skip the rest of a gain row after this many saturated lines,
+        # zero to scan every gain
+        self.saturation_stop = 0
+
     def setup_signals(self):
         """ Configure widget signals.
         """
@@ -164,46 +205,36 @@ class GainOffset(QtGui.QMainWindow):
         # Tree list widget updates image on click
         self.ui.treeView.clicked.connect(self.update_image)
 
+        # Show the selected image with or without dark correction
+        cbdp = self.ui.checkBoxDarkPixelAveragin
+        cbdp.stateChanged.connect(self.update_image)
+
     def update_image(self):
         """ Based on the tree view selected datamodel item, build an
         image in the dialog.
         """
         idx = self.ui.treeView.selectedIndexes()
-        item = self.datamod.item(idx[0].row(), idx[0].column())
-        self.results_to_image(item)
+        if not idx:
+            return
+        self.results_to_image(idx[0].row())
 
-    def results_to_image(self, item):
-        """ given an item from the datamodel that has results of gain
-        0-255, construct a numpy array and assign that to the image.
+    def results_to_image(self, row):
+        """ given a row of the datamodel, show the stored (gain, pixel)
+        block of its offset group. The block is passed to the image as a
+        view in its native dtype, with no copy unless dark correction is
+        enabled.
         """
-        src_data = []
-        for gain_row in item.results:
-            src_data.append(gain_row.data)
-
-        #log.info("How many rows: %s" % len(src_data))
-        img_data = range(len(src_data))
-
-        position = 0
-        while position < len(img_data):
-            img_data[position] = src_data[position]
-            position += 1
-
-        new_data = numpy.array(img_data).astype(float)
-
-        local_plot = self.ui.image_dialog.get_plot()
-
-        # Apparently get_default_item is not supported by the python xy
-        # implementation of guiqwt.
-        #plot.get_default_item().set_data(new_data)
-        first = local_plot.get_items()[1]
-        first.set_data(new_data)
-
-        local_plot.replot()
+        group = self.datamod.group(row)
+        if self.ui.checkBoxDarkPixelAveragin.isChecked():
+            self.show_image(group.corrected())
+        else:
+            self.show_image(group.data)
 
     def open_process(self):
         """ Get a filename to load.
         """
-        file_name = self.file_dialog.getOpenFileName()
+        file_name = self.file_dialog.getOpenFileName(self, "Open", "",
+                                                     SWEEP_FILTER)
 
         # Trigger the timer after the dialog has had a chance to close
         self.load_wait_timer.timeout.connect(lambda: self.load_file(file_name))
@@ -211,104 +242,61 @@ class GainOffset(QtGui.QMainWindow):
 
     def load_file(self, file_name):
         """ Set the progress bar indicators and convert a csv file to
-        datamodel.
+        datamodel. Progress is measured in bytes of the file indexed, so
+        the file is only read once.
         """
-        total = self.get_line_total(file_name)
+        if storage.is_binary(file_name):
+            self.load_binary_file(file_name)
+            return
 
-        msg = "Loading %s combinations from %s" % (total, file_name)
+        self.csv_index = storage.CSVIndex(file_name)
+        self.csv_sweep = self.datamod.add_sweep(self.csv_index)
+
+        msg = "Loading %s" % file_name
         self.ui.labelProcessing.setText(msg)
 
-        self.ui.progressBar.total = total
         self.ui.progressBar.setValue(0)
-        self.op_count = 0
-
-        csv_header = ["Offset", "Gain", "Line Time", "Integration Time"]
-        self.csv_file = csv.DictReader(open(file_name, 'rb'),
-                                       csv_header, 'Data')
-
-        # Read past the header:
-        self.csv_file.next()
-
-        self.last_model = None
+        self.progress.start(self.csv_index.size, msg, "bytes")
+        self.progress.add(self.csv_index.position)
         self.loop_load()
 
-    def loop_load(self):
-        """ Iterate through the file data to be loaded inside a timer,
-        update the interface progress.
+    def load_binary_file(self, file_name):
+        """ Add every offset group of a binary sweep file to the
+        datamodel. The pixel data is not parsed.
         """
+        cube = storage.load_binary(file_name)
 
-        line_fail = 0
-        try:
-            line = self.csv_file.next()
-            #log.info("File header: %s" % line['Offset'])
-        except StopIteration:
-            line_fail = 1
-            log.warn("Problem reading file")
-
-        self.load_position += 1
-        self.update_progress_bar()
-
-        if line_fail:
-            log.info("Load complete, add final")
-            last_entry = self.last_model.results[0]
-            offs_it = QtGui.QStandardItem(str(last_entry.offset))
-            offs_it.results = self.last_model.results
-            gain_it = QtGui.QStandardItem("Gain 0-255")
-            self.datamod.appendRow([offs_it, gain_it])
-            return
-
-        new_data = []
-        for item in line["Data"][0:2047]:
-            new_data.append(float(item))
+        self.progress.start(cube.meta.size, "Loaded %s" % file_name,
+                            "combinations")
+        sweep_number = self.datamod.add_sweep(cube)
+        self.datamod.add_rows(sweep_number, range(len(cube.offsets)))
 
-        new_result = model.Result(line["Gain"], line["Offset"],
-                                  line["Line Time"],
-                                  line["Integration Time"],
-                                  new_data
-                                 )
+        self.progress.add(cube.meta.size)
+        self.progress.finish()
 
-        # If it's the very first pass, just assign it
-        if self.last_model == None:
-            self.last_model = model.Model()
-
-
-        # compare current line offset to last offset, if different, add last
-        # item, start a new item
-        new_offset = new_result.offset
-        if len(self.last_model.results) == 0:
-            old_offset = new_offset
+    def loop_load(self):
+        """ Index the next chunk of the file to be loaded inside a timer,
+        add any completed offset groups and update the interface
+        progress. The pixel data of a group is only parsed when it is
+        displayed or saved.
+        """
+        position = self.csv_index.position
+        groups = self.csv_index.scan_chunk()
+        self.progress.add(self.csv_index.position - position)
+        self.datamod.add_rows(self.csv_sweep,
+                              [group.position for group in groups])
+
+        if self.csv_index.done:
+            log.info("Load complete")
+            self.progress.finish()
         else:
-            old_offset = self.last_model.results[0].offset
-
-        if new_offset != old_offset:
-            log.info("Offset change, add to model")
-            offs_it = QtGui.QStandardItem(str(old_offset))
-            offs_it.results = self.last_model.results
-            gain_it = QtGui.QStandardItem("Gain 0-255")
-            self.datamod.appendRow([offs_it, gain_it])
-
-            self.last_model = model.Model()
-
-        self.last_model.results.append(new_result)
-
-        if self.load_position < self.ui.progressBar.total:
             self.load_timer.start(0)
 
-    def get_line_total(self, file_name):
-        """ Make a pass through the file, read the total number of
-        lines.
-        """
-        lfile = open(file_name)
-        lcount = 0
-        for _ in lfile.readlines():
-            lcount += 1
-        lfile.close()
-        return lcount
-
     def save_process(self):
         """ Select a filename to save the current results.
         """
-        file_name = self.file_dialog.getSaveFileName()
+        file_name = self.file_dialog.getSaveFileName(self, "Save", "",
+                                                     SWEEP_FILTER)
         # Trigger the timer after the dialog has had a chance to close
         self.save_wait_timer.timeout.connect(lambda: self.save_file(file_name))
         self.save_wait_timer.start(300)
@@ -317,14 +305,29 @@ class GainOffset(QtGui.QMainWindow):
         """ Write the current contents of the datamodel displayed in the
         tree widget to disk.
         """
-        total = self.datamod.rowCount() * 255
+        total = 0
+        for row in range(self.datamod.rowCount()):
+            total += len(self.datamod.group_ref(row))
 
         msg = "Saving %s combinations to %s" % (total, file_name)
         self.ui.labelProcessing.setText(msg)
 
-        self.ui.progressBar.total = total
         self.ui.progressBar.setValue(0)
-        self.op_count = 0
+        self.progress.start(total, "Saving %s" % file_name, "combinations")
+
+        if storage.is_binary(file_name):
+            # A loaded bbq file stays memory mapped by the tree, so it
+            # can not be saved over
+            try:
+                storage.save_binary(file_name, self.all_groups())
+            except ValueError as exc:
+                log.warning("Save failed: %s", exc)
+                self.ui.labelProcessing.setText(str(exc))
+                return
+            self.progress.add(total)
+            self.progress.finish()
+            return
+
         self.csv_file = open(file_name, "wb")
 
         self.write_header(self.csv_file)
@@ -332,38 +335,40 @@ class GainOffset(QtGui.QMainWindow):
         self.save_position = 0
         self.loop_save()
 
+    def all_groups(self):
+        """ Return the offset group of every row in the datamodel.
+        """
+        return [self.datamod.group_ref(row).load()
+                for row in range(self.datamod.rowCount())]
+
     def loop_save(self):
         """ Iterate through the data to be saved in a timer to enable
         load inhibits and progress bar updates.
         """
 
-        item = self.datamod.item(self.save_position, 0)
-        log.info("Write item: %s", item)
+        group_ref = self.datamod.group_ref(self.save_position)
+        log.info("Write offset: %s", group_ref.offset)
 
-        self.write_results(self.csv_file, item)
+        self.write_results(self.csv_file, group_ref)
+        self.csv_file.flush()
         self.save_position += 1
 
         if self.save_position < self.datamod.rowCount():
             self.save_timer.start(0)
+        else:
+            self.csv_file.close()
+            self.progress.finish()
 
-    def write_results(self, csv_file, item):
-        """ Print the contents of the datamodel item to disk.
+    def write_results(self, csv_file, group_ref):
+        """ Print the contents of the offset group to disk.
         """
-        for result in item.results:
-            csv_file.write("%s," % result.offset)
-            csv_file.write("%s," % result.gain)
-            csv_file.write("%s," % result.linetime)
-            csv_file.write("%s," % result.integration)
-            for pixel in result.data:
-                csv_file.write("%s," % pixel)
-            csv_file.write("\n")
-            self.update_progress_bar()
+        rows = storage.write_group(csv_file, group_ref.load())
+        self.progress.add(rows)
 
     def write_header(self, csv_file):
         """ write the csv file format header to the passed in file.
         """
-        head_str = "Offset,Gain,Line Time,Integration Time,Data\n"
-        csv_file.write(head_str)
+        storage.write_header(csv_file)
 
     def update_summary(self):
         """ Create a summary text showing how many iterations will be
@@ -379,10 +384,6 @@ class GainOffset(QtGui.QMainWindow):
         total = offset_range * gain_range
         msg = "System will process %s combinations." % total
         self.ui.labelProcessing.setText(msg)
-
-        # Store the current total combinations for use by the progress
-        # bar update function
-        self.ui.progressBar.total = total
         self.ui.progressBar.setValue(0)
 
     def setup_process(self):
@@ -397,73 +398,210 @@ class GainOffset(QtGui.QMainWindow):
 
         self.orig_offset_start = self.ui.spinBoxOffsetStart.value()
         self.orig_offset_end = self.ui.spinBoxOffsetEnd.value()
-        self.offset = self.orig_offset_start
 
         self.linetime = self.ui.spinBoxLineTime.value()
         self.integration = self.ui.spinBoxIntegrationTime.value()
 
-        self.op_count = 0
+        offsets = range(self.orig_offset_start, self.orig_offset_end + 1)
+        gains = range(self.orig_gain_start, self.orig_gain_end + 1)
+        self.progress.start(len(offsets) * len(gains), "Scanning", "scans")
+
+        self.stop_worker()
 
         self.acquire_model = model.Model()
-        self.acquire_model.assign("single")
-        self.process_timer.start(0)
+        self.acquire_model.frames = self.frames
+        self.acquire_model.settle_delay = self.settle_delay
+        cbdp = self.ui.checkBoxDarkPixelAveragin
+        self.acquire_model.dark_correction = cbdp.isChecked()
+        self.acquire_model.allocate(offsets, gains,
+                                    filename=self.next_sweep_filename())
+
+        # Offset groups are listed in the order they complete
+        self.acquire_sweep = self.datamod.add_sweep(self.acquire_model.cube,
+                                                    ordered=False)
+
+        strategy = sweep.create(self.sweep_strategy, offsets, gains)
+
+        policy = None
+        if self.saturation_stop:
+            policy = sweep.SaturationStop(self.saturation_stop)
+
+        self.worker = AcquisitionWorker(self.acquire_model,
+                                        self.device_session, strategy,
+                                        self.linetime, self.integration,
+                                        self.pipelined, policy)
+        self.worker.scan_complete.connect(self.scan_complete)
+        self.worker.offset_complete.connect(self.offset_complete)
+        self.worker.acquisition_error.connect(self.acquisition_error)
+        self.worker.finished.connect(self.acquisition_finished)
+        self.start_live_image(gains, self.acquire_model.cube.pixels)
+        self.worker.start()
+
+    def next_sweep_filename(self):
+        """ Return an unused file name in the sweep directory, or None if
+        acquisitions are to be held in memory.
+        """
+        if self.sweep_directory is None:
+            return None
+
+        count = 0
+        while True:
+            file_name = os.path.join(self.sweep_directory,
+                                     "sweep_%04d.bbq" % count)
+            if not os.path.exists(file_name):
+                return file_name
+            count += 1
+
+    def scan_complete(self, offset, gain):
+        """ Update the progress for every scan made by the current
+        worker, and queue the scan for the live image.
+        """
+        if self.sender() is self.worker:
+            self.progress.add()
+            self.live_pending.append((offset, gain))
 
-    def loop_process(self):
-        """ Once the timer has been activated, loop through the test
-        iteration structure until all offset/gain options have been
-        processed.
+    def start_live_image(self, gains, pixels):
+        """ Preallocate the live image for the gain range and start the
+        replot timer.
         """
+        self.live_timer.stop()
+        self.live_pending = []
+        self.live_offset = None
+        if not self.live_fps:
+            return
 
-        gain = self.orig_gain_start
-        while gain <= self.orig_gain_end:
-            #log.debug("Gain: %s" % gain)
-            result = self.acquire_model.scan(gain, self.offset,
-                                             self.linetime,
-                                             self.integration
-                                            )
-            if not result:
-                log.critical("Problem scan %s, %s", gain, self.offset)
+        self.live_buffer = numpy.zeros((len(gains), pixels))
+        self.live_timer.start(int(1000 / self.live_fps))
 
-            self.update_progress_bar()
-            gain += 1
+    def update_live_image(self):
+        """ Copy the gain rows scanned since the last update into the
+        live image and replot. Only the most recently scanned offset is
+        shown, and the image is cleared when the offset changes.
+        """
+        if not self.live_pending:
+            return
 
-        offs_it = QtGui.QStandardItem(str(self.offset))
-        offs_it.results = self.acquire_model.results
+        pending = self.live_pending
+        self.live_pending = []
 
-        # Reset the results list for next pass
-        self.acquire_model.results = []
+        offset = pending[-1][0]
+        if offset != self.live_offset:
+            self.live_buffer[:] = 0
+            self.live_offset = offset
 
-        #log.info("Store results: %s" % len(offs_it.results))
-        gain_it = QtGui.QStandardItem("Gain 0-255")
+        cube = self.acquire_model.cube
+        off_pos = cube.offset_position(offset)
+        rows = [cube.gain_position(gain) for scan_offset, gain in pending
+                if scan_offset == offset]
 
-        self.datamod.appendRow([offs_it, gain_it])
+        if self.ui.checkBoxDarkPixelAveragin.isChecked():
+            self.live_buffer[rows] = model.subtract_dark(
+                cube.data[off_pos, rows], cube.meta[off_pos, rows])
+        else:
+            self.live_buffer[rows] = cube.data[off_pos, rows]
 
-        self.offset += 1
+        self.show_image(self.live_buffer)
 
-        if self.offset <= self.orig_offset_end:
-            if not self.process_timer.isActive():
-                #log.info("Start timer: %s" % self.offset)
-                self.process_timer.start(10)
+    def show_image(self, image):
+        """ Display the (gain, pixel) array in the image dialog.
+        """
+        local_plot = self.ui.image_dialog.get_plot()
 
-        else:
-            log.info("end offset loop")
+        # Apparently get_default_item is not supported by the python xy
+        # implementation of guiqwt.
+        #plot.get_default_item().set_data(new_data)
+        first = local_plot.get_items()[1]
+        first.set_data(image)
+
+        local_plot.replot()
+
+    def offset_complete(self, offset):
+        """ Add the completed offset group of the current worker to the
+        datamodel. The row is read from the preallocated sweep cube, no
+        data is copied.
+        """
+        if self.sender() is self.worker:
+            cube = self.acquire_model.cube
+            self.datamod.add_rows(self.acquire_sweep,
+                                  [cube.offset_position(offset)])
+
+    def acquisition_finished(self):
+        """ Strategies that skip combinations finish before the progress
+        total is reached, so show completion of the current worker. A
+        failed sweep keeps its error message on display.
+        """
+        if self.sender() is self.worker:
+            if self.worker.error_message is None:
+                self.progress.finish()
+            self.live_timer.stop()
+            self.update_live_image()
+
+            # Per-cell timing shows what the sweep order and settle
+            # delay cost
+            cube = self.acquire_model.cube
+            durations = cube.meta["duration"][cube.measured()]
+            if len(durations):
+                log.info("Sweep time %.1fs, mean scan %.4fs",
+                         durations.sum(), durations.mean())
+
+    def acquisition_error(self, message):
+        """ Show why the sweep of the current worker failed.
+        """
+        if self.sender() is self.worker:
+            self.ui.labelProcessing.setText("Acquisition failed: %s" %
+                                            message)
 
     def stop_process(self):
         """ set the global variable to inhibit a running process, reset
         gui items.
         """
-        self.process_timer.stop()
+        if self.worker is not None:
+            self.stop_worker()
+            self.progress.report()
         self.save_timer.stop()
+        self.live_timer.stop()
 
-    def update_progress_bar(self):
-        """ Given a op_count value, assign the progress bar to the
-        percentage of total operations.
+    def stop_worker(self):
+        """ Cancel the running acquisition, if any, and wait for it to
+        finish the current scan. Signals already queued by the worker
+        are ignored, and the offsets it measured are listed directly.
         """
-        self.op_count += 1
-        self.op_count = self.op_count * 1.0
-        tot = self.ui.progressBar.total * 1.0
-        perc = (self.op_count / tot) * 100.0
-        self.ui.progressBar.setValue(perc)
+        if self.worker is None:
+            return
+
+        self.worker.stop()
+        self.worker.wait()
+        self.worker = None
+        self.list_measured_offsets()
+
+    def list_measured_offsets(self):
+        """ Add every offset group of the acquisition with measured cells
+        that is not yet in the datamodel. Strategies that are not offset
+        major only report at the end, so this keeps the scans taken
+        before a stop viewable and saveable.
+        """
+        cube = self.acquire_model.cube
+        listed = set(self.datamod.listed(self.acquire_sweep))
+        measured = numpy.flatnonzero(cube.measured().any(axis=1))
+        self.datamod.add_rows(self.acquire_sweep,
+                              [int(position) for position in measured
+                               if position not in listed])
+
+    def closeEvent(self, event):
+        """ Make sure the acquisition thread is finished and the device
+        is closed before the window goes away.
+        """
+        self.stop_worker()
+        self.live_timer.stop()
+        self.device_session.close()
+        event.accept()
+
+    def show_progress(self, reporter):
+        """ Show the percentage of total operations, throughput and time
+        remaining reported by the progress reporter.
+        """
+        self.ui.progressBar.setValue(int(reporter.percent))
+        self.ui.labelProcessing.setText(reporter.describe())
 
     def move_linetime(self):
         """ Change the integration time range to make sure the user
@@ -487,6 +625,247 @@ class GainOffset(QtGui.QMainWindow):
         self.ui.spinBoxOffsetEnd.setMinimum(os_value + 1)
 
 
+class SweepTreeModel(QtCore.QAbstractItemModel):
+    """ Item model of the offset groups of every acquired or loaded
+    sweep, read directly from the sweep storage. A sweep is held as its
+    SweepCube, or as the CSVIndex of a csv file, and each row is
+    generated on demand from its group position. No items or results are
+    kept per row.
+
+    The mean, maximum and saturated fraction columns are computed when
+    displayed, and the most recent are cached. Groups of a csv file are
+    only parsed when loaded, so their columns are blank until then.
+    """
+    headers = ["Offset", "Gain", "Mean", "Max", "Saturated"]
+
+    def __init__(self, full_scale=4095, cache_rows=256):
+        super(SweepTreeModel, self).__init__()
+        self.full_scale = full_scale
+        self.cache_rows = cache_rows
+
+        # Storage and listed group positions of each sweep, and the first
+        # row of each sweep followed by the total rows
+        self.sweeps = []
+        self.starts = [0]
+        self._summaries = collections.OrderedDict()
+
+    def add_sweep(self, source, ordered=True):
+        """ Add a sweep with no rows and return its number. The rows of an
+        ordered sweep are the groups of the storage in order, otherwise
+        the group position of each row is listed.
+        """
+        positions = None
+        if not ordered:
+            positions = []
+        self.sweeps.append((source, positions))
+        self.starts.append(self.starts[-1])
+        return len(self.sweeps) - 1
+
+    def add_rows(self, sweep_number, positions):
+        """ Append rows for the group positions of the sweep. The rows of
+        an ordered sweep continue from its last row.
+        """
+        count = len(positions)
+        if not count:
+            return
+
+        row = self.starts[sweep_number + 1]
+        self.beginInsertRows(QtCore.QModelIndex(), row, row + count - 1)
+        listed = self.sweeps[sweep_number][1]
+        if listed is not None:
+            listed.extend(positions)
+        for later in range(sweep_number + 1, len(self.starts)):
+            self.starts[later] += count
+        self.endInsertRows()
+
+    def listed(self, sweep_number):
+        """ Return the group positions of the rows of the sweep.
+        """
+        source, positions = self.sweeps[sweep_number]
+        if positions is None:
+            return range(self.starts[sweep_number + 1] -
+                         self.starts[sweep_number])
+        return positions
+
+    def locate(self, row):
+        """ Return the sweep number, storage and group position of the
+        row.
+        """
+        sweep_number = bisect.bisect_right(self.starts, row) - 1
+        source, positions = self.sweeps[sweep_number]
+        position = row - self.starts[sweep_number]
+        if positions is not None:
+            position = positions[position]
+        return sweep_number, source, position
+
+    def group_ref(self, row):
+        """ Return a reference to the offset group of the row, with the
+        length and load interface of a sweep group. No data is read.
+        """
+        sweep_number, source, position = self.locate(row)
+        if isinstance(source, storage.CSVIndex):
+            return storage.CSVGroupRef(source, position)
+        return model.SweepGroup(source, position)
+
+    def group(self, row):
+        """ Load the offset group of the row, and cache its summary.
+        """
+        sweep_number, source, position = self.locate(row)
+        group = self.group_ref(row).load()
+        self.cache_summary((sweep_number, position), group)
+        return group
+
+    def summary(self, row):
+        """ Return the mean, maximum and saturated fraction of the row, or
+        None for a csv group that has not been loaded.
+        """
+        sweep_number, source, position = self.locate(row)
+        key = (sweep_number, position)
+        if key in self._summaries:
+            return self._summaries[key]
+
+        if isinstance(source, storage.CSVIndex):
+            return None
+        return self.cache_summary(key, model.SweepGroup(source, position))
+
+    def cache_summary(self, key, group):
+        """ Compute and cache the summary of the group, dropping the
+        oldest once the cache is full.
+        """
+        summary = group.summary(self.full_scale)
+        self._summaries.pop(key, None)
+        self._summaries[key] = summary
+        while len(self._summaries) > self.cache_rows:
+            self._summaries.popitem(last=False)
+        return summary
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        if parent.isValid() or not 0 <= row < self.starts[-1] or \
+           not 0 <= column < len(self.headers):
+            return QtCore.QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index):
+        return QtCore.QModelIndex()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.starts[-1]
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(self.headers)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and \
+           role == QtCore.Qt.DisplayRole:
+            return self.headers[section]
+        return None
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role != QtCore.Qt.DisplayRole:
+            return None
+
+        column = index.column()
+        if column < 2:
+            group_ref = self.group_ref(index.row())
+            if column == 0:
+                return str(group_ref.offset)
+            return "%s gains" % len(group_ref)
+
+        summary = self.summary(index.row())
+        if summary is None:
+            return ""
+
+        mean, maximum, saturated = summary
+        if column == 2:
+            return "%.1f" % mean
+        if column == 3:
+            return "%d" % maximum
+        return "%.1f%%" % (saturated * 100.0)
+
+
+class AcquisitionWorker(QtCore.QThread):
+    """ Run the gain/offset sweep of a model in a separate thread. The
+    worker attaches the model to the shared device session and owns the
+    model while it runs, reports every scan and completed offset group
+    through signals, and can be cancelled between individual scans.
+    """
+    scan_complete = QtCore.pyqtSignal(int, int)
+    offset_complete = QtCore.pyqtSignal(int)
+    acquisition_error = QtCore.pyqtSignal(str)
+
+    def __init__(self, acquire_model, session, strategy, linetime,
+                 integration, pipelined=False, policy=None):
+        super(AcquisitionWorker, self).__init__()
+        self.model = acquire_model
+        self.scanner = acquire_model
+        if pipelined:
+            self.scanner = pipeline.PipelinedScanner(acquire_model)
+        self.session = session
+        self.policy = policy
+        self.strategy = strategy
+        self.linetime = linetime
+        self.integration = integration
+        self.error_message = None
+        self._stop = threading.Event()
+
+    def stop(self):
+        """ Request the sweep to end after the current scan.
+        """
+        self._stop.set()
+
+    def run(self):
+        """ Scan every block of combinations chosen by the sweep
+        strategy. Offset groups are reported as soon as they are
+        complete, or at the end of the sweep for strategies that visit
+        an offset more than once. Offsets measured before a cancel or a
+        device error are reported too, and the error is signalled.
+        """
+        cube = self.model.cube
+        reported = set()
+
+        def block_complete(offsets, gains):
+            if self.strategy.offset_major:
+                self.report_offsets(cube, offsets, reported)
+
+        try:
+            self.model.attach(self.session)
+            self.scanner.scan_sweep(self.strategy, self.linetime,
+                                    self.integration,
+                                    callback=self.emit_scan,
+                                    cancel=self._stop, policy=self.policy,
+                                    block_complete=block_complete)
+            log.info("end offset loop")
+        except Exception as exc:
+            log.exception("Acquisition failed")
+            self.error_message = str(exc)
+            self.acquisition_error.emit(self.error_message)
+        finally:
+            self.report_offsets(cube, cube.offsets, reported)
+            if self.model.session is not None:
+                self.model.close_model()
+
+    def emit_scan(self, offset, gain):
+        """ Signal the completion of a single scan.
+        """
+        self.scan_complete.emit(int(offset), int(gain))
+
+    def report_offsets(self, cube, offsets, reported):
+        """ Flush the cube to disk and signal every offset with measured
+        cells that has not yet been reported.
+        """
+        cube.flush()
+        measured = cube.measured().any(axis=1)
+        for offset in offsets:
+            offset = int(offset)
+            if offset in reported:
+                continue
+            if measured[cube.offset_position(offset)]:
+                reported.add(offset)
+                self.offset_complete.emit(offset)
+
+
 class NoButtonImageDialog(plot.ImageDialog):
     """ An guiqwt imagedialog with the ok/cancel buttons hidden.
     """
@@ -1,10 +1,14 @@
 """ Datamodel classes for the barbecue.
 """
 
+import time
+import json
+import struct
 import logging
 
-from wasatchcameralink import DALSA
-from wasatchcameralink import simulation
+import numpy
+
+from barbecue import devices
 
 log = logging.getLogger(__name__)
 
@@ -17,45 +21,82 @@ class Model(object):
         #log.info("created")
         self.results = []
         self.device = None
+        self.cube = None
+
+        # Issue every n'th redundant register write to refresh the
+        # device, zero to never repeat a write
+        self.verify_interval = 0
+
+        # Seconds to wait after a register moves by more than the settle
+        # threshold
+        self.settle_delay = 0.0
+        self.settle_threshold = 16
+
+        # Number of lines grabbed and averaged for every scan
+        self.frames = 1
+        self._frame_buffer = None
+        self.sensor_dtype = numpy.uint16
+
+        # Estimate the dark level of every line from the average of the
+        # optically masked pixels
+        self.dark_correction = False
+        self.dark_pixels = slice(0, 16)
+
+        # Keyword arguments for the device driver, such as the file
+        # played back by the replay device
+        self.device_options = {}
+        self.session = None
+        self._owns_session = False
+
+    def allocate(self, offsets, gains, pixels=2048, dtype=None,
+                 filename=None):
+        """ Preallocate a sweep cube covering the offset and gain ranges.
+        Subsequent scans are written directly into the cube instead of
+        being appended to the results list. If a filename is given, the
+        cube is memory mapped to that file. When averaging frames the
+        cube holds the per-pixel statistics too, and defaults to float
+        data for the mean.
+        """
+        statistics = self.frames > 1
+        if dtype is None:
+            dtype = numpy.float32 if statistics else self.sensor_dtype
+
+        self.cube = SweepCube(offsets, gains, pixels, dtype, filename,
+                              statistics, self.sensor_dtype)
+        return self.cube
 
     def assign(self, device_type):
-        """ Designate and setup the specified device type
+        """ Designate and setup the specified device type, created from
+        the device registry with the keyword arguments in device_options.
+        The model owns the device, which is closed with the model.
         """
         if device_type == None:
-            raise(ValueError, "specify a device type")
-
-        if device_type != "simulation" and \
-           device_type != "cobra" and \
-           device_type != "single":
-            raise(ValueError, "specify a valid device type")
-        
-        self.device = device_type
-
-        if self.device == "single":
-            self._dev = simulation.SimulatedCobraSLED()
-
-        elif self.device == "cobra":
-            self._dev = DALSA.Cobra()
-
-        # Yes, this order is correct. You have to setup, then grab from
-        # the pipe, then open the port and then start the scan. You
-        # might think this would cause a timeout in the sap net grab.
-        # Apparently it does not. However, if you setup the pipe and/or
-        # open the serial port first, everything will look fine. Until
-        # you go to write to the serial port after a grab operation.
-        # Then the write command will succeed, but reading back the
-        # response will always result in '', and no changes appear to be
-        # written to the device.
-        result = self._dev.setup_pipe()
-        result, data = self._dev.grab_pipe()
-        forc_res = self._dev.open_port()
-        forc_res = self._dev.start_scan()
-        
+            raise ValueError("specify a device type")
+
+        session = devices.DeviceSession(device_type, **self.device_options)
+        self.attach(session)
+        self._owns_session = True
+        return True
+
+    def attach(self, session):
+        """ Use the device of a shared session, which stays open when
+        the model is closed. The session checks the device and reopens
+        it if required.
+        """
+        self._dev = session.acquire()
+        self._dev.verify_interval = self.verify_interval
+        self._dev.settle_delay = self.settle_delay
+        self._dev.settle_threshold = self.settle_threshold
+
+        self.session = session
+        self.device = session.device_type
+        self._owns_session = False
         return True
 
     def scan(self, gain, offset, linetime, integration):
         """ Connect to a device, apply the settings, collect one line of
-        data, store the results and exit.
+        data, store the results and exit. The time taken by the scan,
+        including any settle delay, is stored with the results.
         """
         if self.device == None:
             raise(ValueError, "Must assign device first")
@@ -63,27 +104,683 @@ class Model(object):
         if gain == None or offset == None:
             raise(ValueError, "must specify gain, offset")
 
-        result = self._dev.set_gain(gain)
-        result = self._dev.set_offset(offset)
-        result, data = self._dev.grab_pipe()
+        data, stats, duration = self.acquire(gain, offset)
+
+        if self.cube is not None:
+            self.cube.store(gain, offset, linetime, integration, data,
+                            duration=duration, **stats)
+            return True
 
-        store_result = Result(gain, offset, linetime, integration, data)
+        store_result = Result(gain, offset, linetime, integration, data,
+                              duration=duration, **stats)
         self.results.append(store_result)
         return True
 
+    def scan_many(self, gains, offsets, linetime, integration, out=None,
+                  callback=None, cancel=None, policy=None):
+        """ Scan every gain at each offset, with the settings validated
+        once for the whole grid. Results are written into the out array
+        of shape (offsets, gains, pixels) if given, otherwise into the
+        allocated cube, otherwise into a new array. Returns the filled
+        storage and a dictionary of timing statistics. Only the cube keeps
+        the settings, dark estimate and frame statistics of each scan, an
+        array holds the pixel data alone.
+
+        callback(offset, gain) is called after every scan, and the scan
+        ends early once cancel.is_set() is true. A stop policy, such as
+        sweep.SaturationStop, ends the gain row of an offset early. The
+        rest of that row is marked as clipped.
+        """
+        if self.device == None:
+            raise ValueError("Must assign device first")
+
+        gains = numpy.asarray(gains, dtype=int)
+        offsets = numpy.asarray(offsets, dtype=int)
+        if gains.size == 0 or offsets.size == 0:
+            raise ValueError("must specify gains, offsets")
+
+        target = out
+        if target is None:
+            target = self.cube
+
+        durations = numpy.zeros((len(offsets), len(gains)))
+        clipped = numpy.zeros(durations.shape, dtype=bool)
+        scans = 0
+        cancelled = False
+        start = time.time()
+
+        for off_pos, offset in enumerate(offsets):
+            if policy is not None:
+                policy.start(gains)
+
+            for gain_pos, gain in enumerate(gains):
+                if cancel is not None and cancel.is_set():
+                    cancelled = True
+                    break
+
+                data, stats, duration = self.acquire(gain, offset)
+                target = self.store_cell(target, (off_pos, gain_pos),
+                                         durations.shape, gain, offset,
+                                         linetime, integration, data, stats,
+                                         duration)
+                durations[off_pos, gain_pos] = duration
+                scans += 1
+                if callback is not None:
+                    callback(offset, gain)
+
+                if policy is not None and policy.stop(data):
+                    clipped[off_pos, gain_pos + 1:] = True
+                    self.mark_clipped(target, offset, gains[gain_pos + 1:])
+                    break
+
+            if cancelled:
+                break
+
+        return target, scan_timing(durations, scans, time.time() - start,
+                                   cancelled, clipped)
+
+    def scan_sweep(self, strategy, linetime, integration, callback=None,
+                   cancel=None, policy=None, block_complete=None):
+        """ Scan every block of the sweep strategy into the allocated
+        cube, see scan_many. block_complete(offsets, gains) is called once
+        each block is stored. Returns the timing statistics of the whole
+        sweep, with the durations and clipped cells of every block
+        flattened in scan order.
+        """
+        durations = [numpy.zeros(0)]
+        clipped = [numpy.zeros(0, dtype=bool)]
+        scans = 0
+        cancelled = False
+        start = time.time()
+
+        for offsets, gains in strategy.blocks(self.cube):
+            _, timing = self.scan_many(gains, offsets, linetime, integration,
+                                       callback=callback, cancel=cancel,
+                                       policy=policy)
+            durations.append(timing["durations"].ravel())
+            clipped.append(timing["clipped"].ravel())
+            scans += timing["scans"]
+            if timing["cancelled"]:
+                cancelled = True
+                break
+            if block_complete is not None:
+                block_complete(offsets, gains)
+
+        return scan_timing(numpy.concatenate(durations), scans,
+                           time.time() - start, cancelled,
+                           numpy.concatenate(clipped))
+
+    def store_cell(self, target, position, shape, gain, offset, linetime,
+                   integration, data, stats, duration):
+        """ Store one scan of a scan_many grid. The cube is addressed by
+        gain and offset, any other target array by the (offset, gain)
+        position in the grid of the given shape. Returns the target, which
+        is allocated by the first scan if it is None, with the same dtype
+        as an allocated cube. An array target stores the pixel data only,
+        the settings and stats are not kept.
+        """
+        if target is None:
+            dtype = self.sensor_dtype
+            if self.frames > 1:
+                dtype = numpy.float32
+            target = numpy.zeros(shape + (len(data),), dtype=dtype)
+
+        if target is self.cube:
+            self.cube.store(gain, offset, linetime, integration, data,
+                            duration=duration, **stats)
+        else:
+            target[position] = data
+        return target
+
+    def mark_clipped(self, target, offset, gains):
+        """ Mark the gains skipped at the offset as clipped, if the
+        target is the cube.
+        """
+        if target is self.cube and len(gains):
+            self.cube.mark_clipped(offset, gains)
+
+    def acquire(self, gain, offset):
+        """ Apply the gain and offset, grab the data. Returns the data,
+        the frame statistics and the time taken. No settings are
+        validated.
+        """
+        start = time.time()
+        self.apply(gain, offset)
+        data, stats = self.grab()
+        stats = self.estimate_dark(data, stats)
+        return data, stats, time.time() - start
+
+    def estimate_dark(self, data, stats):
+        """ Add the dark level of the line to the statistics, when dark
+        correction is enabled. Returns the statistics.
+        """
+        if self.dark_correction:
+            stats["dark"] = float(numpy.mean(data[self.dark_pixels]))
+        return stats
+
+    def apply(self, gain, offset):
+        """ Write the gain and offset to the device.
+        """
+        result = self._dev.set_gain(gain)
+        result = self._dev.set_offset(offset)
+
+    def grab(self):
+        """ Grab one line of data. When averaging, grab every frame into
+        a preallocated buffer and return the per-pixel mean, along with
+        the frame count, standard deviation, minimum and maximum.
+        """
+        if self.frames == 1:
+            result, data = self._dev.grab_pipe()
+            return data, {}
+
+        self._frame_buffer = self.grab_frames(self._frame_buffer)
+        return self.reduce_frames(self._frame_buffer)
+
+    def grab_frames(self, buffer=None, latched=None):
+        """ Grab every frame of a scan into the (frames, pixels) buffer of
+        the sensor dtype, which is allocated if it is missing or the wrong
+        shape. Returns the buffer.
+
+        latched() is called once the device has taken the settings of the
+        last frame, after which the next settings may be written. A device
+        with a trigger takes the settings when the frame is triggered, so
+        the writes can overlap the read out. Any other device holds the
+        settings until the grab returns.
+        """
+        trigger = getattr(self._dev, "trigger", None)
+        for index in range(self.frames):
+            if trigger is None:
+                result, line = self._dev.grab_pipe()
+            else:
+                trigger()
+                if latched is not None and index == self.frames - 1:
+                    latched()
+                result, line = self._dev.read_pipe()
+
+            if buffer is None or buffer.shape != (self.frames, len(line)):
+                buffer = numpy.empty((self.frames, len(line)),
+                                     dtype=self.sensor_dtype)
+            buffer[index] = line
+
+        if latched is not None and trigger is None:
+            latched()
+        return buffer
+
+    def reduce_frames(self, frames):
+        """ Return the per-pixel mean of the grabbed frames, along with
+        the frame count, standard deviation, minimum and maximum.
+        """
+        stats = {"frames": len(frames),
+                 "std": frames.std(axis=0),
+                 "minimum": frames.min(axis=0),
+                 "maximum": frames.max(axis=0),
+                }
+        return frames.mean(axis=0), stats
+
     def close_model(self):
-        """ Helper function to close the pipe.
+        """ Helper function to close the pipe, unless the device belongs
+        to a shared session.
         """
-        return self._dev.close_pipe()
+        log.info("Register writes issued: %s, skipped: %s, settled: %s",
+                 self._dev.issued, self._dev.skipped, self._dev.settles)
+        if self._owns_session:
+            self.session.close()
+        return True
             
+def scan_timing(durations, scans, elapsed, cancelled, clipped=None):
+    """ Return the timing statistics of a scan_many grid, given the
+    (offset, gain) array of scan durations with zero for cells not
+    scanned, and the boolean array of cells skipped as clipped.
+    """
+    if clipped is None:
+        clipped = numpy.zeros(durations.shape, dtype=bool)
+
+    measured = durations[durations > 0]
+    if not len(measured):
+        measured = numpy.zeros(1)
+
+    rate = 0.0
+    if elapsed:
+        rate = scans / elapsed
+    return {"scans": scans,
+            "elapsed": elapsed,
+            "rate": rate,
+            "durations": durations,
+            "min": measured.min(),
+            "max": measured.max(),
+            "mean": measured.mean(),
+            "cancelled": cancelled,
+            "clipped": clipped,
+           }
+
 class Result(object):
-    """ holds stored data and device settings from a given scan.
+    """ holds stored data and device settings from a given scan. Scans
+    averaged over several frames also hold the per-pixel statistics, and
+    dark corrected scans the dark level estimate.
     """
     def __init__(self, gain=-1, offset=-1, linetime=-1, integration=-1,
-                 data=[]):
+                 data=[], frames=1, std=None, minimum=None, maximum=None,
+                 duration=-1, dark=-1):
         super(Result, self).__init__()
         self.gain = gain
         self.offset = offset
         self.linetime = linetime
         self.integration = integration
         self.data = data
+        self.frames = frames
+        self.std = std
+        self.minimum = minimum
+        self.maximum = maximum
+        self.duration = duration
+        self.dark = dark
+
+
+class SweepCube(object):
+    """ Preallocated storage for a gain/offset sweep. Pixel data is held
+    in a single (offset, gain, pixel) array in the native sensor dtype,
+    with a structured array of the per-cell device settings alongside.
+    Unmeasured cells have all metadata fields set to -1.
+
+    With statistics, the standard deviation, minimum and maximum of
+    averaged scans are held in arrays of the same shape as the data. The
+    minimum and maximum are frame values, so they are kept in the sensor
+    dtype, and the deviation in half precision floats.
+
+    When a filename is specified the arrays are memory mapped to a
+    single file, so resident memory stays flat for a full sweep and the
+    data survives a crash. The file starts with a header block that
+    describes the layout, and is reopened with SweepCube.open.
+    """
+    meta_dtype = [("gain", "i2"), ("offset", "i2"),
+                  ("linetime", "i4"), ("integration", "i4"),
+                  ("frames", "i2"), ("duration", "f4"), ("dark", "f4"),
+                  ("status", "i1")]
+
+    def __init__(self, offsets, gains, pixels=2048, dtype=numpy.uint16,
+                 filename=None, statistics=False, sensor_dtype=numpy.uint16):
+        super(SweepCube, self).__init__()
+        self.offsets = numpy.array(offsets, dtype=int)
+        self.gains = numpy.array(gains, dtype=int)
+        self.pixels = pixels
+        self.filename = filename
+
+        stat_dtypes = None
+        if statistics:
+            stat_dtypes = {"std": numpy.float16, "minimum": sensor_dtype,
+                           "maximum": sensor_dtype}
+
+        shape = (len(self.offsets), len(self.gains))
+        if filename is None:
+            self.data = numpy.zeros(shape + (pixels,), dtype=dtype)
+            self.meta = numpy.empty(shape, dtype=self.meta_dtype)
+            for name in STAT_NAMES:
+                array = None
+                if statistics:
+                    array = numpy.zeros(shape + (pixels,),
+                                        dtype=stat_dtypes[name])
+                setattr(self, name, array)
+        else:
+            header = create_sweep_file(filename, self.offsets, self.gains,
+                                       pixels, dtype, self.meta_dtype,
+                                       stat_dtypes)
+            self._map(header, "r+")
+
+        for name in self.meta.dtype.names:
+            self.meta[name] = -1
+
+        self._build_index()
+
+    @classmethod
+    def open(cls, filename, mode="r"):
+        """ Memory map an existing sweep file. Nothing is read from disk
+        beyond the header until the data is accessed.
+        """
+        header = read_sweep_header(filename)
+
+        cube = cls.__new__(cls)
+        cube.offsets = numpy.array(header["offsets"], dtype=int)
+        cube.gains = numpy.array(header["gains"], dtype=int)
+        cube.pixels = header["pixels"]
+        cube.filename = filename
+        cube._map(header, mode)
+        cube._build_index()
+        return cube
+
+    @classmethod
+    def from_arrays(cls, offsets, gains, data, meta, std=None,
+                    minimum=None, maximum=None):
+        """ Create a cube around existing data, metadata and optional
+        statistics arrays without copying them.
+        """
+        cube = cls.__new__(cls)
+        cube.offsets = numpy.array(offsets, dtype=int)
+        cube.gains = numpy.array(gains, dtype=int)
+        cube.pixels = data.shape[-1]
+        cube.filename = None
+        cube.data = data
+        cube.meta = meta
+        cube.std = std
+        cube.minimum = minimum
+        cube.maximum = maximum
+        cube._build_index()
+        return cube
+
+    def _map(self, header, mode):
+        """ Create the memory mapped data and metadata arrays described
+        by the file header.
+        """
+        shape = (len(self.offsets), len(self.gains))
+        # Header strings are unicode after the json round trip
+        meta_dtype = numpy.dtype([tuple(str(part) for part in field)
+                                  for field in header["meta_dtype"]])
+
+        self.meta = numpy.memmap(self.filename, dtype=meta_dtype,
+                                 mode=mode, offset=header["meta_offset"],
+                                 shape=shape)
+        self.data = numpy.memmap(self.filename, dtype=str(header["dtype"]),
+                                 mode=mode, offset=header["data_offset"],
+                                 shape=shape + (self.pixels,))
+
+        stats = header.get("stats", {})
+        for name in STAT_NAMES:
+            array = None
+            if name in stats:
+                offset, dtype = stats[name]
+                array = numpy.memmap(self.filename, dtype=str(dtype),
+                                     mode=mode, offset=offset,
+                                     shape=shape + (self.pixels,))
+            setattr(self, name, array)
+
+    @property
+    def statistics(self):
+        """ True if the cube holds frame statistics.
+        """
+        return self.std is not None
+
+    def flush(self):
+        """ Write any pending changes of a memory mapped cube to disk.
+        """
+        if self.filename is not None:
+            self.meta.flush()
+            self.data.flush()
+            for name in STAT_NAMES:
+                if getattr(self, name) is not None:
+                    getattr(self, name).flush()
+
+    def _build_index(self):
+        """ Map gain and offset values to their positions in the cube.
+        """
+        self._offset_index = dict((int(value), position) for
+                                  position, value in enumerate(self.offsets))
+        self._gain_index = dict((int(value), position) for
+                                position, value in enumerate(self.gains))
+
+    def offset_position(self, offset):
+        """ Return the cube index of the specified offset value.
+        """
+        return self._offset_index[int(offset)]
+
+    def gain_position(self, gain):
+        """ Return the cube index of the specified gain value.
+        """
+        return self._gain_index[int(gain)]
+
+    def store(self, gain, offset, linetime, integration, data, frames=1,
+              std=None, minimum=None, maximum=None, duration=-1, dark=-1):
+        """ Write one line of data and its settings into the cell for the
+        gain, offset pair. Statistics are stored if the cube holds them.
+        """
+        off_pos = self.offset_position(offset)
+        gain_pos = self.gain_position(gain)
+        self.data[off_pos, gain_pos] = data
+
+        self.meta[off_pos, gain_pos] = (gain, offset, linetime, integration,
+                                        frames, duration, dark, MEASURED)
+
+        if self.statistics and std is not None:
+            self.std[off_pos, gain_pos] = std
+            self.minimum[off_pos, gain_pos] = minimum
+            self.maximum[off_pos, gain_pos] = maximum
+
+    def corrected(self):
+        """ Return the pixel data less the dark estimate of each line.
+        """
+        return subtract_dark(self.data, self.meta)
+
+    def group(self, offset):
+        """ Return a view of all the gain results at the specified
+        offset.
+        """
+        return SweepGroup(self, self.offset_position(offset))
+
+    def mark_clipped(self, offset, gains):
+        """ Record that the gains at the offset were skipped because the
+        line is known to be clipped. The cells stay unmeasured.
+        """
+        off_pos = self.offset_position(offset)
+        positions = [self.gain_position(gain) for gain in gains]
+        self.meta["status"][off_pos, positions] = CLIPPED
+
+    def measured(self):
+        """ Return a boolean (offset, gain) mask of the cells that have
+        been scanned.
+        """
+        return self.meta["gain"] >= 0
+
+    def clipped(self):
+        """ Return a boolean (offset, gain) mask of the cells skipped as
+        clipped.
+        """
+        return self.meta["status"] == CLIPPED
+
+    def groups(self):
+        """ Return a view of every offset group in cube order.
+        """
+        return [SweepGroup(self, position)
+                for position in range(len(self.offsets))]
+
+    @property
+    def nbytes(self):
+        """ Total memory used by the pixel data, statistics and metadata
+        arrays.
+        """
+        total = self.data.nbytes + self.meta.nbytes
+        for name in STAT_NAMES:
+            if getattr(self, name) is not None:
+                total += getattr(self, name).nbytes
+        return total
+
+
+class SweepGroup(object):
+    """ A list-like view of every gain result at one offset of a sweep
+    cube. Iterating yields Result objects whose data is a view into the
+    cube, so no pixel data is copied.
+    """
+    def __init__(self, cube, position):
+        super(SweepGroup, self).__init__()
+        self.cube = cube
+        self.position = position
+        self.offset = int(cube.offsets[position])
+
+    @property
+    def data(self):
+        """ The (gain, pixel) block of pixel data for this offset.
+        """
+        return self.cube.data[self.position]
+
+    @property
+    def meta(self):
+        """ The per-gain settings for this offset.
+        """
+        return self.cube.meta[self.position]
+
+    @property
+    def std(self):
+        """ Per-pixel standard deviation of averaged scans, or None.
+        """
+        return self._stat("std")
+
+    @property
+    def minimum(self):
+        """ Per-pixel minimum of averaged scans, or None.
+        """
+        return self._stat("minimum")
+
+    @property
+    def maximum(self):
+        """ Per-pixel maximum of averaged scans, or None.
+        """
+        return self._stat("maximum")
+
+    def corrected(self):
+        """ The (gain, pixel) block of pixel data less the dark estimate
+        of each line.
+        """
+        return subtract_dark(self.data, self.meta)
+
+    def clipped_gains(self):
+        """ The gains skipped as clipped at this offset.
+        """
+        return self.cube.gains[self.cube.clipped()[self.position]]
+
+    def summary(self, full_scale=4095):
+        """ Return the mean and maximum pixel value of the measured lines,
+        and the fraction of their pixels at full scale. All are zero if no
+        line has been measured.
+        """
+        lines = self.data[self.meta["gain"] >= 0]
+        if not lines.size:
+            return 0.0, 0.0, 0.0
+        return (float(lines.mean()), float(lines.max()),
+                numpy.count_nonzero(lines >= full_scale) / float(lines.size))
+
+    def _stat(self, name):
+        """ The (gain, pixel) block of the named statistic.
+        """
+        array = getattr(self.cube, name)
+        if array is None:
+            return None
+        return array[self.position]
+
+    def load(self):
+        """ Groups held in a cube are already loaded. Lazily loaded
+        groups read from files share this interface.
+        """
+        return self
+
+    def __len__(self):
+        return len(self.cube.gains)
+
+    def __getitem__(self, index):
+        cell = self.meta[index]
+        result = Result(int(cell["gain"]), int(cell["offset"]),
+                        int(cell["linetime"]), int(cell["integration"]),
+                        self.data[index])
+        result.frames = int(cell["frames"])
+        result.duration = float(cell["duration"])
+        result.dark = float(cell["dark"])
+        if self.cube.statistics:
+            result.std = self.std[index]
+            result.minimum = self.minimum[index]
+            result.maximum = self.maximum[index]
+        return result
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def subtract_dark(data, meta):
+    """ Return the float32 pixel data less the per-line dark estimate
+    in the metadata. Lines with no estimate are unchanged.
+    """
+    corrected = data.astype(numpy.float32)
+    corrected -= numpy.maximum(meta["dark"], 0)[..., None]
+    return corrected
+
+STAT_NAMES = ("std", "minimum", "maximum")
+
+# Cell status values. Unmeasured cells have every field at -1.
+UNMEASURED = -1
+MEASURED = 1
+CLIPPED = 2
+
+SWEEP_MAGIC = b"BBQSWEEP"
+SWEEP_VERSION = 1
+SWEEP_ALIGN = 4096
+
+def _align(position):
+    """ Round a byte position up to the next block boundary.
+    """
+    return (position + SWEEP_ALIGN - 1) // SWEEP_ALIGN * SWEEP_ALIGN
+
+def create_sweep_file(filename, offsets, gains, pixels, dtype, meta_dtype,
+                      stat_dtypes=None):
+    """ Write the header block of a sweep file and extend the file to
+    hold the metadata, pixel and optional statistics arrays. Returns the
+    header dictionary.
+    """
+    meta_dtype = numpy.dtype(meta_dtype)
+    dtype = numpy.dtype(dtype)
+    cells = len(offsets) * len(gains)
+
+    header = {"version": SWEEP_VERSION,
+              "offsets": [int(value) for value in offsets],
+              "gains": [int(value) for value in gains],
+              "pixels": int(pixels),
+              "dtype": dtype.str,
+              "meta_dtype": [list(field) for field in meta_dtype.descr],
+             }
+
+    # The layout offsets depend on the header length, so size the
+    # header with placeholders first
+    header["meta_offset"] = header["data_offset"] = 0
+    if stat_dtypes:
+        header["stats"] = dict((name, [0, numpy.dtype(stat_dtypes[name]).str])
+                               for name in STAT_NAMES)
+
+    head_len = len(SWEEP_MAGIC) + 4 + len(json.dumps(header)) + 64
+    header["meta_offset"] = _align(head_len)
+    header["data_offset"] = _align(header["meta_offset"] +
+                                   cells * meta_dtype.itemsize)
+    total = header["data_offset"] + cells * int(pixels) * dtype.itemsize
+
+    if stat_dtypes:
+        for name in STAT_NAMES:
+            stat_dtype = numpy.dtype(stat_dtypes[name])
+            header["stats"][name][0] = _align(total)
+            total = _align(total) + cells * int(pixels) * stat_dtype.itemsize
+
+    head_str = json.dumps(header).encode("utf-8")
+    sweep_file = open(filename, "wb")
+    sweep_file.write(SWEEP_MAGIC)
+    sweep_file.write(struct.pack("<I", len(head_str)))
+    sweep_file.write(head_str)
+    sweep_file.truncate(total)
+    sweep_file.close()
+    return header
+
+def read_sweep_header(filename):
+    """ Return the header dictionary of a sweep file.
+    """
+    sweep_file = open(filename, "rb")
+    try:
+        magic = sweep_file.read(len(SWEEP_MAGIC))
+        if magic != SWEEP_MAGIC:
+            raise ValueError("%s is not a sweep file" % filename)
+        head_len = struct.unpack("<I", sweep_file.read(4))[0]
+        header = json.loads(sweep_file.read(head_len).decode("utf-8"))
+    finally:
+        sweep_file.close()
+    return header
+
+def is_sweep_file(filename):
+    """ Return True if the file starts with the sweep file signature.
+    """
+    try:
+        sweep_file = open(filename, "rb")
+    except IOError:
+        return False
+    magic = sweep_file.read(len(SWEEP_MAGIC))
+    sweep_file.close()
+    return magic == SWEEP_MAGIC
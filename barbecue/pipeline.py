@@ -0,0 +1,312 @@
+""" Pipelined acquisition, where the device is kept busy with register
+writes and frame grabs while the previous frames are reduced and stored.
+"""
+
+import time
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy
+
+from barbecue import model
+
+class ScanBlock(object):
+    """ A block of the gain/offset grid passing through the pipeline,
+    with the scan durations and stopped rows of its cells.
+    """
+    def __init__(self, offsets, gains):
+        super(ScanBlock, self).__init__()
+        self.offsets = numpy.asarray(offsets, dtype=int)
+        self.gains = numpy.asarray(gains, dtype=int)
+        self.durations = numpy.zeros((len(self.offsets), len(self.gains)))
+        self.scanned = numpy.zeros(self.durations.shape, dtype=bool)
+
+        # Offset rows ended by the stop policy, by the gain position the
+        # row ended at. The write stage skips the rest of these rows.
+        self.stopped = {}
+
+        # Set once every cell of the block has been stored
+        self.stored = threading.Event()
+
+    def clipped(self):
+        """ Return the boolean array of cells skipped by the stop policy.
+        """
+        clipped = numpy.zeros(self.durations.shape, dtype=bool)
+        for off_pos, gain_pos in self.stopped.items():
+            clipped[off_pos, gain_pos + 1:] = \
+                ~self.scanned[off_pos, gain_pos + 1:]
+        return clipped
+
+class PipelinedScanner(object):
+    """ Scan a gain/offset grid with the same interface and results as
+    Model.scan_many and Model.scan_sweep, split into three stages joined
+    by bounded queues:
+
+        write: write the registers of each grid cell, in order
+        grab:  grab the frames of the cell
+        store: average the frames, estimate the dark level, store the
+               line, report the scan
+
+    The write and grab stages run on their own threads, and the store
+    stage runs on the calling thread. The registers of a cell are written
+    once the device has taken the settings of the previous cell. A device
+    with a trigger takes them when the frame is triggered, so the next
+    write overlaps the read out of the frame, see Model.grab_frames. Both
+    overlap the storage of the frames already grabbed. The queue depth
+    bounds the number of scans held in memory between grab and store.
+
+    A sweep runs through a single pipeline. The next block of a strategy
+    that does not use results is written while the previous block is
+    still being grabbed and stored, so the pipeline stays full across
+    blocks.
+    """
+    def __init__(self, acquire_model, depth=8, poll_interval=0.05):
+        super(PipelinedScanner, self).__init__()
+        self.model = acquire_model
+        self.depth = depth
+        self.poll_interval = poll_interval
+
+    def scan_many(self, gains, offsets, linetime, integration, out=None,
+                  callback=None, cancel=None, policy=None):
+        """ Scan every gain at each offset. See Model.scan_many.
+        """
+        gains = numpy.asarray(gains, dtype=int)
+        offsets = numpy.asarray(offsets, dtype=int)
+        if gains.size == 0 or offsets.size == 0:
+            raise ValueError("must specify gains, offsets")
+
+        target = out
+        if target is None:
+            target = self.model.cube
+
+        target, blocks, scans, cancelled, elapsed = self.run(
+            [(offsets, gains)], linetime, integration, target, callback,
+            cancel, policy)
+
+        block = ScanBlock(offsets, gains)
+        if blocks:
+            block = blocks[0]
+        return target, model.scan_timing(block.durations, scans, elapsed,
+                                         cancelled, block.clipped())
+
+    def scan_sweep(self, strategy, linetime, integration, callback=None,
+                   cancel=None, policy=None, block_complete=None):
+        """ Scan every block of the sweep strategy into the allocated
+        cube. See Model.scan_sweep.
+        """
+        target, blocks, scans, cancelled, elapsed = self.run(
+            strategy.blocks(self.model.cube), linetime, integration,
+            self.model.cube, callback, cancel, policy, block_complete,
+            strategy.uses_results)
+
+        durations = [block.durations.ravel() for block in blocks]
+        clipped = [block.clipped().ravel() for block in blocks]
+        return model.scan_timing(numpy.concatenate(durations +
+                                                   [numpy.zeros(0)]),
+                                 scans, elapsed, cancelled,
+                                 numpy.concatenate(clipped +
+                                                   [numpy.zeros(0, bool)]))
+
+    def run(self, blocks, linetime, integration, target, callback=None,
+            cancel=None, policy=None, block_complete=None,
+            uses_results=False):
+        """ Scan the (offsets, gains) blocks through the pipeline. Returns
+        the filled target, the scan blocks started, the number of scans,
+        whether the scan was cancelled and the time taken.
+        """
+        if self.model.device == None:
+            raise ValueError("Must assign device first")
+
+        started = []
+        scans = 0
+        cancelled = False
+        row = None
+        start = time.time()
+
+        stop = threading.Event()
+        latched = queue.Queue(1)
+        latched.put(True)
+        written = queue.Queue(1)
+        grabbed = queue.Queue(self.depth)
+        stages = [threading.Thread(target=self.write_cells,
+                                   args=(blocks, written, latched, stop,
+                                         uses_results)),
+                  threading.Thread(target=self.grab_cells,
+                                   args=(written, grabbed, latched, stop))]
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+
+        try:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    cancelled = True
+                    break
+
+                # Wait in short steps, so a cancel is seen while the
+                # device is busy
+                try:
+                    item = grabbed.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    continue
+
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                if isinstance(item, ScanBlock):
+                    if not started or started[-1] is not item:
+                        started.append(item)
+                    self.finish_block(item, target)
+                    if block_complete is not None:
+                        block_complete(item.offsets, item.gains)
+                    continue
+
+                block, position, gain, offset, frames, duration = item
+                if not started or started[-1] is not block:
+                    started.append(block)
+
+                data, stats = frames[0], {}
+                if self.model.frames > 1:
+                    data, stats = self.model.reduce_frames(frames)
+                stats = self.model.estimate_dark(data, stats)
+
+                target = self.model.store_cell(target, position,
+                                               block.durations.shape, gain,
+                                               offset, linetime, integration,
+                                               data, stats, duration)
+                block.durations[position] = duration
+                block.scanned[position] = True
+                scans += 1
+                if callback is not None:
+                    callback(offset, gain)
+
+                if policy is None or position[0] in block.stopped:
+                    continue
+                if row != (block, position[0]):
+                    row = (block, position[0])
+                    policy.start(block.gains)
+                if policy.stop(data):
+                    block.stopped[position[0]] = position[1]
+        finally:
+            self.shutdown(stop, stages)
+
+        # Rows stopped in a block ended by a cancel are clipped too
+        if started and not started[-1].stored.is_set():
+            self.finish_block(started[-1], target)
+
+        return target, started, scans, cancelled, time.time() - start
+
+    def finish_block(self, block, target):
+        """ Mark the cells of the block skipped by the stop policy as
+        clipped, and release a write stage waiting for the block.
+        """
+        clipped = block.clipped()
+        for off_pos in block.stopped:
+            self.model.mark_clipped(target, block.offsets[off_pos],
+                                    block.gains[clipped[off_pos]])
+        block.stored.set()
+
+    def write_cells(self, blocks, written, latched, stop, uses_results):
+        """ Write stage, apply the settings of every cell of each block
+        once the previous settings are latched, and queue the cell to be
+        grabbed, followed by the block. Cells in rows ended by the stop
+        policy are skipped. When the blocks use results, the next block
+        is only requested once the previous one is stored. Any error is
+        passed on to the store stage.
+        """
+        try:
+            for offsets, gains in blocks:
+                block = ScanBlock(offsets, gains)
+                for off_pos, offset in enumerate(block.offsets):
+                    for gain_pos, gain in enumerate(block.gains):
+                        if off_pos in block.stopped:
+                            break
+                        if self.get(latched, stop) is None:
+                            return
+
+                        scan_start = time.time()
+                        self.model.apply(gain, offset)
+                        cell = (block, (off_pos, gain_pos), gain, offset,
+                                scan_start)
+                        if not self.put(written, cell, stop):
+                            return
+
+                if not self.put(written, block, stop):
+                    return
+                if uses_results and not self.wait(block.stored, stop):
+                    return
+        except Exception as exc:
+            self.put(written, exc, stop)
+            return
+        self.put(written, None, stop)
+
+    def grab_cells(self, written, grabbed, latched, stop):
+        """ Grab stage, grab the frames of each written cell into a new
+        array, and queue them to be stored. The write stage is released
+        as soon as the device has latched the settings. Blocks, errors
+        and the end of the scan are passed on to the store stage.
+        """
+        try:
+            while True:
+                item = self.get(written, stop)
+                if not isinstance(item, tuple):
+                    if not self.put(grabbed, item, stop):
+                        return
+                    if isinstance(item, ScanBlock):
+                        continue
+                    return
+
+                block, position, gain, offset, scan_start = item
+                frames = self.model.grab_frames(
+                    latched=lambda: latched.put(True))
+                item = (block, position, gain, offset, frames,
+                        time.time() - scan_start)
+                if not self.put(grabbed, item, stop):
+                    return
+        except Exception as exc:
+            self.put(grabbed, exc, stop)
+
+    def put(self, stage_queue, item, stop):
+        """ Queue the item, waiting for space unless the pipeline is
+        stopped. Returns False if the item was not queued.
+        """
+        while not stop.is_set():
+            try:
+                stage_queue.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, stage_queue, stop):
+        """ Return the next queued item, or None once the pipeline is
+        stopped.
+        """
+        while not stop.is_set():
+            try:
+                return stage_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                pass
+        return None
+
+    def wait(self, event, stop):
+        """ Wait for the event unless the pipeline is stopped. Returns
+        False if the pipeline was stopped first.
+        """
+        while not stop.is_set():
+            if event.wait(self.poll_interval):
+                return True
+        return False
+
+    def shutdown(self, stop, stages):
+        """ Stop every stage and wait for its thread to finish.
+        """
+        stop.set()
+        for stage in stages:
+            stage.join()
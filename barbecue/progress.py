@@ -0,0 +1,131 @@
+""" Progress reporting for long running acquisition, save and load
+operations.
+"""
+
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+class ProgressReporter(object):
+    """ Count the operations of a task and pass the progress to the
+    callback at most max_rate times a second, or for every operation if
+    max_rate is zero.
+    Counting is a single addition and clock read, so the reporter can be
+    updated for every scan or row.
+    """
+    def __init__(self, callback, max_rate=10.0, clock=time.time):
+        super(ProgressReporter, self).__init__()
+        self.callback = callback
+        self.max_rate = max_rate
+        self.clock = clock
+        self.message = ""
+        self.unit = ""
+        self.total = 0
+        self.count = 0
+        self.done = False
+        self.start_time = self.clock()
+        self.last_time = self.start_time
+        self.next_report = self.start_time
+
+    def start(self, total, message="", unit="operations"):
+        """ Begin a new task of total operations. The first operation
+        counted is reported straight away.
+        """
+        self.total = total
+        self.message = message
+        self.unit = unit
+        self.count = 0
+        self.done = False
+        self.start_time = self.clock()
+        self.last_time = self.start_time
+        self.next_report = self.start_time
+
+    def add(self, count=1):
+        """ Count completed operations, and report them if the report
+        interval has passed.
+        """
+        self.count += count
+        now = self.clock()
+        if now >= self.next_report:
+            self.report(now)
+
+    def finish(self):
+        """ Mark the task complete, which may be before the total is
+        reached, and report it.
+        """
+        self.done = True
+        self.report()
+
+    def report(self, now=None):
+        """ Pass the current progress to the callback.
+        """
+        if now is None:
+            now = self.clock()
+        self.last_time = now
+        if self.max_rate:
+            self.next_report = now + 1.0 / self.max_rate
+        self.callback(self)
+
+    @property
+    def elapsed(self):
+        """ Seconds from the start of the task to the last report.
+        """
+        return self.last_time - self.start_time
+
+    @property
+    def rate(self):
+        """ Operations per second.
+        """
+        if self.elapsed <= 0:
+            return 0.0
+        return self.count / self.elapsed
+
+    @property
+    def remaining(self):
+        """ Estimated seconds to complete the total, or None before the
+        rate is known.
+        """
+        if self.done:
+            return 0.0
+        if self.rate <= 0:
+            return None
+        return max(self.total - self.count, 0) / self.rate
+
+    @property
+    def percent(self):
+        """ Percentage of the total completed.
+        """
+        if self.done:
+            return 100.0
+        if not self.total:
+            return 0.0
+        return min(100.0 * self.count / self.total, 100.0)
+
+    def describe(self):
+        """ Return a line of text with the count, throughput, elapsed time
+        and estimated time remaining.
+        """
+        if self.done:
+            text = "Done %s %s in %s, %.1f %s/s" % \
+                   (self.count, self.unit, format_seconds(self.elapsed),
+                    self.rate, self.unit)
+        else:
+            text = "%s/%s %s, %.1f %s/s, elapsed %s, ETA %s" % \
+                   (self.count, self.total, self.unit, self.rate, self.unit,
+                    format_seconds(self.elapsed),
+                    format_seconds(self.remaining))
+
+        if self.message:
+            text = "%s: %s" % (self.message, text)
+        return text
+
+def format_seconds(seconds):
+    """ Return the number of seconds as h:mm:ss, or dashes if unknown.
+    """
+    if seconds is None:
+        return "-:--:--"
+
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
@@ -0,0 +1,437 @@
+""" Readers and writers for the sweep results file formats.
+"""
+
+import os
+import logging
+import collections
+
+import numpy
+
+from barbecue import model
+
+log = logging.getLogger(__name__)
+
+CSV_HEADER = "Offset,Gain,Line Time,Integration Time,Data\n"
+CSV_FIELDS = 4
+
+BINARY_FORMATS = ("bbq", "npz")
+
+def file_format(file_name):
+    """ Return the sweep file format selected by the file name
+    extension: bbq, npz or csv.
+    """
+    extension = os.path.splitext(str(file_name))[1].lower().lstrip(".")
+    if extension in BINARY_FORMATS:
+        return extension
+    return "csv"
+
+def is_binary(file_name):
+    """ Return True if the file name selects a binary sweep format.
+    """
+    return file_format(file_name) in BINARY_FORMATS
+
+def create_csv(file_name):
+    """ Open a csv sweep file for writing. Lines end with a bare newline
+    on every platform, as in the files written in binary mode by the
+    controller.
+    """
+    try:
+        return open(file_name, "w", newline="")
+    except TypeError:
+        # Python 2 has no newline translation in binary mode
+        return open(file_name, "wb")
+
+def write_header(csv_file):
+    """ Write the csv file format header to the passed in file.
+    """
+    csv_file.write(CSV_HEADER)
+
+def group_table(results):
+    """ Return an object array with one row per measured result of an
+    offset group: offset, gain, line time, integration time, then the
+    pixel data. Values are python ints and floats so they print exactly
+    as the individual result values do. Single and half precision data
+    is formatted at its own precision, as a python float would print
+    the rounding error of the conversion.
+    """
+    if hasattr(results, "meta"):
+        meta = results.meta
+        measured = numpy.flatnonzero(meta["gain"] >= 0)
+        meta = meta[measured]
+        columns = [meta["offset"], meta["gain"], meta["linetime"],
+                   meta["integration"]]
+        data = results.data[measured]
+    else:
+        columns = [[result.offset for result in results],
+                   [result.gain for result in results],
+                   [result.linetime for result in results],
+                   [result.integration for result in results]]
+        data = numpy.array([result.data for result in results])
+
+    table = numpy.empty((len(data), CSV_FIELDS + data.shape[-1]),
+                        dtype=object)
+    for position, column in enumerate(columns):
+        table[:, position] = column
+    if data.dtype.kind == "f" and data.dtype.itemsize < 8:
+        data = data.astype(str)
+    table[:, CSV_FIELDS:] = data
+    return table
+
+def format_table(table):
+    """ Format every row of a group table as csv lines in a single
+    string formatting operation.
+    """
+    rows, columns = table.shape
+    row_fmt = "%s," * columns + "\n"
+    return (row_fmt * rows) % tuple(table.ravel())
+
+def write_group(csv_file, results):
+    """ Write an offset group to the csv file with one buffered write,
+    return the number of lines written.
+    """
+    table = group_table(results)
+    csv_file.write(format_table(table))
+    return len(table)
+
+class CSVIndex(object):
+    """ Table of the byte range of every offset group in a csv sweep
+    file. The file is indexed in chunks of bytes, and the line breaks and
+    offset field of every line in a chunk are found with array
+    operations. A group's pixel data is parsed when it is loaded, and
+    the most recently loaded groups are cached.
+    """
+    def __init__(self, file_name, chunk_bytes=1024 * 1024, cache_groups=4):
+        super(CSVIndex, self).__init__()
+        self.file_name = file_name
+        self.chunk_bytes = chunk_bytes
+        self.cache_groups = cache_groups
+        self.entries = []
+        self.rows = 0
+        self.done = False
+
+        # Bytes in the file and bytes indexed so far, for progress
+        self.size = os.path.getsize(file_name)
+        self._cache = collections.OrderedDict()
+        self._csv_file = open(file_name, "rb")
+        self._csv_file.readline()
+        self.position = self._csv_file.tell()
+        self._current = None
+        self._remainder = b""
+
+    def scan_chunk(self):
+        """ Index the next chunk of lines, return a list of references to
+        the offset groups completed by it.
+        """
+        if self.done:
+            return []
+
+        start = len(self.entries)
+        chunk = self._csv_file.read(self.chunk_bytes)
+        block = self._remainder + chunk
+
+        # A partial line at the end of the chunk is kept for the next
+        complete = len(block)
+        if chunk:
+            complete = block.rfind(b"\n") + 1
+        self._remainder = block[complete:]
+        self.index_lines(block[:complete], self.position)
+        self.position += complete
+
+        if not chunk:
+            self._finish_entry(self.position)
+            self.done = True
+            self._csv_file.close()
+
+        return [CSVGroupRef(self, position)
+                for position in range(start, len(self.entries))]
+
+    def index_lines(self, block, base):
+        """ Add the complete lines of the block, which starts at the byte
+        position base in the file, to the index.
+        """
+        text = numpy.frombuffer(block, dtype=numpy.uint8)
+        ends = numpy.flatnonzero(text == ord("\n"))
+        if len(text) and (not len(ends) or ends[-1] != len(text) - 1):
+            ends = numpy.append(ends, len(text))
+        starts = numpy.concatenate(([0], ends[:-1] + 1)).astype(int)
+
+        # The offset is the text up to the first comma of a line, and
+        # blank lines have no comma
+        commas = numpy.append(numpy.flatnonzero(text == ord(",")), len(text))
+        firsts = commas[numpy.searchsorted(commas, starts)]
+        lines = firsts < ends
+        starts = starts[lines]
+        offsets = parse_offsets(text, starts, firsts[lines])
+        if not len(offsets):
+            return
+
+        changes = numpy.flatnonzero(offsets[1:] != offsets[:-1]) + 1
+        bounds = numpy.concatenate(([0], changes, [len(offsets)]))
+        for first, stop in zip(bounds[:-1], bounds[1:]):
+            offset = int(offsets[first])
+            position = base + int(starts[first])
+            if self._current is not None and self._current[0] != offset:
+                self._finish_entry(position)
+            if self._current is None:
+                self._current = [offset, position, 0]
+            self._current[2] += int(stop - first)
+        self.rows += len(offsets)
+
+    def _finish_entry(self, stop):
+        """ Record the current group as ending at the byte position.
+        """
+        if self._current is not None:
+            offset, start, rows = self._current
+            self.entries.append((offset, start, stop, rows))
+            self._current = None
+
+    def load(self, position):
+        """ Parse and return the offset group of the index entry.
+        """
+        if position in self._cache:
+            group = self._cache.pop(position)
+        else:
+            offset, start, stop, rows = self.entries[position]
+            csv_file = open(self.file_name, "rb")
+            csv_file.seek(start)
+            text = csv_file.read(stop - start)
+            csv_file.close()
+
+            if not isinstance(text, str):
+                text = text.decode("ascii")
+            lines = [line for line in text.splitlines() if line.strip()]
+            group = values_to_group(parse_lines(lines))
+
+        self._cache[position] = group
+        while len(self._cache) > self.cache_groups:
+            self._cache.popitem(last=False)
+        return group
+
+class CSVGroupRef(object):
+    """ Reference to an offset group of an indexed csv file, with the
+    same load interface as a sweep group.
+    """
+    def __init__(self, index, position):
+        super(CSVGroupRef, self).__init__()
+        self.index = index
+        self.position = position
+        self.offset, _, _, self.rows = index.entries[position]
+
+    def __len__(self):
+        return self.rows
+
+    def load(self):
+        """ Parse the group from the file.
+        """
+        return self.index.load(self.position)
+
+def parse_offsets(text, starts, stops):
+    """ Convert the digits between each start and stop position of the
+    text byte array to integers, one digit position at a time for every
+    line at once.
+    """
+    widths = stops - starts
+    offsets = numpy.zeros(len(starts), dtype=int)
+    if not len(starts):
+        return offsets
+    if widths.min() < 1:
+        raise ValueError("Malformed csv sweep data")
+
+    for digit in range(widths.max()):
+        take = digit < widths
+        values = text[numpy.where(take, starts + digit, 0)].astype(int) - \
+                 ord("0")
+        if numpy.any(take & ((values < 0) | (values > 9))):
+            raise ValueError("Malformed csv sweep data")
+        offsets = numpy.where(take, offsets * 10 + values, offsets)
+    return offsets
+
+def parse_lines(lines):
+    """ Convert a list of csv lines to a two dimensional array of
+    floats. The trailing comma of each line is ignored.
+    """
+    text = ",".join(line.rstrip().rstrip(",") for line in lines)
+    values = numpy.fromstring(text, dtype=float, sep=",")
+
+    columns = lines[0].rstrip().rstrip(",").count(",") + 1
+    if values.size != len(lines) * columns:
+        raise ValueError("Malformed csv sweep data")
+    return values.reshape(len(lines), columns)
+
+def values_to_group(values):
+    """ Convert parsed csv rows of a single offset into a sweep group.
+    Pixel data is stored as unsigned 16 bit if every value fits,
+    otherwise as float.
+    """
+    data = values[:, CSV_FIELDS:]
+    dtype = float
+    if data.size and data.min() >= 0 and data.max() <= 65535 and \
+       numpy.all(numpy.floor(data) == data):
+        dtype = numpy.uint16
+
+    offset = int(values[0, 0])
+    cube = model.SweepCube([offset], values[:, 1], data.shape[1], dtype)
+    cube.data[0] = data
+    for position, name in enumerate(["offset", "gain", "linetime",
+                                     "integration"]):
+        cube.meta[name][0] = values[:, position]
+    return cube.group(offset)
+
+def groups_to_cube(groups, filename=None):
+    """ Combine offset groups into a single sweep cube, in group order.
+    The gain axis is the union of every measured or clipped gain, and
+    cells not measured in a group are left unmeasured.
+    """
+    if not groups:
+        raise ValueError("No results to combine")
+
+    cube = create_combined_cube(groups, [group.offset for group in groups],
+                                filename)
+    for position, group in enumerate(groups):
+        copy_group(cube, position, group)
+    return cube
+
+def csv_to_cube(file_name, filename=None):
+    """ Convert a csv sweep file to a sweep cube, memory mapped to the
+    filename if given. The groups are parsed once to size the cube and
+    again to fill it, so only one group is held in memory at a time.
+    """
+    index = CSVIndex(file_name, cache_groups=0)
+    while not index.done:
+        index.scan_chunk()
+    if not index.entries:
+        raise ValueError("No results to combine")
+
+    positions = range(len(index.entries))
+    groups = (index.load(position) for position in positions)
+    cube = create_combined_cube(groups, [entry[0] for entry in index.entries],
+                                filename)
+    for position in positions:
+        copy_group(cube, position, index.load(position))
+    return cube
+
+def create_combined_cube(groups, offsets, filename=None):
+    """ Create an empty sweep cube to combine the groups in. The groups
+    are only iterated once, so they can be loaded one at a time.
+    """
+    gains = set()
+    pixels = 0
+    dtypes = []
+    sensor_dtypes = []
+    # Frame statistics are kept only if every group has them
+    statistics = True
+    for group in groups:
+        cells = numpy.flatnonzero(group.meta["gain"] >= 0)
+        gains.update(group.meta["gain"][cells].tolist())
+        gains.update(group.clipped_gains().tolist())
+        pixels = max(pixels, group.data.shape[-1])
+        dtypes.append(group.data.dtype)
+        if group.std is None:
+            statistics = False
+        else:
+            sensor_dtypes.append(group.minimum.dtype)
+
+    sensor_dtype = numpy.uint16
+    if statistics:
+        sensor_dtype = numpy.result_type(*sensor_dtypes)
+
+    return model.SweepCube(offsets, numpy.array(sorted(gains), dtype=int),
+                           pixels, numpy.result_type(*dtypes), filename,
+                           statistics, sensor_dtype)
+
+def copy_group(cube, position, group):
+    """ Copy the measured cells and clipped status of an offset group
+    into the row of the cube at position.
+    """
+    cells = numpy.flatnonzero(group.meta["gain"] >= 0)
+    meta = group.meta[cells]
+    columns = numpy.searchsorted(cube.gains, meta["gain"])
+    cube.data[position, columns] = group.data[cells]
+    for name in meta.dtype.names:
+        cube.meta[name][position, columns] = meta[name]
+
+    if cube.statistics:
+        for name in model.STAT_NAMES:
+            stat = getattr(cube, name)
+            stat[position, columns] = getattr(group, name)[cells]
+
+    # Offsets repeat when groups of several sweeps are combined, so
+    # the status is written by position rather than offset value
+    columns = numpy.searchsorted(cube.gains, group.clipped_gains())
+    cube.meta["status"][position, columns] = model.CLIPPED
+
+def save_binary(file_name, groups):
+    """ Write the offset groups to a bbq or npz file. Pixel data is
+    stored in its native dtype along with the gain and offset axes and
+    the per-cell settings. Raises ValueError if the file is memory mapped
+    by one of the groups, as a mapped file can not be replaced on every
+    platform.
+    """
+    file_name = str(file_name)
+    if is_mapped(file_name, groups):
+        raise ValueError("Can not overwrite %s while it is memory mapped" %
+                         file_name)
+
+    if file_format(file_name) == "npz":
+        cube = groups_to_cube(groups)
+        arrays = {"offsets": cube.offsets, "gains": cube.gains,
+                  "pixels": cube.pixels, "data": cube.data,
+                  "meta": cube.meta}
+        if cube.statistics:
+            for name in model.STAT_NAMES:
+                arrays[name] = getattr(cube, name)
+
+        npz_file = open(file_name, "wb")
+        numpy.savez(npz_file, **arrays)
+        npz_file.close()
+        return
+
+    # Build the new file alongside and then move it into place, so a
+    # failed save leaves the previous file intact
+    temp_name = file_name + ".tmp"
+    cube = groups_to_cube(groups, filename=temp_name)
+    cube.flush()
+    del cube
+
+    if os.path.exists(file_name):
+        os.remove(file_name)
+    os.rename(temp_name, file_name)
+
+def is_mapped(file_name, groups):
+    """ Return True if any of the offset groups is a view of a cube memory
+    mapped to the file.
+    """
+    if not os.path.exists(file_name):
+        return False
+
+    # os.path.samefile is not available on Windows under python 2
+    target = normalize_path(file_name)
+    for group in groups:
+        mapped = group.cube.filename
+        if mapped is not None and normalize_path(mapped) == target:
+            return True
+    return False
+
+def normalize_path(file_name):
+    """ Return the absolute path of the file, in the case used by the
+    platform to compare file names.
+    """
+    return os.path.normcase(os.path.abspath(str(file_name)))
+
+def load_binary(file_name):
+    """ Return the sweep cube stored in a bbq or npz file. A bbq file is
+    memory mapped, so no pixel data is read until it is accessed.
+    """
+    file_name = str(file_name)
+    if file_format(file_name) == "npz":
+        arrays = numpy.load(file_name)
+        stats = dict((name, arrays[name]) for name in model.STAT_NAMES
+                     if name in arrays.files)
+        cube = model.SweepCube.from_arrays(arrays["offsets"],
+                                           arrays["gains"],
+                                           arrays["data"], arrays["meta"],
+                                           **stats)
+        arrays.close()
+        return cube
+
+    return model.SweepCube.open(file_name)
@@ -0,0 +1,302 @@
+""" Strategies that choose the order and subset of gain/offset
+combinations scanned in a sweep.
+
+A strategy yields blocks of (offsets, gains). A strategy that uses
+results looks at the data already stored in the sweep cube, and every
+combination of the offsets and gains in a block is scanned and stored
+before its next block is requested. The blocks of any other strategy
+may be requested while the previous ones are still being scanned.
+"""
+
+import logging
+import functools
+import collections
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+class RasterSweep(object):
+    """ Scan every gain at each offset in turn, or every offset at each
+    gain when gain major. A serpentine sweep reverses the inner axis on
+    every other pass, so the registers never jump from one end of the
+    range back to the other.
+    """
+    def __init__(self, offsets, gains, serpentine=False, gain_major=False):
+        super(RasterSweep, self).__init__()
+        self.offsets = list(offsets)
+        self.gains = list(gains)
+        self.serpentine = serpentine
+        self.gain_major = gain_major
+
+        # Offset major blocks cover a single offset, which is complete
+        # once the block has been scanned
+        self.offset_major = not gain_major
+        self.uses_results = False
+
+    def blocks(self, cube):
+        """ Yield one block per offset of every gain, or one block per
+        gain of every offset.
+        """
+        outer, inner = self.offsets, self.gains
+        if self.gain_major:
+            outer, inner = self.gains, self.offsets
+
+        for position, value in enumerate(outer):
+            values = inner
+            if self.serpentine and position % 2:
+                values = inner[::-1]
+
+            if self.gain_major:
+                yield values, [value]
+            else:
+                yield [value], values
+
+
+class AdaptiveSweep(object):
+    """ Scan a coarse grid of every step'th gain and offset, then refine
+    the tiles between grid points where the response departs from a
+    linear interpolation of the grid, or crosses the saturation or zero
+    clip levels. A refined tile is scanned on a grid factor times finer,
+    and its subtiles are refined in turn down to single cells. Cells
+    that are never scanned stay unmeasured in the cube.
+    """
+    offset_major = False
+    uses_results = True
+
+    def __init__(self, offsets, gains, step=16, threshold=64.0,
+                 full_scale=4095, clip_fraction=0.5, factor=4):
+        super(AdaptiveSweep, self).__init__()
+        self.offsets = numpy.array(offsets, dtype=int)
+        self.gains = numpy.array(gains, dtype=int)
+        self.step = step
+        self.threshold = threshold
+        self.full_scale = full_scale
+        self.clip_fraction = clip_fraction
+        self.factor = factor
+
+    def grid_positions(self, low, high, step):
+        """ Return the positions from low to high every step, always
+        including high.
+        """
+        positions = list(range(low, high + 1, step))
+        if positions[-1] != high:
+            positions.append(high)
+        return numpy.array(positions)
+
+    def tiles(self, count):
+        """ Return the (low, high) grid indexes bounding every tile along
+        an axis of count grid points.
+        """
+        if count == 1:
+            return [(0, 0)]
+        return [(low, low + 1) for low in range(count - 1)]
+
+    def blocks(self, cube):
+        """ Yield the coarse grid, then the unmeasured cells of the finer
+        grid of each tile that needs refining, level by level. Blocks are
+        generated after the previous ones have been scanned.
+        """
+        cube_off = numpy.array([cube.offset_position(value)
+                                for value in self.offsets])
+        cube_gain = numpy.array([cube.gain_position(value)
+                                 for value in self.gains])
+
+        step = self.step
+        regions = [(self.grid_positions(0, len(self.offsets) - 1, step),
+                    self.grid_positions(0, len(self.gains) - 1, step))]
+        for block in self.unmeasured(cube, cube_off, cube_gain, *regions[0]):
+            yield block
+
+        while step > 1 and regions:
+            fine_step = max(step // self.factor, 1)
+            refined = []
+            for off_grid, gain_grid in regions:
+                grid = cube.data[numpy.ix_(cube_off[off_grid],
+                                           cube_gain[gain_grid])]
+                refine = self.refine_mask(grid, off_grid, gain_grid)
+                off_tiles = self.tiles(len(off_grid))
+                gain_tiles = self.tiles(len(gain_grid))
+
+                for off_tile, gain_tile in zip(*numpy.nonzero(refine)):
+                    off_low, off_high = off_tiles[off_tile]
+                    gain_low, gain_high = gain_tiles[gain_tile]
+                    region = (self.grid_positions(off_grid[off_low],
+                                                  off_grid[off_high],
+                                                  fine_step),
+                              self.grid_positions(gain_grid[gain_low],
+                                                  gain_grid[gain_high],
+                                                  fine_step))
+                    for block in self.unmeasured(cube, cube_off, cube_gain,
+                                                 *region):
+                        yield block
+                    refined.append(region)
+
+            log.info("Refine %s tiles at step %s", len(refined), fine_step)
+            regions = refined
+            step = fine_step
+
+    def unmeasured(self, cube, cube_off, cube_gain, off_grid, gain_grid):
+        """ Yield the unmeasured cells of the grid as blocks of offsets
+        that share the same unmeasured gains. Tiles share their edges, and
+        the coarser grid is already measured, so no cell is scanned
+        twice. Cells skipped as clipped by a stop policy count as done.
+        """
+        done = cube.measured() | cube.clipped()
+        measured = done[numpy.ix_(cube_off[off_grid], cube_gain[gain_grid])]
+        rows = collections.OrderedDict()
+        for row, cells in enumerate(measured):
+            if not cells.all():
+                rows.setdefault(cells.tobytes(), []).append(row)
+
+        for row_list in rows.values():
+            gains = gain_grid[~measured[row_list[0]]]
+            yield self.offsets[off_grid[row_list]], self.gains[gains]
+
+    def refine_mask(self, grid, off_grid, gain_grid):
+        """ Given the (offset, gain, pixel) measurements at the grid
+        positions, return a boolean array of the tiles between grid points
+        to refine.
+        """
+        grid = grid.astype(float)
+        mean = grid.mean(axis=-1)
+        saturated = (grid >= self.full_scale).mean(axis=-1) > \
+                    self.clip_fraction
+        zeroed = (grid <= 0).mean(axis=-1) > self.clip_fraction
+        clipped = saturated | zeroed
+
+        off_tiles = self.tiles(len(off_grid))
+        gain_tiles = self.tiles(len(gain_grid))
+        off_low = [tile[0] for tile in off_tiles]
+        off_high = [tile[1] for tile in off_tiles]
+        gain_low = [tile[0] for tile in gain_tiles]
+        gain_high = [tile[1] for tile in gain_tiles]
+
+        def corners(values):
+            """ Stack the value at each of the four corners of every
+            tile.
+            """
+            return numpy.array([values[numpy.ix_(off_low, gain_low)],
+                                values[numpy.ix_(off_low, gain_high)],
+                                values[numpy.ix_(off_high, gain_low)],
+                                values[numpy.ix_(off_high, gain_high)]])
+
+        # A tile is curved when a corner is away from the line through
+        # its grid neighbours, or when its corners do not lie on a plane.
+        # Clipped points are left to the crossing test.
+        error = numpy.maximum(
+            self.linear_error(mean, clipped, off_grid, 0),
+            self.linear_error(mean, clipped, gain_grid, 1))
+        curved = corners(error).max(axis=0) > self.threshold
+
+        mean_corners = corners(mean)
+        twist = abs(mean_corners[0] - mean_corners[1] - mean_corners[2] +
+                    mean_corners[3])
+        curved |= (twist > self.threshold) & \
+                  ~corners(clipped).any(axis=0)
+
+        # A tile crosses a clip level when only some of its corners are
+        # clipped
+        sat_corners = corners(saturated)
+        zero_corners = corners(zeroed)
+        crossing = (sat_corners.any(axis=0) & ~sat_corners.all(axis=0)) | \
+                   (zero_corners.any(axis=0) & ~zero_corners.all(axis=0))
+
+        return curved | crossing
+
+    def linear_error(self, mean, clipped, positions, axis):
+        """ Return the distance of every interior grid mean from the
+        linear interpolation of its two neighbours along the axis. Points
+        at the ends of the axis or next to a clipped point are zero.
+        """
+        error = numpy.zeros(mean.shape)
+        if len(positions) < 3:
+            return error
+
+        mean = numpy.swapaxes(mean, 0, axis)
+        clipped = numpy.swapaxes(clipped, 0, axis)
+        positions = numpy.asarray(positions, dtype=float)
+        weight = (positions[1:-1] - positions[:-2]) / \
+                 (positions[2:] - positions[:-2])
+        weight = weight.reshape((-1,) + (1,) * (mean.ndim - 1))
+
+        predicted = mean[:-2] + weight * (mean[2:] - mean[:-2])
+        interior = abs(mean[1:-1] - predicted)
+        interior[clipped[:-2] | clipped[1:-1] | clipped[2:]] = 0
+        numpy.swapaxes(error, 0, axis)[1:-1] = interior
+        return error
+
+
+class SaturationStop(object):
+    """ Stop policy that ends the gain row of an offset once a number of
+    consecutive lines are saturated, as raising the gain further only
+    clips more of the line. A line is saturated when more than the
+    fraction of its pixels are at full scale. Rows scanned in decreasing
+    gain order are never stopped.
+    """
+    def __init__(self, consecutive=4, full_scale=4095, fraction=0.9):
+        super(SaturationStop, self).__init__()
+        self.consecutive = consecutive
+        self.full_scale = full_scale
+        self.fraction = fraction
+        self.count = 0
+        self.active = False
+
+    def start(self, gains):
+        """ Begin a new gain row.
+        """
+        self.count = 0
+        self.active = len(gains) > 1 and bool(numpy.all(numpy.diff(gains)
+                                                        > 0))
+
+    def saturated(self, line):
+        """ Return True if the line is saturated.
+        """
+        line = numpy.asarray(line)
+        clipped = numpy.count_nonzero(line >= self.full_scale)
+        return clipped > self.fraction * line.size
+
+    def stop(self, line):
+        """ Count the scanned line, return True if the rest of the row
+        is to be skipped.
+        """
+        if not self.active:
+            return False
+
+        if self.saturated(line):
+            self.count += 1
+        else:
+            self.count = 0
+        return self.count >= self.consecutive
+
+
+STRATEGIES = {"raster": RasterSweep,
+              "serpentine": functools.partial(RasterSweep, serpentine=True),
+              "gain_major": functools.partial(RasterSweep, gain_major=True),
+              "gain_serpentine": functools.partial(RasterSweep,
+                                                   serpentine=True,
+                                                   gain_major=True),
+              "adaptive": AdaptiveSweep,
+             }
+
+def check_stop_policy(name):
+    """ Raise ValueError if a stop policy can never end a gain row of the
+    named strategy, as its rows hold a single gain. Return a warning if
+    the strategy reverses the gains of some rows, which are never
+    stopped, otherwise None.
+    """
+    strategy = create(name, [0], [0])
+    if getattr(strategy, "gain_major", False):
+        raise ValueError("A saturation stop never ends a row of the %s "
+                         "strategy, which scans one gain per offset" % name)
+    if getattr(strategy, "serpentine", False):
+        return "A saturation stop only ends the rows of increasing gain " \
+               "of the %s strategy" % name
+    return None
+
+def create(name, offsets, gains, **kwargs):
+    """ Return the named sweep strategy over the offset and gain ranges.
+    """
+    if name not in STRATEGIES:
+        raise ValueError("Unknown sweep strategy: %s" % name)
+    return STRATEGIES[name](offsets, gains, **kwargs)
@@ -0,0 +1,15 @@
+""" Helpers shared by the barbecue tests.
+"""
+
+class StopAfter(object):
+    """ Cancel flag that is set once the callback has counted the
+    number of scans.
+    """
+    def __init__(self, scans):
+        self.scans = scans
+
+    def scanned(self, offset, gain):
+        self.scans -= 1
+
+    def is_set(self):
+        return self.scans <= 0
@@ -0,0 +1,77 @@
+""" tests for the gain/offset calibration of barbecue
+"""
+
+import unittest
+
+import numpy
+
+from barbecue import model
+from barbecue import calibrate
+
+class LinearModel(object):
+    """ Stand in for an assigned model whose lines have a dark level set
+    by the offset, and a peak above it scaled by the gain.
+    """
+    def __init__(self):
+        self.results = []
+        self.cube = None
+
+    def scan(self, gain, offset, linetime, integration):
+        dark = offset * 10.0
+        peak = dark + gain * 8.0
+        data = numpy.clip(numpy.linspace(dark, peak, 200), 0, 4095)
+        self.results.append(model.Result(gain, offset, linetime,
+                                         integration, data))
+        return True
+
+class TestCalibrator(unittest.TestCase):
+
+    def setUp(self):
+        self.model = LinearModel()
+        self.calibrator = calibrate.Calibrator(self.model, 100, 98,
+                                               dark_percentile=0,
+                                               peak_percentile=100)
+
+    def test_search_either_direction(self):
+        rising = self.calibrator.search(lambda value: value * 3.0,
+                                        (0, 255), 300.0, 1.0)
+        self.assertEqual(rising, 100)
+
+        falling = self.calibrator.search(lambda value: 1000 - value * 3.0,
+                                         (0, 255), 700.0, 1.0)
+        self.assertEqual(falling, 100)
+
+        # Out of range targets settle on the nearest end
+        self.assertEqual(self.calibrator.search(lambda value: value,
+                                                (0, 255), 900.0, 1.0), 255)
+
+    def test_calibrate_to_targets(self):
+        result = self.calibrator.calibrate(dark_target=500,
+                                           peak_target=2100, tolerance=16)
+        self.assertTrue(result.converged)
+        self.assertLessEqual(abs(result.dark - 500), 16)
+        self.assertLessEqual(abs(result.peak - 2100), 16)
+        self.assertEqual(result.dark, result.offset * 10.0)
+
+        # Far fewer scans than a full sweep, and every one is recorded
+        self.assertLess(result.scans, 100)
+        self.assertEqual(result.trail[-1].gain, result.gain)
+        self.assertEqual(len(self.model.results), 0)
+
+    def test_unreachable_target(self):
+        result = self.calibrator.calibrate(dark_target=500,
+                                           peak_target=9000, max_rounds=2)
+        self.assertFalse(result.converged)
+        self.assertEqual(result.gain, 255)
+
+    def test_no_rounds(self):
+        self.assertRaises(ValueError, self.calibrator.calibrate,
+                          dark_target=500, peak_target=3000, max_rounds=0)
+
+    def test_cube_not_allowed(self):
+        self.model.cube = model.SweepCube([0], [0], pixels=2)
+        self.assertRaises(ValueError, calibrate.Calibrator, self.model,
+                          100, 98)
+
+if __name__ == "__main__":
+    unittest.main()
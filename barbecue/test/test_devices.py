@@ -0,0 +1,351 @@
+""" tests for the device layers of barbecue
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import numpy
+
+from barbecue import model
+from barbecue import devices
+from barbecue import storage
+
+class RecordingDevice(object):
+    """ Record every register write made to the device.
+    """
+    def __init__(self):
+        self.writes = []
+
+    def set_gain(self, gain):
+        self.writes.append(("gain", gain))
+        return True
+
+    def set_offset(self, offset):
+        self.writes.append(("offset", offset))
+        return True
+
+    def grab_pipe(self):
+        return True, [0, 1, 2]
+
+    def setup_pipe(self):
+        return True
+
+    def open_port(self):
+        return True
+
+    def start_scan(self):
+        return True
+
+    def close_pipe(self):
+        return True
+
+class TestRegisterShadow(unittest.TestCase):
+
+    def setUp(self):
+        self.device = RecordingDevice()
+
+    def test_redundant_writes_skipped(self):
+        shadow = devices.RegisterShadow(self.device)
+
+        # A gain sweep at one offset only writes the offset once
+        for gain in range(4):
+            self.assertTrue(shadow.set_gain(gain))
+            self.assertTrue(shadow.set_offset(10))
+
+        offsets = [write for write in self.device.writes
+                   if write[0] == "offset"]
+        self.assertEqual(offsets, [("offset", 10)])
+        self.assertEqual(shadow.issued, 5)
+        self.assertEqual(shadow.skipped, 3)
+
+        # Changed values are always written
+        shadow.set_offset(11)
+        self.assertEqual(self.device.writes[-1], ("offset", 11))
+
+    def test_verify_interval(self):
+        # Every third repeated write is issued to refresh the device
+        shadow = devices.RegisterShadow(self.device, verify_interval=3)
+        for _ in range(7):
+            shadow.set_gain(5)
+
+        self.assertEqual(self.device.writes, [("gain", 5)] * 3)
+        self.assertEqual(shadow.issued, 3)
+        self.assertEqual(shadow.skipped, 4)
+
+    def test_invalidate(self):
+        shadow = devices.RegisterShadow(self.device)
+        shadow.set_gain(5)
+        shadow.invalidate()
+        shadow.set_gain(5)
+        self.assertEqual(shadow.issued, 2)
+
+    def test_failed_write_is_not_shadowed(self):
+        def failing_write(value):
+            raise IOError("serial timeout")
+        self.device.set_gain = failing_write
+
+        shadow = devices.RegisterShadow(self.device)
+        self.assertRaises(IOError, shadow.set_gain, 5)
+        self.assertNotIn("gain", shadow.values)
+
+    def test_settle_after_large_jump(self):
+        shadow = devices.RegisterShadow(self.device, settle_delay=0.01,
+                                        settle_threshold=16)
+
+        # The first write and small steps do not settle
+        shadow.set_gain(0)
+        shadow.set_gain(16)
+        self.assertEqual(shadow.settles, 0)
+
+        # Jumping back to the start of the range does
+        shadow.set_gain(255)
+        shadow.set_gain(0)
+        self.assertEqual(shadow.settles, 2)
+        self.assertAlmostEqual(shadow.settle_time, 0.02)
+
+    def test_pass_through(self):
+        shadow = devices.RegisterShadow(self.device)
+        self.assertEqual(shadow.grab_pipe(), (True, [0, 1, 2]))
+
+class TestDeviceRegistry(unittest.TestCase):
+
+    def register(self, device_type, driver):
+        self.addCleanup(devices.DEVICES.pop, device_type)
+        devices.register(device_type, driver)
+
+    def test_unknown_device(self):
+        self.assertRaises(ValueError, devices.create, "KnownInvalid")
+        self.assertNotIn("KnownInvalid", devices.available())
+
+    def test_register_driver(self):
+        # A callable driver is given the device options
+        self.register("recording", lambda **options: options)
+        self.assertIn("recording", devices.available())
+        self.assertEqual(devices.create("recording", port=3), {"port": 3})
+
+        # A named driver is imported when created
+        self.register("small", "barbecue.devices:FastSimulatedCobra")
+        device = devices.create("small", pixels=16)
+        self.assertEqual(device.grab_pipe()[1].shape, (16,))
+
+    def test_model_assigns_registered_driver(self):
+        self.register("recording", RecordingDevice)
+        acquire_model = model.Model()
+        self.assertTrue(acquire_model.assign("recording"))
+        self.assertEqual(acquire_model.device, "recording")
+
+        acquire_model.scan(gain=1, offset=10, linetime=100, integration=98)
+        self.assertEqual(acquire_model.results[0].data, [0, 1, 2])
+
+    def test_drivers_imported_lazily(self):
+        # Importing the model does not import any hardware driver
+        code = "import sys; import barbecue.model; " \
+               "print('wasatchcameralink' in sys.modules)"
+        output = subprocess.check_output([sys.executable, "-c", code])
+        self.assertEqual(output.strip(), b"False")
+
+class TestDeviceSession(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+        def create_device():
+            device = RecordingDevice()
+            self.created.append(device)
+            return device
+        devices.register("recording", create_device)
+        self.addCleanup(devices.DEVICES.pop, "recording")
+        self.session = devices.DeviceSession("recording")
+
+    def test_shared_by_models(self):
+        # The device is opened once and stays open between sweeps
+        for _ in range(3):
+            acquire_model = model.Model()
+            self.assertTrue(acquire_model.attach(self.session))
+            acquire_model.scan(gain=1, offset=10, linetime=100,
+                               integration=98)
+            self.assertTrue(acquire_model.close_model())
+
+        self.assertEqual(len(self.created), 1)
+        self.assertEqual(self.session.opens, 1)
+        self.assertTrue(self.session.is_open)
+
+        # Register values carry over between sweeps
+        self.assertEqual(self.created[0].writes,
+                         [("gain", 1), ("offset", 10)])
+
+        self.session.close()
+        self.assertFalse(self.session.is_open)
+        self.assertFalse(self.session.check())
+
+    def test_model_settings_applied(self):
+        acquire_model = model.Model()
+        acquire_model.settle_delay = 0.5
+        acquire_model.attach(self.session)
+        self.assertEqual(self.session.device.settle_delay, 0.5)
+
+    def test_failed_health_check_reopens(self):
+        self.session.acquire()
+        def failing_grab():
+            raise IOError("Grab timeout")
+        self.created[0].grab_pipe = failing_grab
+
+        self.assertFalse(self.session.check())
+        self.session.acquire()
+        self.assertEqual(self.session.opens, 2)
+        self.assertTrue(self.session.check())
+
+class TestFastSimulatedCobra(unittest.TestCase):
+
+    def setUp(self):
+        self.device = devices.FastSimulatedCobra()
+
+    def test_line_interface(self):
+        self.assertTrue(self.device.setup_pipe())
+        self.assertTrue(self.device.set_gain(10))
+        self.assertTrue(self.device.set_offset(100))
+        result, line = self.device.grab_pipe()
+        self.assertTrue(result)
+        self.assertEqual(line.shape, (2048,))
+        self.assertEqual(line.dtype, numpy.uint16)
+        self.assertTrue(self.device.close_pipe())
+
+    def test_response(self):
+        # Gain scales the signal, offset moves the dark level, both are
+        # clipped to the 12 bit range and dead pixels read zero
+        row = self.device.grab_gain_row([0, 64, 255], 100).astype(float)
+        live = numpy.ones(2048, dtype=bool)
+        live[self.device.dead] = False
+
+        self.assertTrue(numpy.all(row[:, self.device.dead] == 0))
+        self.assertLess(row[0, live].mean(), row[1, live].mean())
+        self.assertEqual(row.max(), 4095)
+
+        low = self.device.grab_gain_row([0], 0)
+        self.assertEqual(low[:, live].min(), 0)
+        high = self.device.grab_gain_row([0], 255)
+        self.assertGreater(high[:, live].min(), 3000)
+
+    def test_gain_row_matches_lines(self):
+        device = devices.FastSimulatedCobra(pixels=64, noise=0)
+        row = device.grab_gain_row(range(4), 90)
+        for gain in range(4):
+            device.set_gain(gain)
+            device.set_offset(90)
+            numpy.testing.assert_array_equal(device.grab_pipe()[1], row[gain])
+
+        # The same seed simulates the same spectrometer
+        other = devices.FastSimulatedCobra(pixels=64, noise=0)
+        numpy.testing.assert_array_equal(other.grab_gain_row(range(4), 90),
+                                         row)
+
+    def test_latency(self):
+        device = devices.FastSimulatedCobra(pixels=8, grab_latency=0.01,
+                                            write_latency=0.01)
+        start = time.time()
+        device.set_gain(1)
+        device.grab_pipe()
+        self.assertGreaterEqual(time.time() - start, 0.02)
+
+    def test_fill_cube(self):
+        cube = model.SweepCube(offsets=range(3), gains=range(5), pixels=16)
+        devices.FastSimulatedCobra(pixels=16).fill(cube, 100, 98)
+        self.assertTrue(cube.measured().all())
+        self.assertEqual(cube.meta[2, 4]["offset"], 2)
+        self.assertEqual(cube.meta[2, 4]["linetime"], 100)
+
+    def test_model_assignment(self):
+        acquire_model = model.Model()
+        self.assertTrue(acquire_model.assign("fast"))
+        block, timing = acquire_model.scan_many(range(4), range(2), 100, 98)
+        self.assertEqual(block.shape, (2, 4, 2048))
+        self.assertTrue(acquire_model.close_model())
+
+class TestReplayCobra(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.file_name = os.path.join(temp_dir, "recorded.bbq")
+
+        # Record every other gain of a small sweep
+        self.recorded = model.SweepCube(offsets=[10, 11], gains=range(6),
+                                        pixels=16, filename=self.file_name)
+        simulated = devices.FastSimulatedCobra(pixels=16)
+        for offset in [10, 11]:
+            for gain in [0, 2, 4]:
+                line = simulated.grab_gain_row([gain], offset)[0]
+                self.recorded.store(gain, offset, 100, 98, line,
+                                    duration=0.01)
+        self.recorded.flush()
+
+    def test_replay_sweep(self):
+        # A sweep over the recorded settings reproduces the data
+        acquire_model = model.Model()
+        acquire_model.device_options = {"filename": self.file_name}
+        self.assertTrue(acquire_model.assign("replay"))
+
+        block, timing = acquire_model.scan_many([0, 2, 4], [10, 11], 100, 98)
+        numpy.testing.assert_array_equal(block,
+                                         self.recorded.data[:, [0, 2, 4]])
+        self.assertTrue(acquire_model.close_model())
+
+    def test_unrecorded_settings(self):
+        device = devices.ReplayCobra(self.file_name)
+
+        # Before any settings, the first recorded line is returned
+        self.assertEqual(list(device.grab_pipe()[1]),
+                         list(self.recorded.data[0, 0]))
+
+        device.set_offset(10)
+        device.set_gain(1)
+        self.assertRaises(ValueError, device.grab_pipe)
+        device.set_gain(200)
+        self.assertRaises(ValueError, device.grab_pipe)
+
+        self.assertRaises(ValueError, model.Model().assign, "replay")
+
+    def test_csv_source(self):
+        csv_name = self.file_name.replace(".bbq", ".csv")
+        csv_file = open(csv_name, "w")
+        storage.write_header(csv_file)
+        for group in self.recorded.groups():
+            storage.write_group(csv_file, group)
+        csv_file.close()
+
+        # The converted sweep is mapped to a file removed on close
+        device = devices.ReplayCobra(csv_name)
+        self.assertIsInstance(device.cube.data, numpy.memmap)
+        self.assertTrue(os.path.exists(device.temp_name))
+        numpy.testing.assert_array_equal(device.cube.data,
+                                         self.recorded.data[:, [0, 2, 4]])
+
+        device.set_offset(11)
+        device.set_gain(4)
+        self.assertEqual(list(device.grab_pipe()[1]),
+                         list(self.recorded.data[1, 4]))
+
+        temp_name = device.temp_name
+        self.assertTrue(device.close_pipe())
+        self.assertFalse(os.path.exists(temp_name))
+
+    def test_paced(self):
+        # Each grab takes the recorded scan time, divided by the speed
+        device = devices.ReplayCobra(self.file_name, paced=True)
+        start = time.time()
+        for _ in range(4):
+            device.grab_pipe()
+        self.assertGreaterEqual(time.time() - start, 0.03)
+
+        device = devices.ReplayCobra(self.file_name, paced=True, speed=10)
+        start = time.time()
+        for _ in range(4):
+            device.grab_pipe()
+        self.assertLess(time.time() - start, 0.02)
+
+if __name__ == "__main__":
+    unittest.main()
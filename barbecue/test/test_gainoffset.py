@@ -16,8 +16,12 @@ import sys
 import logging
 import unittest
 
+import numpy
+
 from PyQt4 import QtGui, QtTest, QtCore
 
+from barbecue import model
+from barbecue import devices
 from barbecue import gain_offset_controller
 from barbecue import GainOffset
 
@@ -278,6 +282,43 @@ class TestGainOffsetControllerView(unittest.TestCase):
         end_data = plot.get_items()[1].get_data(0,0)
         self.assertNotEqual(start_data, end_data)
 
+    def test_image_is_view_of_stored_group(self):
+        # The clicked offset group is shown without copying its data
+        cube = model.SweepCube(offsets=[5], gains=range(4), pixels=16)
+        cube.data[0] = numpy.arange(64).reshape(4, 16)
+        dm = self.form.datamod
+        dm.add_rows(dm.add_sweep(cube), [0])
+
+        self.form.results_to_image(0)
+        image = self.form.ui.image_dialog.get_plot().get_items()[1]
+        self.assertEqual(image.data.dtype, numpy.uint16)
+        self.assertTrue(numpy.may_share_memory(image.data, cube.data))
+
+    def test_tree_rows_read_from_storage(self):
+        # Rows of each sweep are generated from its storage, in the order
+        # they were added, with computed summary columns
+        dm = self.form.datamod
+        first = model.SweepCube(offsets=[1, 2, 3], gains=range(2), pixels=4)
+        first.store(0, 3, 100, 98, [10, 20, 4095, 4095])
+        second = model.SweepCube(offsets=[7, 8], gains=range(2), pixels=4)
+
+        first_sweep = dm.add_sweep(first, ordered=False)
+        dm.add_rows(dm.add_sweep(second), range(2))
+        dm.add_rows(first_sweep, [2, 0])
+
+        self.assertEqual(dm.rowCount(), 4)
+        self.assertEqual(dm.columnCount(), 5)
+        offsets = [dm.data(dm.index(row, 0)) for row in range(4)]
+        self.assertEqual(offsets, ["3", "1", "7", "8"])
+        self.assertEqual(dm.headerData(4, QtCore.Qt.Horizontal),
+                         "Saturated")
+
+        self.assertEqual(dm.data(dm.index(0, 2)), "2055.0")
+        self.assertEqual(dm.data(dm.index(0, 3)), "4095")
+        self.assertEqual(dm.data(dm.index(0, 4)), "50.0%")
+        self.assertEqual(dm.group(3).offset, 8)
+        self.assertEqual(len(dm.group_ref(0)), 2)
+
     def test_progress_bar(self):
         # On startup, progress bar is disabled
         pg = self.form.ui.progressBar
@@ -320,6 +361,117 @@ class TestGainOffsetControllerView(unittest.TestCase):
         self.assertEqual(second_pg_val, third_pg_val)
         log.info("Values: %s, %s " % (first_pg_val, second_pg_val))
 
+    def test_acquisition_runs_in_worker(self):
+        # The sweep runs in a worker thread, and stopping it cancels
+        # between individual scans rather than at the end of an offset
+        self.form.ui.spinBoxOffsetStart.setValue(0)
+        self.form.ui.spinBoxOffsetEnd.setValue(200)
+        self.form.ui.spinBoxGainStart.setValue(0)
+        self.form.ui.spinBoxGainEnd.setValue(255)
+
+        self.form.ui.toolButtonStart.click()
+        self.assertTrue(self.form.worker.isRunning())
+
+        QtTest.QTest.qWait(100)
+        self.form.ui.toolButtonStop.click()
+        self.assertIsNone(self.form.worker)
+
+        # No more results arrive after the stop
+        rows = self.form.datamod.rowCount()
+        QtTest.QTest.qWait(500)
+        self.assertEqual(self.form.datamod.rowCount(), rows)
+        self.assertLess(rows, 201)
+
+    def test_stopped_sweep_keeps_measured_offsets(self):
+        # A gain major sweep only reports offsets at the end, the scans
+        # taken before a stop are still listed
+        self.form.sweep_strategy = "gain_major"
+        self.form.ui.spinBoxOffsetStart.setValue(0)
+        self.form.ui.spinBoxOffsetEnd.setValue(200)
+        self.form.ui.spinBoxGainStart.setValue(0)
+        self.form.ui.spinBoxGainEnd.setValue(255)
+
+        self.form.ui.toolButtonStart.click()
+        QtTest.QTest.qWait(300)
+        self.form.ui.toolButtonStop.click()
+
+        cube = self.form.acquire_model.cube
+        measured = cube.measured().any(axis=1).sum()
+        self.assertGreater(measured, 0)
+        self.assertEqual(self.form.datamod.rowCount(), measured)
+
+    def test_dark_pixel_averaging(self):
+        # The checkbox enables the per-line dark estimate
+        self.form.ui.spinBoxOffsetEnd.setValue(1)
+        self.form.ui.spinBoxGainEnd.setValue(3)
+        self.form.ui.checkBoxDarkPixelAveragin.setChecked(True)
+
+        self.form.ui.toolButtonStart.click()
+        self.form.worker.wait()
+        self.assertTrue(self.form.acquire_model.dark_correction)
+
+        dark = self.form.acquire_model.cube.meta["dark"]
+        self.assertTrue((dark >= 0).all())
+
+    def test_live_image_during_sweep(self):
+        # Scanned gain rows are copied into the live image, which is
+        # replotted on a timer rather than for every scan
+        self.form.ui.spinBoxOffsetEnd.setValue(1)
+        self.form.ui.spinBoxGainEnd.setValue(3)
+        self.form.live_fps = 20
+
+        self.form.ui.toolButtonStart.click()
+        self.assertTrue(self.form.live_timer.isActive())
+        self.assertEqual(self.form.live_timer.interval(), 50)
+        self.assertEqual(self.form.live_buffer.shape, (4, 2048))
+
+        self.form.worker.wait()
+        QtTest.QTest.qWait(200)
+        self.assertFalse(self.form.live_timer.isActive())
+        self.assertEqual(self.form.live_pending, [])
+        self.assertEqual(self.form.live_offset, 1)
+
+        cube = self.form.acquire_model.cube
+        self.assertTrue((self.form.live_buffer == cube.data[1]).all())
+
+        # The live image can be turned off
+        self.form.live_fps = 0
+        self.form.ui.toolButtonStart.click()
+        self.assertFalse(self.form.live_timer.isActive())
+        self.form.worker.wait()
+
+    def test_device_open_error(self):
+        # A device that fails to open is reported in the interface
+        self.form.device_session = devices.DeviceSession("KnownInvalid")
+        self.form.ui.spinBoxOffsetEnd.setValue(1)
+        self.form.ui.spinBoxGainEnd.setValue(3)
+
+        self.form.ui.toolButtonStart.click()
+        self.form.worker.wait()
+        QtTest.QTest.qWait(200)
+
+        self.assertIn("KnownInvalid", self.form.worker.error_message)
+        text = str(self.form.ui.labelProcessing.text())
+        self.assertTrue(text.startswith("Acquisition failed"))
+        self.assertEqual(self.form.datamod.rowCount(), 0)
+
+    def test_device_session_reused(self):
+        # Later sweeps use the device opened by the first, which is
+        # closed with the window
+        self.form.ui.spinBoxOffsetEnd.setValue(1)
+        self.form.ui.spinBoxGainEnd.setValue(3)
+
+        for _ in range(2):
+            self.form.ui.toolButtonStart.click()
+            self.form.worker.wait()
+
+        session = self.form.device_session
+        self.assertTrue(session.is_open)
+        self.assertEqual(session.opens, 1)
+
+        self.form.close()
+        self.assertFalse(session.is_open)
+
     def test_save_results_use_progress_bar(self):
         # setup a long scan for saving data
         self.form.ui.spinBoxOffsetStart.setValue(0)
@@ -348,9 +500,10 @@ class TestGainOffsetControllerView(unittest.TestCase):
 
         # Choose the file, make sure the summary text is updated
         self.form.load_file(file_name)
-        QtTest.QTest.qWait(100)
     
-        # get the read from the progress bar near the start
+        # get the read from the progress bar near the start. Only the
+        # index is built while loading, so read it before the event
+        # loop runs the remaining chunks
         start_progress = self.form.ui.progressBar.value()
         
         # as the file loads, read the progress bar , make sure they are
@@ -367,7 +520,7 @@ class TestGainOffsetControllerView(unittest.TestCase):
             
         # verify the offset value is read from the file to the datamodel
         # correctly
-        new_offset = self.form.datamod.item(0, 0).text()
+        new_offset = dm.data(dm.index(0, 0))
         self.assertEqual(new_offset, "0")
 
         # Verify that the image data changes when the entry is clicked
@@ -1,9 +1,16 @@
 """ tests for datamodel of barbecue
 """
 
+import os
+import shutil
+import tempfile
 import unittest
 
+import numpy
+
 from barbecue import model
+from barbecue import sweep
+from barbecue.test import helpers
 
 class Test(unittest.TestCase):
 
@@ -58,8 +65,285 @@ class Test(unittest.TestCase):
         self.assertEqual(last_result.linetime, 100)
         self.assertEqual(last_result.integration, 98)
         self.assertEqual(len(last_result.data), 2048)
+        self.assertGreaterEqual(last_result.duration, 0)
+
+    def test_scan_into_cube(self):
+        # With a cube allocated, scans are written directly into it and
+        # the results list stays empty
+        self.model.assign("single")
+        cube = self.model.allocate(offsets=range(10, 12), gains=range(4))
+        self.assertEqual(cube.data.shape, (2, 4, 2048))
+        self.assertEqual(cube.data.dtype, numpy.uint16)
+
+        self.model.scan(gain=1, offset=11, linetime=100, integration=98)
+        self.assertEqual(len(self.model.results), 0)
+
+        cell = cube.meta[1, 1]
+        self.assertGreaterEqual(cell["duration"], 0)
+        self.assertEqual(cell["gain"], 1)
+        self.assertEqual(cell["offset"], 11)
+        self.assertEqual(cell["linetime"], 100)
+        self.assertEqual(cell["integration"], 98)
+
+        # Unmeasured cells keep the default metadata
+        self.assertEqual(cube.meta[0, 0]["gain"], -1)
+        self.assertTrue(self.model.close_model())
+
+    def test_cube_group_view(self):
+        # A group is a list-like view of results at a single offset
+        cube = model.SweepCube(offsets=[5, 6], gains=[0, 1, 2], pixels=8)
+        cube.store(2, 6, 100, 98, numpy.arange(8))
+
+        group = cube.group(6)
+        self.assertEqual(group.offset, 6)
+        self.assertEqual(len(group), 3)
+        self.assertEqual(group.data.shape, (3, 8))
+
+        last_result = group[2]
+        self.assertEqual(last_result.gain, 2)
+        self.assertEqual(last_result.offset, 6)
+        self.assertEqual(list(last_result.data), list(range(8)))
+
+        # Writing through the group data modifies the cube
+        group.data[0, 0] = 42
+        self.assertEqual(cube.data[1, 0, 0], 42)
+
+        # A full sweep is a few hundred megabytes, not gigabytes. The
+        # cube is mapped to a sparse file, so no memory is allocated.
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        full = model.SweepCube(offsets=range(256), gains=range(256),
+                               pixels=2048,
+                               filename=os.path.join(temp_dir, "full.bbq"))
+        self.assertGreater(full.nbytes, 256 * 1024 * 1024)
+        self.assertLess(full.nbytes, 300 * 1024 * 1024)
+        del full
+
+    def test_group_summary(self):
+        # Only measured lines count towards the summary columns
+        cube = model.SweepCube(offsets=[5], gains=[0, 1, 2], pixels=4)
+        group = cube.group(5)
+        self.assertEqual(group.summary(), (0.0, 0.0, 0.0))
+
+        cube.store(0, 5, 100, 98, [10, 20, 30, 40])
+        cube.store(2, 5, 100, 98, [4095, 4095, 100, 0])
+        mean, maximum, saturated = group.summary()
+        self.assertAlmostEqual(mean, (100 + 8290) / 8.0)
+        self.assertEqual(maximum, 4095)
+        self.assertEqual(saturated, 0.25)
+        self.assertEqual(group.summary(full_scale=100)[2], 0.375)
+
+    def test_register_writes_coalesced(self):
+        # A gain sweep at a single offset only writes the offset once
+        self.model.assign("single")
+        for gain in range(4):
+            self.model.scan(gain=gain, offset=10, linetime=100,
+                            integration=98)
+
+        self.assertEqual(self.model._dev.issued, 5)
+        self.assertEqual(self.model._dev.skipped, 3)
+        self.assertTrue(self.model.close_model())
+
+    def test_scan_many(self):
+        scan_many = self.model.scan_many
+        # Attempt to scan before device assignment, fail
+        self.assertRaises(ValueError, scan_many, range(2), range(2), 100, 98)
+
+        self.model.assign("single")
+        self.assertRaises(ValueError, scan_many, [], range(2), 100, 98)
+
+        # Without a cube, a new block is filled and returned
+        block, timing = scan_many(range(3), range(10, 12), 100, 98)
+        self.assertEqual(block.shape, (2, 3, 2048))
+        self.assertEqual(len(self.model.results), 0)
+        self.assertEqual(timing["scans"], 6)
+        self.assertEqual(timing["durations"].shape, (2, 3))
+        self.assertLessEqual(timing["min"], timing["mean"])
+        self.assertLessEqual(timing["mean"], timing["max"])
+        self.assertFalse(timing["cancelled"])
+
+        # A caller supplied block is filled in place
+        out = numpy.zeros((1, 2, 2048), dtype=numpy.uint16)
+        block, timing = scan_many([0, 1], [10], 100, 98, out=out)
+        self.assertIs(block, out)
+        self.assertGreater(out.max(), 0)
+        self.assertTrue(self.model.close_model())
+
+    def test_scan_many_into_cube(self):
+        # With a cube allocated, every cell of the grid is stored in it
+        self.model.assign("single")
+        cube = self.model.allocate(offsets=range(10, 13), gains=range(4))
+
+        scanned = []
+        block, timing = self.model.scan_many(
+            gains=[1, 3], offsets=[10, 12], linetime=100, integration=98,
+            callback=lambda offset, gain: scanned.append((offset, gain)))
+        self.assertIs(block, cube)
+        self.assertEqual(scanned, [(10, 1), (10, 3), (12, 1), (12, 3)])
+        self.assertEqual(cube.measured().sum(), 4)
+        self.assertEqual(cube.meta[2, 3]["offset"], 12)
+        self.assertEqual(cube.meta[2, 3]["linetime"], 100)
+        self.assertGreaterEqual(cube.meta[2, 3]["duration"], 0)
+        self.assertTrue(self.model.close_model())
+
+    def test_scan_many_cancel(self):
+        # The grid stops at the first scan after cancellation
+        self.model.assign("single")
+        cube = self.model.allocate(offsets=range(2), gains=range(4))
+        stop = helpers.StopAfter(5)
+        block, timing = self.model.scan_many(range(4), range(2), 100, 98,
+                                             callback=stop.scanned,
+                                             cancel=stop)
+        self.assertTrue(timing["cancelled"])
+        self.assertEqual(timing["scans"], 5)
+        self.assertEqual(cube.measured().sum(), 5)
+        self.assertTrue(self.model.close_model())
+
+    def test_saturated_rows_stop_early(self):
+        # High offsets saturate within a few gains, and the rest of the
+        # row is marked as clipped rather than scanned
+        self.model.assign("fast")
+        cube = self.model.allocate(offsets=[100, 255], gains=range(256))
+        policy = sweep.SaturationStop(consecutive=4)
+        block, timing = self.model.scan_many(range(256), [100, 255], 100, 98,
+                                             policy=policy)
+
+        self.assertEqual(timing["scans"], cube.measured().sum())
+        self.assertLess(cube.measured()[1].sum(), 160)
+        self.assertTrue(cube.measured()[0].all())
+        self.assertFalse(cube.clipped()[0].any())
+
+        clipped = cube.clipped()[1]
+        self.assertEqual(clipped.sum() + cube.measured()[1].sum(), 256)
+        self.assertFalse(cube.measured()[1][clipped].any())
+        self.assertTrue(clipped[-1])
+        numpy.testing.assert_array_equal(timing["clipped"], cube.clipped())
+        numpy.testing.assert_array_equal(cube.group(255).clipped_gains(),
+                                         cube.gains[clipped])
+        self.assertTrue(self.model.close_model())
+
+    def test_dark_correction(self):
+        # The dark level of each line is the mean of its masked pixels,
+        # and the raw data is stored unchanged
+        self.model.assign("fast")
+        self.model.dark_correction = True
+        cube = self.model.allocate(offsets=[100, 120], gains=range(2))
+        self.model.scan_many(range(2), [100, 120], 100, 98)
+
+        dark = cube.meta["dark"]
+        self.assertTrue(numpy.all(dark > 0))
+        self.assertGreater(dark[1, 0], dark[0, 0])
+        self.assertEqual(cube.data.dtype, numpy.uint16)
+        expected = cube.data[:, :, 0:16].mean(axis=-1)
+        numpy.testing.assert_allclose(dark, expected, rtol=1e-5)
+
+        # The corrected masked pixels are close to zero
+        corrected = cube.corrected()
+        self.assertEqual(corrected.dtype, numpy.float32)
+        self.assertLess(abs(corrected[:, :, 0:16].mean()), 1)
+        numpy.testing.assert_allclose(cube.group(120).corrected(),
+                                      corrected[1])
+        self.assertEqual(cube.group(120)[1].dark, dark[1, 1])
+        self.assertTrue(self.model.close_model())
+
+        # A new array keeps the sensor dtype, as the dark estimate is not
+        # stored with it
+        self.model.assign("fast")
+        self.model.cube = None
+        block, timing = self.model.scan_many(range(2), [100], 100, 98)
+        self.assertEqual(block.dtype, numpy.uint16)
+        self.assertTrue(self.model.close_model())
+
+        # Lines without an estimate are unchanged
+        cube = model.SweepCube(offsets=[0], gains=[0], pixels=4)
+        cube.data[0, 0] = [1, 2, 3, 4]
+        self.assertEqual(list(cube.corrected()[0, 0]), [1, 2, 3, 4])
+
+    def test_frame_averaging(self):
+        # Several frames per scan are reduced to the mean and statistics
+        self.model.assign("single")
+        self.model.frames = 4
+        result = self.model.scan(gain=1, offset=10, linetime=100,
+                                 integration=98)
+
+        last_result = self.model.results[-1]
+        self.assertEqual(last_result.frames, 4)
+        self.assertEqual(len(last_result.data), 2048)
+        self.assertEqual(len(last_result.std), 2048)
+        self.assertTrue(numpy.all(last_result.minimum <= last_result.data))
+        self.assertTrue(numpy.all(last_result.maximum >= last_result.data))
+
+        # The frame buffer is reused between scans
+        frame_buffer = self.model._frame_buffer
+        self.model.scan(gain=2, offset=10, linetime=100, integration=98)
+        self.assertIs(self.model._frame_buffer, frame_buffer)
+
+        # The allocated cube holds float means and the statistics
+        cube = self.model.allocate(offsets=[10], gains=[1])
+        self.assertTrue(cube.statistics)
+        self.assertEqual(cube.data.dtype, numpy.float32)
+        self.model.scan(gain=1, offset=10, linetime=100, integration=98)
+        self.assertEqual(cube.meta[0, 0]["frames"], 4)
+        self.assertEqual(cube.group(10)[0].frames, 4)
+        self.assertEqual(cube.group(10).std.shape, (1, 2048))
+        self.assertTrue(self.model.close_model())
+
+        # Frames, minimum and maximum stay in the sensor dtype
+        self.assertEqual(frame_buffer.dtype, numpy.uint16)
+        self.assertEqual(cube.minimum.dtype, numpy.uint16)
+        self.assertEqual(cube.maximum.dtype, numpy.uint16)
+        self.assertEqual(cube.std.dtype, numpy.float16)
+
+    def test_memory_mapped_statistics(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        file_name = os.path.join(temp_dir, "sweep.bbq")
+
+        cube = model.SweepCube(offsets=[0], gains=[0, 1], pixels=3,
+                               dtype=numpy.float32, filename=file_name,
+                               statistics=True)
+        cube.store(1, 0, 100, 98, [1.5, 2, 3], frames=8, std=[1, 1, 1],
+                   minimum=[0, 1, 2], maximum=[3, 3, 4])
+        cube.flush()
+        del cube
+
+        cube = model.SweepCube.open(file_name)
+        self.assertTrue(cube.statistics)
+        result = cube.group(0)[1]
+        self.assertEqual(result.frames, 8)
+        self.assertEqual(list(result.data), [1.5, 2, 3])
+        self.assertEqual(list(result.maximum), [3, 3, 4])
+
+    def test_memory_mapped_cube(self):
+        # A file backed cube is written through to disk, and can be
+        # reopened without parsing any of the data
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        file_name = os.path.join(temp_dir, "sweep.bbq")
+
+        cube = model.SweepCube(offsets=range(3), gains=range(4), pixels=16,
+                               filename=file_name)
+        self.assertTrue(model.is_sweep_file(file_name))
+        self.assertEqual(cube.meta[2, 3]["gain"], -1)
+
+        cube.store(3, 2, 100, 98, numpy.arange(16))
+        cube.flush()
+        del cube
+
+        cube = model.SweepCube.open(file_name)
+        self.assertEqual(list(cube.offsets), [0, 1, 2])
+        self.assertEqual(list(cube.gains), [0, 1, 2, 3])
+        self.assertEqual(cube.data.dtype, numpy.uint16)
+        self.assertEqual(list(cube.group(2)[3].data), list(range(16)))
+        self.assertEqual(cube.meta[2, 3]["linetime"], 100)
+        self.assertEqual(cube.meta[0, 0]["gain"], -1)
+
+        # Not a sweep file
+        other = os.path.join(temp_dir, "other.csv")
+        open(other, "w").write("Offset,Gain\n")
+        self.assertFalse(model.is_sweep_file(other))
+        self.assertRaises(ValueError, model.SweepCube.open, other)
 
-    
 if __name__ == "__main__":
     unittest.main()
     
@@ -0,0 +1,209 @@
+""" tests for pipelined acquisition
+"""
+
+import time
+import unittest
+import threading
+
+import numpy
+
+from barbecue import model
+from barbecue import sweep
+from barbecue import devices
+from barbecue import pipeline
+from barbecue.test import helpers
+
+class SettingsDevice(object):
+    """ Return lines that encode the gain and offset at the time of the
+    grab, so out of order writes and grabs are detected.
+    """
+    def __init__(self, fail_after=None):
+        self.gain = 0
+        self.offset = 0
+        self.grabs = 0
+        self.fail_after = fail_after
+
+    def set_gain(self, gain):
+        self.gain = gain
+        return True
+
+    def set_offset(self, offset):
+        self.offset = offset
+        return True
+
+    def grab_pipe(self):
+        self.grabs += 1
+        if self.fail_after is not None and self.grabs > self.fail_after:
+            raise IOError("Grab timeout")
+        line = [self.offset * 1000 + self.gain + frame
+                for frame in (self.grabs % 2, 0, 0)]
+        return True, line
+
+def settings_model(device):
+    """ Return a model with the device assigned.
+    """
+    acquire_model = model.Model()
+    acquire_model.device = "settings"
+    acquire_model._dev = devices.RegisterShadow(device)
+    return acquire_model
+
+class TestPipelinedScanner(unittest.TestCase):
+
+    def test_requires_device(self):
+        scanner = pipeline.PipelinedScanner(model.Model())
+        self.assertRaises(ValueError, scanner.scan_many, range(2), range(2),
+                          100, 98)
+
+    def test_matches_serial_scan(self):
+        # Every cell is stored with the data grabbed at its settings
+        acquire_model = settings_model(SettingsDevice())
+        cube = acquire_model.allocate(offsets=range(3), gains=range(5),
+                                      pixels=3)
+        scanned = []
+        scanner = pipeline.PipelinedScanner(acquire_model, depth=2)
+        block, timing = scanner.scan_many(
+            range(5), range(3), 100, 98,
+            callback=lambda offset, gain: scanned.append((offset, gain)))
+
+        self.assertIs(block, cube)
+        self.assertEqual(timing["scans"], 15)
+        self.assertFalse(timing["cancelled"])
+        self.assertEqual(scanned, [(offset, gain) for offset in range(3)
+                                   for gain in range(5)])
+        self.assertTrue(cube.measured().all())
+
+        expected = numpy.arange(3)[:, None] * 1000 + numpy.arange(5)
+        numpy.testing.assert_array_equal(cube.data[:, :, 1], expected)
+        self.assertEqual(cube.meta[2, 4]["linetime"], 100)
+
+    def test_frame_averaging(self):
+        # Frames are reduced on the storing thread
+        acquire_model = settings_model(SettingsDevice())
+        acquire_model.frames = 2
+        scanner = pipeline.PipelinedScanner(acquire_model)
+        block, timing = scanner.scan_many([3], [1], 100, 98)
+
+        self.assertEqual(block.dtype, numpy.float32)
+        self.assertEqual(list(block[0, 0]), [1003.5, 1003, 1003])
+
+    def test_cancel(self):
+        acquire_model = settings_model(SettingsDevice())
+        cube = acquire_model.allocate(offsets=range(4), gains=range(4),
+                                      pixels=3)
+        scanner = pipeline.PipelinedScanner(acquire_model, depth=1)
+        stop = helpers.StopAfter(3)
+        block, timing = scanner.scan_many(range(4), range(4), 100, 98,
+                                          callback=stop.scanned, cancel=stop)
+        self.assertTrue(timing["cancelled"])
+        self.assertEqual(timing["scans"], 3)
+        self.assertEqual(cube.measured().sum(), 3)
+
+    def test_saturated_rows_stop_early(self):
+        # Lines from gain 3 of offset 2 are at full scale, so the device
+        # stage skips the rest of that row
+        acquire_model = settings_model(SettingsDevice())
+        cube = acquire_model.allocate(offsets=range(3), gains=range(16),
+                                      pixels=3)
+        policy = sweep.SaturationStop(consecutive=2, full_scale=2003)
+        scanner = pipeline.PipelinedScanner(acquire_model, depth=2)
+        block, timing = scanner.scan_many(range(16), range(3), 100, 98,
+                                          policy=policy)
+
+        self.assertFalse(timing["cancelled"])
+        self.assertTrue(cube.measured()[0:2].all())
+        self.assertTrue(cube.measured()[2, 0:5].all())
+        self.assertLess(timing["scans"], 48)
+
+        # Every cell of the row is either scanned or clipped
+        row = cube.measured()[2] | cube.clipped()[2]
+        self.assertTrue(row.all())
+        self.assertTrue(cube.clipped()[2, -1])
+        self.assertFalse(cube.clipped()[0:2].any())
+
+    def test_device_error(self):
+        # A failed grab is raised on the calling thread
+        acquire_model = settings_model(SettingsDevice(fail_after=4))
+        scanner = pipeline.PipelinedScanner(acquire_model)
+        self.assertRaises(IOError, scanner.scan_many, range(4), range(4),
+                          100, 98)
+
+    def test_cancel_slow_device(self):
+        # A cancel is seen while the device is still grabbing
+        device = devices.FastSimulatedCobra(pixels=16, grab_latency=0.5)
+        acquire_model = settings_model(device)
+        acquire_model.allocate(offsets=[64], gains=range(4), pixels=16)
+        scanner = pipeline.PipelinedScanner(acquire_model)
+
+        cancel = threading.Event()
+        timer = threading.Timer(0.1, cancel.set)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        block, timing = scanner.scan_many(range(4), [64], 100, 98,
+                                          cancel=cancel)
+        self.assertTrue(timing["cancelled"])
+        self.assertEqual(timing["scans"], 0)
+
+    def test_writes_overlap_grabs(self):
+        # A triggered device takes the settings at the start of the grab,
+        # so the next writes overlap the read out and the pipelined sweep
+        # takes about the grab time per scan, not write plus grab
+        def sweep_time(scanner_class):
+            device = devices.FastSimulatedCobra(pixels=16, noise=0,
+                                                write_latency=0.02,
+                                                grab_latency=0.02)
+            acquire_model = settings_model(device)
+            cube = acquire_model.allocate(offsets=[60, 64], gains=range(10),
+                                          pixels=16)
+            start = time.time()
+            scanner_class(acquire_model).scan_sweep(
+                sweep.create("raster", [60, 64], range(10)), 100, 98)
+            return time.time() - start, cube
+
+        serial, serial_cube = sweep_time(lambda acquire_model:
+                                         acquire_model)
+        piped, piped_cube = sweep_time(pipeline.PipelinedScanner)
+        self.assertLess(piped, 0.75 * serial)
+        numpy.testing.assert_array_equal(piped_cube.data, serial_cube.data)
+
+    def test_sweep_blocks(self):
+        # One pipeline runs the whole sweep, and every block is reported
+        # in order once stored
+        acquire_model = settings_model(SettingsDevice())
+        cube = acquire_model.allocate(offsets=range(3), gains=range(4),
+                                      pixels=3)
+        completed = []
+
+        def block_complete(offsets, gains):
+            completed.append(list(offsets))
+            self.assertTrue(cube.measured()[list(offsets)].all())
+
+        strategy = sweep.create("serpentine", range(3), range(4))
+        scanner = pipeline.PipelinedScanner(acquire_model)
+        timing = scanner.scan_sweep(strategy, 100, 98,
+                                    block_complete=block_complete)
+        self.assertEqual(timing["scans"], 12)
+        self.assertEqual(completed, [[0], [1], [2]])
+
+        expected = numpy.arange(3)[:, None] * 1000 + numpy.arange(4)
+        numpy.testing.assert_array_equal(cube.data[:, :, 1], expected)
+
+    def test_adaptive_sweep(self):
+        # Blocks that use results are requested once the previous ones
+        # are stored, so the cells scanned match a serial sweep
+        def adaptive_cube(scanner_class):
+            acquire_model = settings_model(devices.FastSimulatedCobra(
+                pixels=64))
+            cube = acquire_model.allocate(offsets=range(0, 256, 4),
+                                          gains=range(0, 256, 4), pixels=64)
+            strategy = sweep.create("adaptive", cube.offsets, cube.gains,
+                                    step=4)
+            scanner_class(acquire_model).scan_sweep(strategy, 100, 98)
+            return cube
+
+        serial = adaptive_cube(lambda acquire_model: acquire_model)
+        piped = adaptive_cube(pipeline.PipelinedScanner)
+        numpy.testing.assert_array_equal(piped.measured(), serial.measured())
+        self.assertLess(piped.measured().sum(), piped.measured().size)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+""" tests for rate limited progress reporting
+"""
+
+import unittest
+
+from barbecue import progress
+
+class FakeClock(object):
+    """ Return a time that only changes when the test advances it.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class TestProgressReporter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.reports = []
+        self.reporter = progress.ProgressReporter(self.record, max_rate=10.0,
+                                                  clock=self.clock)
+
+    def record(self, reporter):
+        self.reports.append((reporter.count, reporter.percent,
+                             reporter.describe()))
+
+    def test_rate_limited(self):
+        # The first operation is reported, then at most ten a second
+        self.reporter.start(1000, unit="scans")
+        self.assertEqual(self.reports, [])
+
+        for count in range(100):
+            self.reporter.add()
+        self.assertEqual(len(self.reports), 1)
+        self.assertEqual(self.reports[0][0], 1)
+
+        self.clock.now += 0.05
+        self.reporter.add()
+        self.assertEqual(len(self.reports), 1)
+
+        self.clock.now += 0.06
+        self.reporter.add(9)
+        self.assertEqual(len(self.reports), 2)
+        self.assertEqual(self.reports[1][0], 110)
+
+    def test_unlimited(self):
+        # A zero rate reports every operation
+        self.reporter.max_rate = 0
+        self.reporter.start(4)
+        for count in range(4):
+            self.reporter.add()
+        self.assertEqual([report[0] for report in self.reports],
+                         [1, 2, 3, 4])
+
+    def test_throughput_and_eta(self):
+        self.reporter.start(1000, "Scanning", "scans")
+        self.assertIsNone(self.reporter.remaining)
+
+        self.clock.now += 10.0
+        self.reporter.add(250)
+        self.assertEqual(self.reporter.rate, 25.0)
+        self.assertEqual(self.reporter.remaining, 30.0)
+        self.assertEqual(self.reporter.percent, 25.0)
+        self.assertEqual(self.reports[-1][2],
+                         "Scanning: 250/1000 scans, 25.0 scans/s, "
+                         "elapsed 0:00:10, ETA 0:00:30")
+
+    def test_finish(self):
+        # Finishing before the total shows completion
+        self.reporter.start(1000, unit="scans")
+        self.clock.now += 4.0
+        self.reporter.add(100)
+        self.reporter.finish()
+        self.assertEqual(self.reporter.percent, 100.0)
+        self.assertEqual(self.reports[-1][2],
+                         "Done 100 scans in 0:00:04, 25.0 scans/s")
+
+    def test_format_seconds(self):
+        self.assertEqual(progress.format_seconds(3725.2), "1:02:05")
+        self.assertEqual(progress.format_seconds(None), "-:--:--")
+
+if __name__ == "__main__":
+    unittest.main()
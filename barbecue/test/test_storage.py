@@ -0,0 +1,366 @@
+""" tests for the sweep results file formats of barbecue
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from barbecue import model
+from barbecue import storage
+
+class TestCSVWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.cube = model.SweepCube(offsets=[0, 1], gains=[0, 1, 2],
+                                    pixels=4)
+        for gain in range(3):
+            data = numpy.arange(4) + gain * 10
+            self.cube.store(gain, 1, 100, 98, data)
+
+    def reference_lines(self, results):
+        """ Helper function to format results one value at a time, the
+        way the original writer did.
+        """
+        lines = ""
+        for result in results:
+            lines += "%s," % result.offset
+            lines += "%s," % result.gain
+            lines += "%s," % result.linetime
+            lines += "%s," % result.integration
+            for pixel in result.data:
+                lines += "%s," % pixel
+            lines += "\n"
+        return lines
+
+    def test_header(self):
+        written = []
+        storage.write_header(DummyFile(written))
+        head_str = "Offset,Gain,Line Time,Integration Time,Data\n"
+        self.assertEqual("".join(written), head_str)
+
+    def test_group_matches_per_value_format(self):
+        group = self.cube.group(1)
+        text = storage.format_table(storage.group_table(group))
+        self.assertEqual(text, self.reference_lines(group))
+        self.assertTrue(text.startswith("1,0,100,98,0,1,2,3,\n"))
+
+    def test_result_list_matches_per_value_format(self):
+        # Lists of results with float data, as built by the old loader
+        results = [model.Result(0, 5, 100, 98, [1.0, 2.5, 3.0]),
+                   model.Result(1, 5, 100, 98, [4.0, 5.0, 6.25])]
+        text = storage.format_table(storage.group_table(results))
+        self.assertEqual(text, self.reference_lines(results))
+
+    def test_single_precision_data(self):
+        # Averaged float32 means print at their own precision
+        cube = model.SweepCube(offsets=[2], gains=[0], pixels=3,
+                               dtype=numpy.float32)
+        cube.store(0, 2, 100, 98, [0.1, 1003.5, 2])
+        text = storage.format_table(storage.group_table(cube.group(2)))
+        self.assertEqual(text, "2,0,100,98,0.1,1003.5,2.0,\n")
+
+    def test_unmeasured_cells_are_skipped(self):
+        # Offset zero was never scanned, so nothing is written
+        written = []
+        rows = storage.write_group(DummyFile(written), self.cube.group(0))
+        self.assertEqual(rows, 0)
+        self.assertEqual("".join(written), "")
+
+        # Only one buffered write is made for a whole group
+        written = []
+        rows = storage.write_group(DummyFile(written), self.cube.group(1))
+        self.assertEqual(rows, 3)
+        self.assertEqual(len(written), 1)
+
+class CSVFileCase(unittest.TestCase):
+    """ Write a small three offset sweep to a temporary csv file.
+    """
+    def setUp(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.file_name = os.path.join(temp_dir, "sweep.csv")
+
+        self.cube = model.SweepCube(offsets=range(3), gains=range(5),
+                                    pixels=7)
+        for offset in range(3):
+            for gain in range(5):
+                data = numpy.arange(7) + gain + offset * 100
+                self.cube.store(gain, offset, 100, 98, data)
+
+        csv_file = open(self.file_name, "w")
+        storage.write_header(csv_file)
+        for offset in range(3):
+            storage.write_group(csv_file, self.cube.group(offset))
+        csv_file.close()
+
+    def assert_same_settings(self, meta, original):
+        """ Compare the metadata fields that are stored in csv files.
+        """
+        for name in ["offset", "gain", "linetime", "integration"]:
+            self.assertTrue(numpy.array_equal(meta[name], original[name]))
+
+class TestCSVIndex(CSVFileCase):
+
+    def build_index(self, chunk_bytes):
+        """ Helper function to index the whole test file.
+        """
+        index = storage.CSVIndex(self.file_name, chunk_bytes, cache_groups=2)
+        refs = []
+        while not index.done:
+            refs.extend(index.scan_chunk())
+        return index, refs
+
+    def test_index_entries(self):
+        for chunk_bytes in [1, 40, 50, 100000]:
+            index, refs = self.build_index(chunk_bytes)
+            self.assertEqual(index.rows, 15)
+            self.assertEqual([ref.offset for ref in refs], [0, 1, 2])
+            self.assertEqual([len(ref) for ref in refs], [5, 5, 5])
+
+    def test_groups_match_written_data(self):
+        # Chunk boundaries inside and on the edge of offset groups must
+        # all give the same result
+        for chunk_bytes in [1, 2, 27, 29, 64, 100000]:
+            index, refs = self.build_index(chunk_bytes)
+            self.assertEqual(index.position, index.size)
+
+            for ref in refs:
+                group = ref.load()
+                original = self.cube.group(group.offset)
+                self.assertEqual(group.data.dtype, numpy.uint16)
+                self.assertTrue(numpy.array_equal(group.data, original.data))
+                self.assert_same_settings(group.meta, original.meta)
+
+    def test_progress_position(self):
+        # The bytes indexed so far grow with every chunk
+        index = storage.CSVIndex(self.file_name, chunk_bytes=64)
+        self.assertEqual(index.position, len(storage.CSV_HEADER))
+        positions = []
+        while not index.done:
+            index.scan_chunk()
+            positions.append(index.position)
+        self.assertEqual(positions, sorted(positions))
+        self.assertEqual(positions[-1], index.size)
+
+    def test_float_data(self):
+        csv_file = open(self.file_name, "w")
+        storage.write_header(csv_file)
+        csv_file.write("4,0,100,98,1.5,2.0,\n")
+        csv_file.write("4,1,100,98,-3.0,4.25,\n")
+        csv_file.close()
+
+        index, refs = self.build_index(chunk_bytes=4096)
+        self.assertEqual(len(refs), 1)
+        group = refs[0].load()
+        self.assertEqual(group.offset, 4)
+        self.assertEqual(group.data.dtype, float)
+        self.assertEqual(list(group[1].data), [-3.0, 4.25])
+
+    def test_malformed_line(self):
+        self.assertRaises(ValueError, storage.parse_lines,
+                          ["1,2,3,4,5,6,\n", "1,2,3,4,5,\n"])
+
+    def test_blank_lines_and_line_endings(self):
+        csv_file = open(self.file_name, "wb")
+        csv_file.write(storage.CSV_HEADER.encode("ascii"))
+        csv_file.write(b"12,0,100,98,1,2,\r\n\r\n12,1,100,98,3,4,\r\n")
+        csv_file.write(b"\n7,0,100,98,5,6,")
+        csv_file.close()
+
+        for chunk_bytes in [1, 5, 4096]:
+            index, refs = self.build_index(chunk_bytes)
+            self.assertEqual(index.rows, 3)
+            self.assertEqual([(ref.offset, len(ref)) for ref in refs],
+                             [(12, 2), (7, 1)])
+            self.assertEqual(refs[1].load().data.tolist(), [[5, 6]])
+
+    def test_malformed_offset(self):
+        csv_file = open(self.file_name, "w")
+        storage.write_header(csv_file)
+        csv_file.write("1x,0,100,98,1,2,\n")
+        csv_file.close()
+        self.assertRaises(ValueError, self.build_index, 4096)
+
+    def test_load_single_group(self):
+        index, refs = self.build_index(chunk_bytes=64)
+
+        group = refs[2].load()
+        original = self.cube.group(2)
+        self.assertEqual(group.offset, 2)
+        self.assertTrue(numpy.array_equal(group.data, original.data))
+        self.assert_same_settings(group.meta, original.meta)
+
+        # Loaded groups are cached up to the limit
+        self.assertIs(refs[2].load(), group)
+        refs[0].load()
+        refs[1].load()
+        self.assertIsNot(refs[2].load(), group)
+
+    def test_group_load_interface(self):
+        # Groups held in a cube share the load interface
+        group = self.cube.group(1)
+        self.assertIs(group.load(), group)
+
+class TestBinaryFormats(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.temp_dir = temp_dir
+
+        # Two groups with different gain ranges, as from separate runs
+        first = model.SweepCube(offsets=[3], gains=[0, 1], pixels=5)
+        second = model.SweepCube(offsets=[9], gains=[1, 2], pixels=5)
+        for gain in [0, 1]:
+            first.store(gain, 3, 100, 98, numpy.arange(5) + gain)
+        for gain in [1, 2]:
+            second.store(gain, 9, 50, 48, numpy.arange(5) * gain)
+        self.groups = [first.group(3), second.group(9)]
+
+    def test_format_from_extension(self):
+        self.assertEqual(storage.file_format("sweep.bbq"), "bbq")
+        self.assertEqual(storage.file_format("SWEEP.NPZ"), "npz")
+        self.assertEqual(storage.file_format("sweep.csv"), "csv")
+        self.assertEqual(storage.file_format("sweep"), "csv")
+        self.assertTrue(storage.is_binary("sweep.bbq"))
+        self.assertFalse(storage.is_binary("sweep.csv"))
+
+    def test_combine_groups(self):
+        cube = storage.groups_to_cube(self.groups)
+        self.assertEqual(list(cube.offsets), [3, 9])
+        self.assertEqual(list(cube.gains), [0, 1, 2])
+        self.assertEqual(cube.meta[0, 2]["gain"], -1)
+        self.assertEqual(cube.meta[1, 0]["gain"], -1)
+        self.assertEqual(cube.meta[1, 2]["linetime"], 50)
+        self.assertEqual(list(cube.data[1, 2]), [0, 2, 4, 6, 8])
+
+        self.assertRaises(ValueError, storage.groups_to_cube, [])
+
+    def test_round_trip(self):
+        for extension in ["bbq", "npz"]:
+            file_name = os.path.join(self.temp_dir, "sweep." + extension)
+            storage.save_binary(file_name, self.groups)
+            cube = storage.load_binary(file_name)
+
+            self.assertEqual(cube.data.dtype, numpy.uint16)
+            self.assertEqual(cube.pixels, 5)
+            self.assertEqual(list(cube.offsets), [3, 9])
+            self.assertEqual(list(cube.gains), [0, 1, 2])
+
+            groups = cube.groups()
+            self.assertEqual(list(groups[0][1].data), [1, 2, 3, 4, 5])
+            self.assertEqual(groups[1][2].integration, 48)
+            del cube, groups
+
+    def test_round_trip_statistics(self):
+        cube = model.SweepCube(offsets=[3], gains=[0, 1], pixels=2,
+                               dtype=numpy.float32, statistics=True)
+        cube.store(1, 3, 100, 98, [1.5, 2.5], frames=4, std=[0.5, 0.5],
+                   minimum=[1, 2], maximum=[2, 3])
+
+        for extension in ["bbq", "npz"]:
+            file_name = os.path.join(self.temp_dir, "stats." + extension)
+            storage.save_binary(file_name, [cube.group(3)])
+            loaded = storage.load_binary(file_name)
+            self.assertTrue(loaded.statistics)
+            self.assertEqual(list(loaded.gains), [1])
+            result = loaded.group(3)[0]
+            self.assertEqual(result.frames, 4)
+            self.assertEqual(list(result.minimum), [1, 2])
+            del loaded, result
+
+        # Groups without statistics are saved without them
+        plain = model.SweepCube(offsets=[4], gains=[0], pixels=2)
+        plain.store(0, 4, 100, 98, [1, 2])
+        file_name = os.path.join(self.temp_dir, "mixed.npz")
+        storage.save_binary(file_name, [cube.group(3), plain.group(4)])
+        self.assertFalse(storage.load_binary(file_name).statistics)
+
+    def test_round_trip_clipped(self):
+        # Cells skipped as clipped keep their gains and status
+        cube = model.SweepCube(offsets=[3], gains=[0, 1, 2, 3], pixels=2)
+        cube.store(0, 3, 100, 98, [1, 2])
+        cube.store(1, 3, 100, 98, [4095, 4095])
+        cube.mark_clipped(3, [2, 3])
+
+        for extension in ["bbq", "npz"]:
+            file_name = os.path.join(self.temp_dir, "clipped." + extension)
+            storage.save_binary(file_name, [cube.group(3)])
+            loaded = storage.load_binary(file_name)
+            self.assertEqual(list(loaded.gains), [0, 1, 2, 3])
+            self.assertEqual(list(loaded.clipped()[0]),
+                             [False, False, True, True])
+            self.assertEqual(list(loaded.measured()[0]),
+                             [True, True, False, False])
+            del loaded
+
+    def test_combine_clipped_repeated_offsets(self):
+        # Two sweeps of the same offset keep their own clipped cells
+        first = model.SweepCube(offsets=[3], gains=[0, 1, 2], pixels=2)
+        first.store(0, 3, 100, 98, [4095, 4095])
+        first.mark_clipped(3, [1, 2])
+        second = model.SweepCube(offsets=[3], gains=[0, 1, 2], pixels=2)
+        for gain in range(3):
+            second.store(gain, 3, 100, 98, [1, 2])
+
+        cube = storage.groups_to_cube([first.group(3), second.group(3)])
+        self.assertEqual(list(cube.clipped()[0]), [False, True, True])
+        self.assertFalse(cube.clipped()[1].any())
+
+    def test_overwrite_mapped_file(self):
+        # Saving over a memory mapped sweep file is refused, and leaves
+        # the mapped cube readable
+        file_name = os.path.join(self.temp_dir, "sweep.bbq")
+        storage.save_binary(file_name, self.groups)
+        mapped = storage.load_binary(file_name)
+
+        self.assertRaises(ValueError, storage.save_binary, file_name,
+                          mapped.groups()[0:1])
+        self.assertEqual(list(mapped.offsets), [3, 9])
+        self.assertEqual(mapped.data[1, 2, 1], 2)
+
+        # Once the mapping is released the file can be replaced
+        copied = model.SweepCube.from_arrays(mapped.offsets[0:1],
+                                             mapped.gains,
+                                             numpy.array(mapped.data[0:1]),
+                                             numpy.array(mapped.meta[0:1]))
+        del mapped
+        storage.save_binary(file_name, copied.groups())
+        self.assertEqual(list(storage.load_binary(file_name).offsets), [3])
+
+    def test_mapped_relative_path(self):
+        # The mapped file is found under any spelling of its path,
+        # without comparing the files themselves
+        file_name = os.path.join(self.temp_dir, "sweep.bbq")
+        storage.save_binary(file_name, self.groups)
+        mapped = storage.load_binary(file_name)
+
+        original = os.path.samefile
+        del os.path.samefile
+        try:
+            relative = os.path.relpath(os.path.join(self.temp_dir, ".",
+                                                    "sweep.bbq"))
+            self.assertTrue(storage.is_mapped(relative, mapped.groups()))
+            self.assertRaises(ValueError, storage.save_binary, relative,
+                              mapped.groups())
+
+            other = os.path.join(self.temp_dir, "other.bbq")
+            storage.save_binary(other, self.groups)
+            self.assertFalse(storage.is_mapped(other, mapped.groups()))
+        finally:
+            os.path.samefile = original
+
+class DummyFile(object):
+    """ Collect every write call made to a file.
+    """
+    def __init__(self, written):
+        self.written = written
+
+    def write(self, text):
+        self.written.append(text)
+
+if __name__ == "__main__":
+    unittest.main()
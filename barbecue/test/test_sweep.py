@@ -0,0 +1,201 @@
+""" tests for the sweep strategies of barbecue
+"""
+
+import unittest
+
+import numpy
+
+from barbecue import model
+from barbecue import sweep
+from barbecue import devices
+
+def run_strategy(strategy, cube, response):
+    """ Scan every block of the strategy into the cube, using the
+    response function of gain and offset for the pixel data. Return the
+    number of scans made.
+    """
+    scans = 0
+    for offsets, gains in strategy.blocks(cube):
+        for offset in offsets:
+            for gain in gains:
+                data = numpy.zeros(cube.pixels) + response(gain, offset)
+                cube.store(gain, offset, 100, 98, data)
+                scans += 1
+    return scans
+
+class TestRasterSweep(unittest.TestCase):
+
+    def test_every_combination_in_order(self):
+        strategy = sweep.create("raster", range(3), range(4))
+        cube = model.SweepCube(range(3), range(4), pixels=2)
+        blocks = list(strategy.blocks(cube))
+        self.assertEqual(blocks, [([0], [0, 1, 2, 3]), ([1], [0, 1, 2, 3]),
+                                  ([2], [0, 1, 2, 3])])
+        self.assertTrue(strategy.offset_major)
+
+    def test_serpentine_order(self):
+        strategy = sweep.create("serpentine", range(3), range(3))
+        blocks = list(strategy.blocks(None))
+        self.assertEqual(blocks, [([0], [0, 1, 2]), ([1], [2, 1, 0]),
+                                  ([2], [0, 1, 2])])
+        self.assertTrue(strategy.offset_major)
+
+    def test_gain_major_order(self):
+        strategy = sweep.create("gain_major", range(2), range(3))
+        self.assertEqual(list(strategy.blocks(None)),
+                         [([0, 1], [0]), ([0, 1], [1]), ([0, 1], [2])])
+        self.assertFalse(strategy.offset_major)
+
+        strategy = sweep.create("gain_serpentine", range(2), range(2))
+        self.assertEqual(list(strategy.blocks(None)),
+                         [([0, 1], [0]), ([1, 0], [1])])
+
+    def test_serpentine_reduces_register_travel(self):
+        # Total gain register movement over a full sweep
+        def travel(name):
+            strategy = sweep.create(name, range(256), range(256))
+            gains = [gain for offsets, gains in strategy.blocks(None)
+                     for offset in offsets for gain in gains]
+            return numpy.abs(numpy.diff(gains)).sum()
+
+        # Raster jumps back to gain zero at every offset boundary
+        self.assertEqual(travel("raster"), 256 * 255 + 255 * 255)
+        self.assertEqual(travel("serpentine"), 256 * 255)
+
+    def test_unknown_strategy(self):
+        self.assertRaises(ValueError, sweep.create, "KnownInvalid",
+                          range(3), range(4))
+
+class TestSaturationStop(unittest.TestCase):
+
+    def test_consecutive_saturated_lines(self):
+        policy = sweep.SaturationStop(consecutive=2, full_scale=10,
+                                      fraction=0.5)
+        policy.start(range(8))
+        self.assertFalse(policy.stop([10, 10, 0, 0]))
+        self.assertFalse(policy.stop([10, 10, 10, 0]))
+
+        # An unsaturated line restarts the count
+        self.assertFalse(policy.stop([0, 0, 0, 0]))
+        self.assertFalse(policy.stop([10, 10, 10, 0]))
+        self.assertTrue(policy.stop([10, 10, 10, 10]))
+
+        # A new row starts a new count
+        policy.start(range(8))
+        self.assertFalse(policy.stop([10, 10, 10, 10]))
+
+    def test_decreasing_gains_never_stop(self):
+        policy = sweep.SaturationStop(consecutive=1, full_scale=10)
+        policy.start(range(8)[::-1])
+        self.assertFalse(policy.stop([10, 10, 10, 10]))
+
+        policy.start([3])
+        self.assertFalse(policy.stop([10, 10, 10, 10]))
+
+    def test_strategy_support(self):
+        # Gain major rows hold one gain, serpentine rows are reversed
+        self.assertIsNone(sweep.check_stop_policy("raster"))
+        self.assertIsNone(sweep.check_stop_policy("adaptive"))
+        self.assertIn("increasing", sweep.check_stop_policy("serpentine"))
+        for name in ["gain_major", "gain_serpentine"]:
+            self.assertRaises(ValueError, sweep.check_stop_policy, name)
+
+class TestAdaptiveSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.cube = model.SweepCube(range(256), range(256), pixels=4)
+
+    def test_flat_response_scans_coarse_grid_only(self):
+        strategy = sweep.create("adaptive", range(256), range(256))
+        scans = run_strategy(strategy, self.cube, lambda gain, offset: 100)
+
+        # Every 16th value plus the end of each axis
+        self.assertEqual(scans, 17 * 17)
+        self.assertEqual(self.cube.measured().sum(), 17 * 17)
+        self.assertTrue(self.cube.measured()[0, 0])
+        self.assertTrue(self.cube.measured()[255, 255])
+        self.assertFalse(self.cube.measured()[1, 1])
+
+    def test_saturation_edge_is_refined(self):
+        # Saturate above gain 100 only. The edge is narrowed down to full
+        # resolution, the rest of the grid is not refined.
+        def response(gain, offset):
+            return 4095 if gain > 100 else 1000
+
+        strategy = sweep.create("adaptive", range(256), range(256))
+        scans = run_strategy(strategy, self.cube, response)
+
+        measured = self.cube.measured()
+        self.assertTrue(measured[:, 100:105].all())
+        self.assertTrue(measured[::4, 96:113:4].all())
+        self.assertFalse(measured[:, 96:112].all())
+        self.assertFalse(measured[:, 0:96].all())
+        self.assertEqual(scans, measured.sum())
+        self.assertLess(scans, 256 * 256 / 20)
+
+    def test_linear_response_is_not_refined(self):
+        # The simulated detector responds linearly to gain and offset, so
+        # only the clip edges are refined
+        cube = model.SweepCube(range(256), range(256), pixels=64)
+        simulator = devices.FastSimulatedCobra(pixels=64)
+        strategy = sweep.create("adaptive", range(256), range(256))
+
+        scans = 0
+        for offsets, gains in strategy.blocks(cube):
+            for offset in offsets:
+                lines = simulator.grab_gain_row(gains, offset)
+                for gain, line in zip(gains, lines):
+                    self.assertFalse(cube.measured()[offset, gain])
+                    cube.store(gain, offset, 100, 98, line)
+                    scans += 1
+
+        self.assertLess(scans, 256 * 256 / 10)
+
+    def test_steep_response_is_refined(self):
+        # Response changes fast at low offsets only
+        def response(gain, offset):
+            return max(0, 3000 - offset * 100)
+
+        strategy = sweep.create("adaptive", range(256), range(256),
+                                threshold=500.0)
+        run_strategy(strategy, self.cube, response)
+
+        measured = self.cube.measured()
+        self.assertTrue(measured[28:32, :].all())
+        self.assertFalse(measured[0:16, :].all())
+        self.assertFalse(measured[64:, :].all())
+
+    def test_clipped_cells_are_not_rescanned(self):
+        # Cells skipped by a stop policy are never part of a later block
+        acquire_model = model.Model()
+        acquire_model.assign("fast")
+        cube = acquire_model.allocate(offsets=range(0, 256, 8),
+                                      gains=range(0, 256, 8))
+        strategy = sweep.create("adaptive", cube.offsets, cube.gains,
+                                step=4)
+        policy = sweep.SaturationStop(consecutive=2)
+
+        for offsets, gains in strategy.blocks(cube):
+            cells = numpy.ix_([cube.offset_position(value)
+                               for value in offsets],
+                              [cube.gain_position(value) for value in gains])
+            self.assertFalse(cube.clipped()[cells].any())
+            acquire_model.scan_many(gains, offsets, 100, 98, policy=policy)
+
+        self.assertTrue(cube.clipped().any())
+        self.assertFalse((cube.clipped() & cube.measured()).any())
+        self.assertTrue(acquire_model.close_model())
+
+    def test_single_offset(self):
+        cube = model.SweepCube([7], range(40), pixels=4)
+        strategy = sweep.create("adaptive", [7], range(40), step=16)
+        scans = run_strategy(strategy, cube, lambda gain, offset: gain * 100)
+
+        # Four coarse points, then the tiles down to the zero clip edge
+        # at gain zero, with no point scanned twice
+        self.assertEqual(scans, 4 + 3 + 3)
+        self.assertTrue(cube.measured()[0, 0:5].all())
+        self.assertFalse(cube.measured()[0, 5])
+
+if __name__ == "__main__":
+    unittest.main()
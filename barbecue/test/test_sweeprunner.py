@@ -0,0 +1,121 @@
+""" tests for the headless command line sweep runner
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from barbecue import storage
+from barbecue import progress
+from barbecue import SweepRunner
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+class TestSweepRunnerScript(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.stream = StringIO()
+        self.runner = SweepRunner.SweepRunnerApplication(self.stream)
+
+    def run_sweep(self, file_name, *extra):
+        output = os.path.join(self.temp_dir, file_name)
+        self.runner.parse_args(["-o", output, "--gains", "0", "3",
+                                "--offsets", "10", "11"] + list(extra))
+        self.assertEqual(self.runner.run(), 8)
+        return output
+
+    def test_parser(self):
+        # An output file is required, the defaults cover the full range
+        with self.assertRaises(SystemExit):
+            self.runner.parse_args([])
+
+        args = self.runner.parse_args(["-o", "sweep.bbq"])
+        self.assertEqual(args.device, "single")
+        self.assertEqual(args.gains, [0, 255])
+        self.assertEqual(args.offsets, [0, 255])
+        self.assertEqual(args.strategy, "raster")
+
+    def test_config_file(self):
+        # Config settings replace defaults, command line replaces both
+        config = os.path.join(self.temp_dir, "sweep.json")
+        json.dump({"gains": [5, 9], "frames": 4, "output": "a.npz"},
+                  open(config, "w"))
+
+        args = self.runner.parse_args(["-c", config, "--frames", "2"])
+        self.assertEqual(args.gains, [5, 9])
+        self.assertEqual(args.frames, 2)
+        self.assertEqual(args.output, "a.npz")
+
+        json.dump({"unknown": 1}, open(config, "w"))
+        with self.assertRaises(SystemExit):
+            self.runner.parse_args(["-c", config, "-o", "sweep.bbq"])
+
+    def test_binary_output(self):
+        # A bbq sweep is mapped straight to the output file
+        output = self.run_sweep("sweep.bbq")
+        cube = storage.load_binary(output)
+        self.assertEqual(list(cube.offsets), [10, 11])
+        self.assertEqual(list(cube.gains), [0, 1, 2, 3])
+        self.assertTrue(cube.measured().all())
+
+        output = self.run_sweep("sweep.npz", "--strategy", "serpentine")
+        cube = storage.load_binary(output)
+        self.assertEqual(cube.data.shape, (2, 4, 2048))
+        self.assertTrue(cube.measured().all())
+
+    def test_csv_output(self):
+        # Each offset group is appended in the csv format
+        output = self.run_sweep("sweep.csv")
+        self.assertNotIn(b"\r", open(output, "rb").read())
+        lines = open(output).readlines()
+        self.assertEqual(lines[0], storage.CSV_HEADER)
+        self.assertEqual(len(lines), 9)
+        self.assertTrue(lines[1].startswith("10,0,100,98,"))
+        self.assertTrue(lines[-1].startswith("11,3,100,98,"))
+
+    def test_progress_report(self):
+        # Every scan is reported with no interval, then the total
+        self.run_sweep("sweep.bbq", "--interval", "0")
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 9)
+        self.assertTrue(lines[0].startswith("1/8 scans"))
+        self.assertIn("ETA", lines[0])
+        self.assertTrue(lines[-1].startswith("Done 8 scans"))
+
+        self.assertEqual(progress.format_seconds(3725.2), "1:02:05")
+
+    def test_unsupported_stop_policy(self):
+        # A saturation stop never ends a row of a gain major sweep
+        with self.assertRaises(SystemExit):
+            self.runner.parse_args(["-o", "sweep.bbq", "--stop-saturated",
+                                    "4", "--strategy", "gain_major"])
+        args = self.runner.parse_args(["-o", "sweep.bbq", "--stop-saturated",
+                                       "4", "--strategy", "serpentine"])
+        self.assertEqual(args.strategy, "serpentine")
+
+    def test_unknown_device(self):
+        # No output file is created for a device that can not be opened
+        output = os.path.join(self.temp_dir, "sweep.bbq")
+        self.runner.parse_args(["-o", output, "-d", "KnownInvalid"])
+        self.assertRaises(ValueError, self.runner.run)
+        self.assertFalse(os.path.exists(output))
+
+    def test_device_help(self):
+        # The device types are listed when the help is shown
+        help_text = self.runner.parser.format_help()
+        self.assertIn("fast", help_text)
+        self.assertIn("replay", help_text)
+
+    def test_main_options(self):
+        # Main returns the exit code of bad arguments
+        self.assertEqual(SweepRunner.main(["unittest"]), 2)
+
+if __name__ == "__main__":
+    unittest.main()
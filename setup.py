@@ -14,6 +14,9 @@ config = {
     "install_requires": ["numpy"],
     "packages": ["barbecue"],
     "scripts": [],
+    "entry_points": {
+        "console_scripts": ["SweepRunner = barbecue.SweepRunner:main"],
+    },
     "name": "Barbecue"
 }
 